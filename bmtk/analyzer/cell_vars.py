@@ -0,0 +1,69 @@
+import os
+import h5py
+import numpy as np
+
+
+def load_cell_vars(file_name, gid):
+    """
+    Load the variables saved for a single cell
+
+
+    :param file_name: directory with one h5 file per gid (output:cell_vars_dir) or a single cell variables file
+                      (output:cell_vars_file)
+    :param gid: gid of the cell
+
+    :return cell_vars: dict with a time series for each variable, the same datasets as in the file of a single gid
+    """
+    if os.path.isdir(file_name):
+        with h5py.File(os.path.join(file_name, '%d.h5' % gid), 'r') as h5:
+            return {name: h5[name][()] for name in h5.keys()}
+
+    cell_vars = {}
+    with h5py.File(file_name, 'r') as h5:
+        column = _gid_columns(h5, [gid])[0]
+        index_pointer = h5['mapping/index_pointer']
+        seg0, seg1 = int(index_pointer[column]), int(index_pointer[column+1])
+
+        for name, ds in h5.items():
+            if name == 'mapping':
+                continue
+            elif name == 'spikes':
+                cell_vars[name] = ds['timestamps'][()][ds['gids'][()] == gid]
+            elif name.endswith('_all_segs'):
+                cell_vars[name] = ds[:, seg0:seg1]
+            else:
+                cell_vars[name] = ds[:, column]
+
+    return cell_vars
+
+
+def load_cell_var(file_name, var, gids=None):
+    """
+    Load one variable for many cells from a single cell variables file
+
+
+    :param file_name: cell variables file (output:cell_vars_file)
+    :param var: name of the variable
+    :param gids: list of gids, all the saved gids when None
+
+    :return gids, values: array of gids and the (time, gid) time series in the same order
+    """
+    with h5py.File(file_name, 'r') as h5:
+        if gids is None:
+            return h5['mapping/gids'][()], h5[var][()]
+
+        columns = _gid_columns(h5, gids)
+        order = np.argsort(columns)  # h5py can only read increasing indices
+        values = np.empty((h5[var].shape[0], len(columns)), dtype=h5[var].dtype)
+        values[:, order] = h5[var][:, list(columns[order])]
+        return np.array(gids), values
+
+
+def _gid_columns(h5, gids):
+    mapping_gids = h5['mapping/gids'][()]
+    columns = dict((gid, indx) for indx, gid in enumerate(mapping_gids))
+    missing = [gid for gid in gids if gid not in columns]
+    if missing:
+        raise Exception('gids {} were not saved in {}'.format(missing, h5.filename))
+
+    return np.array([columns[gid] for gid in gids])
@@ -0,0 +1,147 @@
+# Allen Institute Software License - This software license is the 2-clause BSD license plus clause a third
+# clause that prohibits redistribution for commercial purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the Allen Institute's written permission. For
+# purposes of this license, commercial purposes is the incorporation of the Allen Institute's software into anything for
+# which you will charge fees or other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Places the synapses of bionet edges when the network is built.
+
+SynapseLocations is a rule for ConnectionMap.add_properties that draws the segment of each synapse with the same
+section and distance rules used by bionet when placing synapses at run time (Morphology.find_target_segments), and
+returns the index of the segment in the cell (sec_id) and its location along the section (sec_x):
+
+    cm = net.add_edges(source=lgn.nodes(), target=net.nodes(level_of_detail='biophysical'),
+                       connection_rule=5, target_sections=['apical'], distance_range=[50.0, 1e20], ...)
+    cm.add_properties(['sec_id', 'sec_x'],
+                      rule=SynapseLocations('components/biophysical/morphology', 'components/hoc_templates'),
+                      rule_params={'target_sections': ['apical'], 'distance_range': [50.0, 1e20]},
+                      dtypes=[np.int32, np.float])
+
+Every synapse is saved as a separate edge and bionet connects the edges with sec_id and sec_x columns to the given
+segments, so no placement is done when the simulation starts and every run uses the same locations.
+
+The locations of a target are drawn one after the other from a random stream seeded with seed + node_id, the same
+stream bionet uses to place the synapses of the edges without sec_id and sec_x (BioCell.set_syn_connections_batch,
+one draw per synapse in the order of the edges file). The draw of an edge therefore depends on the order in which
+the builder calls the rule for the edges of its target: the locations are the same as the ones bionet would draw only
+when the rule is called in the order the edges are saved, and rules sharing a SynapseLocations share the streams. The cells must
+be simulated with the same segmentation (dL or the d_lambda rule) and axon replacement used here, otherwise the
+segment indexes will differ. Requires
+NEURON, which is only imported when the first morphology is loaded.
+"""
+import os
+import json
+import numpy as np
+
+
+class SynapseLocations(object):
+    """Rule returning the (sec_id, sec_x) location of a synapse on the target cell
+
+    :param morphology_dir: directory of the SWC files, the morphology of a target is its morphology_file property
+    :param templates_dir: directory of the hoc templates, needs the Biophys1 template used to import the SWC files
+    :param dL: maximum length of the segments, the same as run/dL of the simulation
+    :param fix_axon: name of the function of bionet.default_setters.cell_models that replaces the axon of the cell
+        model, fix_axon for the perisomatic models (Biophys1) and fix_axon_allactive for Biophys1_adjusted, None keeps
+        the reconstructed axon
+    :param seed: the locations on each target are drawn from a random stream seeded with seed + node_id, in the order
+        the rule is called for the edges of the target
+    :param nseg_rule: segmentation options of the simulation (run/nseg_rule, d_lambda, d_lambda_freq and max_nseg),
+        see bionet.utils.calc_nseg
+    :param params_dir: directory of the cell model json files, the d_lambda rule needs the axial resistance and
+        capacitance of the "passive" parameters in the params_file of each target
+    """
+    def __init__(self, morphology_dir, templates_dir, dL=20.0, fix_axon='fix_axon', seed=201, nseg_rule=None,
+                 params_dir=None):
+        self._morphology_dir = morphology_dir
+        self._templates_dir = templates_dir
+        self._dL = dL
+        self._fix_axon = fix_axon
+        self._seed = seed
+        self._nseg_rule = nseg_rule or {}
+        self._params_dir = params_dir
+
+        self._morphologies = {}  # bionet Morphology of each SWC file and params file
+        self._prngs = {}  # random stream of each target
+
+    def __call__(self, source, target, target_sections, distance_range):
+        morph = self.get_morphology(self._morphology_file(target), self._params_file(target))
+        tar_seg_ix, _, tar_seg_cdf = morph.find_target_segments(target_sections, distance_range)
+
+        node_id = target.node_id
+        if node_id not in self._prngs:
+            self._prngs[node_id] = np.random.RandomState(self._seed + node_id)
+        seg_ix = tar_seg_ix[tar_seg_cdf.searchsorted(self._prngs[node_id].random_sample(), side='right')]
+
+        return int(seg_ix), float(morph.seg_prop['x'][seg_ix])
+
+    def get_morphology(self, morphology_file, params_file=None):
+        """Segments of a cell with the given SWC file and passive parameters, the file is loaded only once"""
+        key = (morphology_file, params_file)
+        if key not in self._morphologies:
+            self._morphologies[key] = self._load_morphology(morphology_file, params_file)
+        return self._morphologies[key]
+
+    def _morphology_file(self, target):
+        for col in ['morphology_file', 'morphology']:
+            if col in target:
+                return os.path.join(self._morphology_dir, target[col])
+        raise Exception('Target node {} does not have a morphology.'.format(target.node_id))
+
+    def _params_file(self, target):
+        if self._nseg_rule.get('nseg_rule', 'dL') != 'd_lambda':
+            return None  # the segments do not depend on the cell model
+        if self._params_dir is None or 'params_file' not in target:
+            raise Exception('The d_lambda rule needs the params_file of target node {}.'.format(target.node_id))
+        return os.path.join(self._params_dir, target['params_file'])
+
+    def _load_morphology(self, morphology_file, params_file):
+        from neuron import h
+        from bmtk.simulator.bionet import morphology_cache, nrn, utils
+        from bmtk.simulator.bionet.default_setters import cell_models
+        from bmtk.simulator.bionet.morphology import Morphology
+
+        if not hasattr(h, 'Biophys1'):
+            h.load_file('stdgui.hoc')
+            h.load_file(os.path.join(os.path.dirname(nrn.__file__), 'import3d.hoc'))
+            nrn.load_templates(self._templates_dir)
+
+        hobj = morphology_cache.load_morphology(morphology_file)
+        if self._fix_axon is not None:
+            getattr(cell_models, self._fix_axon)(hobj)
+
+        if params_file is not None:
+            with open(params_file, 'r') as f:
+                passive = json.load(f)['passive'][0]
+            cm_dict = dict((c['section'], c['cm']) for c in passive.get('cm', []))
+            for sec in hobj.all:
+                sec.Ra = passive.get('ra', sec.Ra)
+                sec.cm = cm_dict.get(sec.name().split('.')[-1][:4], sec.cm)
+
+        for sec in hobj.all:
+            sec.nseg = utils.calc_nseg(sec, self._dL, **self._nseg_rule)  # as in BioCell.set_nseg
+
+        morph = Morphology(hobj)
+        morph.set_seg_props()
+        return morph
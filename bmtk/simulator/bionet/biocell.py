@@ -26,30 +26,39 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 import numpy as np
-from bmtk.simulator.bionet import utils, nrn
+from bmtk.simulator.bionet import utils, nrn, multisplit
 from bmtk.simulator.bionet.cell import Cell
 
 from neuron import h
 
 pc = h.ParallelContext()    # object to access MPI methods
+MPI_RANK = int(pc.id())
 
 
 class BioCell(Cell):
     """Implemntation of a morphologically and biophysically detailed type cell.
 
     """
-    def __init__(self, node, spike_threshold, dL, calc_ecp=False):
-        super(BioCell, self).__init__(node)
+    def __init__(self, node, spike_threshold, dL, calc_ecp=False, nseg_rule=None, split=None):
+        """
+        :param split: multisplit.CellSplit of a cell split among the ranks, the cell is built whole and reduced to the
+            sections of this rank by split()
+        """
+        self._split = split
+        self._seg_kept = None  # segments on this rank of a split cell
+        super(BioCell, self).__init__(node, register=self.owns_soma)
 
         # Set up netcon object that can be used to detect and communicate cell spikes.
-        self.set_spike_detector(spike_threshold)
+        if self.owns_soma:
+            self.set_spike_detector(spike_threshold)
 
         self._morph = None
         self._seg_coords = {}
 
         # Determine number of segments and store a list of all sections.
         self._nseg = 0
-        self.set_nseg(dL)
+        self._sec_nsegs = ()
+        self.set_nseg(dL, nseg_rule)
         self._secs = []
         self.set_sec_array()
 
@@ -58,7 +67,10 @@ class BioCell(Cell):
         self._syn_seg_ix = []
         self._syn_sec_x = []
 
- 
+        self._vars = []  # names of variables recorded from every segment (see set_vars_ptr)
+        self.vars_ptr = None
+        self.varsVec = None
+
         if calc_ecp:
             self.im_ptr = h.PtrVector(self._nseg)  # pointer vector
             self.im_ptr.ptr_update_callback(self.set_im_ptr)   # used for gathering an array of  i_membrane values from the pointer vector
@@ -69,12 +81,18 @@ class BioCell(Cell):
         nc.threshold = spike_threshold     
         pc.cell(self.gid, nc)  # associate gid with spike detector
 
-    def set_nseg(self, dL):
-        """Define number of segments in a cell"""
+    def set_nseg(self, dL, nseg_rule=None):
+        """Define number of segments in a cell
+
+        :param dL: maximum length of a segment
+        :param nseg_rule: optional segmentation options passed to utils.calc_nseg (nseg_rule, d_lambda, d_lambda_freq
+            and max_nseg), by default the sections are split in segments of at most dL
+        """
         self._nseg = 0
         for sec in self.hobj.all:
-            sec.nseg = 1 + 2 * int(sec.L/(2*dL))
+            sec.nseg = utils.calc_nseg(sec, dL, **(nseg_rule or {}))
             self._nseg += sec.nseg # get the total number of segments in the cell
+        self._sec_nsegs = tuple(sec.nseg for sec in self.hobj.all)
 
     def calc_seg_coords(self, morph_seg_coords):
         """Calculate segment coordinates for individual cells"""
@@ -89,6 +107,37 @@ class BioCell(Cell):
         self._seg_coords['p0'] = self._pos_soma + np.dot(RotYZ, morph_seg_coords['p0'])
         self._seg_coords['p1'] = self._pos_soma + np.dot(RotYZ, morph_seg_coords['p1'])
 
+    @property
+    def owns_soma(self):
+        """False for the pieces of a split cell on the ranks without the soma"""
+        return self._split is None or self._split.owner == MPI_RANK
+
+    def split(self):
+        """Delete the sections of a split cell that are on other ranks, see multisplit.split_hobj
+
+        The segment indexes of the morphology still refer to the whole cell, the synapses on the segments of other
+        ranks are skipped. nseg, the segment coordinates and the recorded segments are those of this rank.
+        """
+        secs_kept = multisplit.split_hobj(self.hobj, self._split, MPI_RANK)
+        self._seg_kept = np.repeat(secs_kept, self._sec_nsegs)
+        self._nseg = int(np.sum(self._seg_kept))
+        for key, coords in self._seg_coords.items():
+            self._seg_coords[key] = coords[:, self._seg_kept]
+
+        if hasattr(self, 'im_ptr'):
+            self.im_ptr = h.PtrVector(self._nseg)
+            self.im_ptr.ptr_update_callback(self.set_im_ptr)
+            self.imVec = h.Vector(self._nseg)
+
+    @property
+    def nseg(self):
+        return self._nseg
+
+    @property
+    def sec_nsegs(self):
+        """Number of segments of each section, in the order of the segment indexes"""
+        return self._sec_nsegs
+
     def get_seg_coords(self):
         
         return self._seg_coords
@@ -113,83 +162,85 @@ class BioCell(Cell):
 
         self._secs = np.array(secs)
 
-    def set_syn_connection(self, edge_prop, src_node, stim=None):
-        syn_weight = edge_prop.weight(src_node, self._node)
-        if edge_prop.preselected_targets:
-            return self._set_connection_preselected(edge_prop, src_node, syn_weight, stim)
-        else:
-            return self._set_connections(edge_prop, src_node, syn_weight, stim)
-
-    def _set_connection_preselected(self, edge_prop, src_node, syn_weight, stim=None):
-        sec_x = edge_prop['sec_x']
-        sec_id = edge_prop['sec_id']
-        section = self._secs[sec_id]
-        #syn_weight = edge_prop['syn_weight']
-
-        delay = edge_prop['delay']
-        synapse_fnc = nrn.py_modules.synapse_model(edge_prop['template'])
-        syn = synapse_fnc(edge_prop['dynamics_params'], sec_x, section)
-
-        if stim is not None:
-            nc = h.NetCon(stim.hobj, syn)  # stim.hobj - source, syn - target
-        else:
-            nc = pc.gid_connect(src_node.node_id, syn)
-
-        nc.weight[0] = syn_weight
-        nc.delay = delay
-        self._netcons.append(nc)
-        self._synapses.append(syn)
-        self._syn_seg_ix.append(sec_id)
-        self._syn_src_gid.append(src_node.node_id)
-        self._syn_sec_x.append(sec_x)
-        return 1
-
-    def _set_connections(self, edge_prop, src_node, syn_weight, stim=None):
-        tar_seg_ix, tar_seg_prob = self._morph.get_target_segments(edge_prop)
-        src_gid = src_node.node_id
-        nsyns = edge_prop.nsyns
-
-        # choose nsyn elements from seg_ix with probability proportional to segment area
-        segs_ix = self.prng.choice(tar_seg_ix, nsyns, p=tar_seg_prob)
-
-        # prints physical location of the segments with the synapses, center of the segment
-        #print "Segments with synapses, first segment"
-        p0=self._morph.seg_coords['p0'][:,segs_ix]
-        #print p0
-        #print '\n'
-        p1=self._morph.seg_coords['p1'][:,segs_ix]
-        #print 'Second segment'
-        #print p1
-        #print '\n'
-        print 'Segments with synapses, segment center'
-        print (p0+p1)/2
+    def set_syn_connections_batch(self, edge_groups, stims=None):
+        """Sets the synapses of all the incoming edges of the cell at once
+
+        The edges come grouped by edge type (see SimEdgeGroup) with their properties as arrays, and the synapses of a
+        group are created with one call to its synapse model. The locations of the synapses of the edges without
+        preselected targets are drawn with a single call to the random stream of the cell, in the order of the edges
+        in the edges file, and the target segments are looked up once for each group. The locations are the same as
+        drawing them one edge at a time with prng.choice.
+
+        :param edge_groups: list of BioEdgeGroup of the incoming edges
+        :param stims: Stim of each source gid for the edges from an external network, None for recurrent connections
+        :return: number of synapses created
+        """
+        placed = [edges for edges in edge_groups if not edges.preselected_targets]
+        nsyns = [np.asarray(edges.nsyns, dtype=np.int64) for edges in placed]
+
+        # the synapses of an edge take the samples after the synapses of the edges before it in the edges file
+        rows = np.concatenate([edges.rows for edges in placed] + [np.zeros(0, dtype=np.int64)])
+        all_nsyns = np.concatenate(nsyns + [np.zeros(0, dtype=np.int64)])
+        order = np.argsort(rows, kind='mergesort')
+        first_syn = np.zeros(len(rows), dtype=np.int64)
+        first_syn[order] = np.cumsum(all_nsyns[order]) - all_nsyns[order]
+        total = int(np.sum(all_nsyns))
+        samples = self.prng.random_sample(total) if total > 0 else np.zeros(0)
+
+        syn_counter = 0
+        offset = 0
+        for edges, edges_nsyns in zip(placed, nsyns):
+            edges_first = first_syn[offset:offset + len(edges)]
+            offset += len(edges)
+            edge_ix = np.repeat(np.arange(len(edges)), edges_nsyns)
+            syn_ids = np.repeat(edges_first - (np.cumsum(edges_nsyns) - edges_nsyns), edges_nsyns) + \
+                np.arange(len(edge_ix))
+            tar_seg_ix, tar_seg_cdf = self._morph.get_target_cdf(edges.edge)
+            segs_ix, xs = self._morph.seg_locations(tar_seg_ix[tar_seg_cdf.searchsorted(samples[syn_ids],
+                                                                                          side='right')])
+            syn_counter += self._set_connections(edges, edge_ix, segs_ix, xs, stims)
+
+        for edges in edge_groups:
+            if edges.preselected_targets:
+                segs_ix, xs = self._morph.seg_locations(edges.column('sec_id'), edges.column('sec_x'))
+                syn_counter += self._set_connections(edges, np.arange(len(edges)), segs_ix, xs, stims)
+
+        return syn_counter
+
+    def _set_connections(self, edges, edge_ix, segs_ix, xs, stims=None):
+        """Creates the synapses of a group of edges, the synapse on segment segs_ix[i] at xs[i] is of edge edge_ix[i]"""
+        if self._seg_kept is not None:
+            # the synapses on the other pieces of a split cell are made by their ranks
+            kept = self._seg_kept[segs_ix]
+            edge_ix, segs_ix, xs = edge_ix[kept], segs_ix[kept], xs[kept]
+        if len(segs_ix) == 0:
+            return 0
 
         secs = self._secs[segs_ix]  # sections where synapases connect
-        xs = self._morph.seg_prop['x'][segs_ix]  # distance along the section where synapse connects, i.e., seg_x
-        # print secs, xs
+        if edges.preselected_targets and 'template' in edges:
+            synapse_fnc = nrn.py_modules.synapse_model(edges.edge['template'])
+            synapses = [synapse_fnc(edges.edge['dynamics_params'], x, sec) for x, sec in zip(xs, secs)]
+        else:
+            synapses = edges.load_synapses(xs, secs)
 
-        # TODO: this should be done just once
-        synapses = edge_prop.load_synapses(xs, secs)
-        delay = edge_prop['delay']
+        src_gids = edges.source_gids[edge_ix]
+        weights = edges.weights(self._node)[edge_ix]
+        delays = edges.column('delay')[edge_ix]
         self._synapses.extend(synapses)
-        self._syn_seg_ix.extend(segs_ix)  # use only when need to output synaptic locations
-        self._syn_src_gid.extend([src_gid] * nsyns)
-        self._syn_sec_x.extend(xs)
-
+        self._syn_seg_ix.extend(segs_ix.tolist())  # use only when need to output synaptic locations
+        self._syn_src_gid.extend(src_gids.tolist())
+        self._syn_sec_x.extend(xs.tolist())
 
-        for syn in synapses:
-            # connect synapses
-            if stim:
-                nc = h.NetCon(stim.hobj, syn)  # stim.hobj - source, syn - target
+        for syn, src_gid, weight, delay in zip(synapses, src_gids.tolist(), weights, delays):
+            if stims is not None:
+                nc = h.NetCon(stims[src_gid].hobj, syn)  # stim.hobj - source, syn - target
             else:
                 nc = pc.gid_connect(src_gid, syn)
 
-
-
-            nc.weight[0] = syn_weight
+            nc.weight[0] = weight
             nc.delay = delay
-            self.netcons.append(nc)
-        return nsyns
+            self._netcons.append(nc)
+        return len(synapses)
 
     def set_syn_connections(self, nsyn, syn_weight, edge_type, src_gid, stim=None):
         """Set synaptic connections"""
@@ -242,6 +293,82 @@ class BioCell(Cell):
         self.im_ptr.gather(self.imVec)
         return self.imVec.as_numpy()  # (nA)
 
+    def set_vars_ptr(self, var_names):
+        """Set PtrVector to point to the variables recorded from the soma and every segment of the cell.
+
+        For each variable the pointer vector holds nseg+1 entries, the first pointing to soma[0](0.5) and the rest to
+        each segment in the same order as set_im_ptr, so that all the variables can be gathered with a single call.
+        """
+        self._vars = list(var_names)
+        nptrs = len(self._vars)*(self._nseg + 1)
+        self.vars_ptr = h.PtrVector(nptrs)
+        self.vars_ptr.ptr_update_callback(self._update_vars_ptr)  # pointers are reset when NEURON reallocates memory
+        self.varsVec = h.Vector(nptrs)
+        self._update_vars_ptr()
+
+    def _update_vars_ptr(self):
+        jptr = 0
+        for var in self._vars:
+            ref_name = '_ref_' + var
+            self.vars_ptr.pset(jptr, getattr(self.hobj.soma[0](0.5), ref_name))
+            jptr += 1
+            for sec in self.hobj.all:
+                for seg in sec:
+                    self.vars_ptr.pset(jptr, getattr(seg, ref_name))
+                    jptr += 1
+
+    def get_vars(self):
+        """Gather recorded variables from PtrVector into an array of shape (nvars, nseg+1), column 0 is the soma"""
+        self.vars_ptr.gather(self.varsVec)
+        return self.varsVec.as_numpy().reshape(len(self._vars), self._nseg + 1)
+
+    def set_vars_record(self, var_names, buffer_size):
+        """Record the variables from the soma and every segment into hoc Vectors, in the same order as set_vars_ptr.
+
+        The values are stored by NEURON itself at every time step, buffer_size should be the number of steps kept in
+        memory before the vectors are read and cleared by the caller.
+        """
+        self._vars = list(var_names)
+        self._vars_vecs = []
+        for var in self._vars:
+            ref_name = '_ref_' + var
+            soma = self.hobj.soma[0]
+            vecs = [self._record_vector(getattr(soma(0.5), ref_name), soma, buffer_size)]
+            for sec in self.hobj.all:
+                for seg in sec:
+                    vecs.append(self._record_vector(getattr(seg, ref_name), sec, buffer_size))
+            self._vars_vecs.append(vecs)
+
+    def get_recorded_vars(self):
+        """Array of the recorded variables with shape (nvars, nsteps, nseg+1), column 0 is the soma"""
+        return np.array([[vec.as_numpy() for vec in vecs] for vecs in self._vars_vecs]).transpose(0, 2, 1)
+
+    def set_im_record(self, buffer_size):
+        """Record i_membrane_ of every segment into hoc Vectors, segments are ordered the same as in set_im_ptr"""
+        self._im_vecs = []
+        for sec in self.hobj.all:
+            for seg in sec:
+                self._im_vecs.append(self._record_vector(seg._ref_i_membrane_, sec, buffer_size))
+
+    def get_recorded_im(self):
+        """Array of recorded membrane currents with shape (nsteps, nseg) (nA)"""
+        return np.array([vec.as_numpy() for vec in self._im_vecs]).T
+
+    def clear_recordings(self):
+        """Empty the recording vectors (keeps the allocated buffers)"""
+        for vecs in getattr(self, '_vars_vecs', []):
+            for vec in vecs:
+                vec.resize(0)
+
+        for vec in getattr(self, '_im_vecs', []):
+            vec.resize(0)
+
+    def _record_vector(self, var_ref, sec, buffer_size):
+        vec = h.Vector()
+        vec.buffer_size(buffer_size)
+        vec.record(var_ref, sec=sec)
+        return vec
+
     def print_synapses(self):
         rstr = ''
         for i in xrange(len(self._syn_src_gid)):
@@ -28,7 +28,7 @@
 import os
 import json
 
-from bmtk.simulator.utils.graph import SimGraph, SimEdge, SimNode
+from bmtk.simulator.utils.graph import SimGraph, SimEdge, SimEdgeGroup, SimNode
 import bmtk.simulator.bionet.config as cfg
 from bmtk.simulator.bionet.property_schemas import DefaultPropertySchema, CellTypes
 
@@ -37,7 +37,7 @@ class BioEdge(SimEdge):
     def __init__(self, original_params, dynamics_params, graph):
         super(BioEdge, self).__init__(original_params, dynamics_params)
         self._graph = graph
-        self._preselected_targets = graph.property_schema.preselected_targets()
+        self._preselected_targets = graph.property_schema.preselected_targets(original_params)
         self._target_sections = graph.property_schema.target_sections(original_params)
         self._target_distance = graph.property_schema.target_distance(original_params)
         self._nsyns = graph.property_schema.nsyns(original_params)
@@ -65,6 +65,19 @@ class BioEdge(SimEdge):
         return self._graph.property_schema.load_synapse_obj(self, section_x, section_id)
 
 
+class BioEdgeGroup(SimEdgeGroup):
+    @property
+    def preselected_targets(self):
+        return self._edge.preselected_targets
+
+    @property
+    def nsyns(self):
+        return self._graph.property_schema.edges_nsyns(self)
+
+    def load_synapses(self, section_x, section_id):
+        return self._edge.load_synapses(section_x, section_id)
+
+
 class BioNode(SimNode):
     def __init__(self, node_id, graph, network, node_params):
         super(BioNode, self).__init__(node_id, graph, network, node_params)
@@ -157,6 +170,9 @@ class BioGraph(SimGraph):
     def _create_edge(self, edge, dynamics_params):
         return BioEdge(edge, dynamics_params, self)
 
+    def _create_edge_group(self, block, rows, edge, source_nodes):
+        return BioEdgeGroup(self, block, rows, edge, source_nodes)
+
     def _add_node(self, node_params, network):
         node = BioNode(node_params.gid, self, network, node_params)
         if node.cell_type == CellTypes.Biophysical:
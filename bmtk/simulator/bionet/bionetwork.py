@@ -25,18 +25,20 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
 import h5py
 
 from bmtk.simulator.bionet.lifcell import LIFCell
 from bmtk.simulator.bionet.biocell import BioCell
 from bmtk.simulator.bionet.stim import Stim
 from bmtk.simulator.bionet.morphology import Morphology
-from bmtk.simulator.bionet import nrn, io
+from bmtk.simulator.bionet import nrn, io, morphology_cache, morphology_reduction, impedance, load_balance, multisplit
 from bmtk.simulator.bionet.property_schemas import CellTypes
 import bmtk.simulator.bionet.config as cfg
 
 # TODO: leave this import, it will initialize some of the default functions for building neurons/synapses/weights.
 import bmtk.simulator.bionet.default_setters
+from bmtk.simulator.bionet.default_setters import cell_models
 
 from neuron import h
 
@@ -61,7 +63,12 @@ class BioNetwork(object):
         
         self.__spike_threshold = -15.0  # membrane voltage of spike for a biophysical cell
         self.__dL = 20  # max length of a morphology segement
+        self.__nseg_rule = {}  # options of utils.calc_nseg for the number of segments, by default from dL
         self.__calc_ecp = False  # for calculating extracellular field potential
+        self.__morphology_reduction = None  # options of the reduced morphologies, None to simulate the full cells
+        self.__load_balance = {'method': 'cost'}  # how the cells are distributed among the ranks
+        self.__multisplit = None  # options of the cells split among the ranks, None to keep each cell on one rank
+        self.__nthreads = 1  # threads integrating the cells of each rank
         self._cells_built = False
         self._morphologies_built = False
         self._connections_initialized = False
@@ -72,11 +79,15 @@ class BioNetwork(object):
         self._local_node_gids = []  # All gids on this rank
         self._local_node_types = {}
         self._local_biophys_gids = []
+        self._node_costs = None  # estimated (or measured) cost of every internal node by gid
+        self._splits = {}  # multisplit.CellSplit of the cells split among the ranks with a piece on this rank by gid
+        self._piece_gids = []  # split cells with a piece on this rank but the soma on another rank
         self._local_lif_gids = []
         self._saved_gids = []  # GIDs specified in "groups", used for saving membrane-potential, Ca++ flux, etc
         self._cells = {}  # table of Cell-Type objects searchable by gid
 
-        self.__morphologies_cache = {}  # Table of saved morphology files
+        self.__morphologies_cache = {}  # Morphology objects by (morphology file, dL, cell model, nseg of each section)
+        self.__morphology_gids = {}  # gids of the cells sharing each Morphology object
         self._stims = {}  # dictionary of external/stim/virtual nodes by [network_name][gid]
         self._spike_trains_ds = {}  # save nwb spike-train datasets for when stims need to be built
 
@@ -96,6 +107,14 @@ class BioNetwork(object):
     def dL(self, segment_length):
         self.__dL = segment_length
 
+    @property
+    def nseg_rule(self):
+        return self.__nseg_rule
+
+    @nseg_rule.setter
+    def nseg_rule(self, options):
+        self.__nseg_rule = options
+
     @property
     def calc_ecp(self):
         return self.__calc_ecp
@@ -104,6 +123,38 @@ class BioNetwork(object):
     def calc_ecp(self, value):
         self.__calc_ecp = value
 
+    @property
+    def morphology_reduction(self):
+        return self.__morphology_reduction
+
+    @morphology_reduction.setter
+    def morphology_reduction(self, options):
+        self.__morphology_reduction = options
+
+    @property
+    def load_balance(self):
+        return self.__load_balance
+
+    @load_balance.setter
+    def load_balance(self, options):
+        self.__load_balance = options
+
+    @property
+    def multisplit(self):
+        return self.__multisplit
+
+    @multisplit.setter
+    def multisplit(self, options):
+        self.__multisplit = options
+
+    @property
+    def nthreads(self):
+        return self.__nthreads
+
+    @nthreads.setter
+    def nthreads(self, n):
+        self.__nthreads = n
+
     @property
     def gids(self):
         return self._local_node_gids
@@ -112,6 +163,11 @@ class BioNetwork(object):
     def biopyhys_gids(self):
         return self._local_biophys_gids
 
+    @property
+    def piece_gids(self):
+        """gids of the pieces of split cells on this rank whose soma, and gid, are on another rank"""
+        return self._piece_gids
+
     @property
     def saved_gids(self):
         return self._saved_gids
@@ -123,12 +179,16 @@ class BioNetwork(object):
     def build_cells(self):
         """Instantiate cells based on parameters provided in the InternalCell table and Internal CellModel table"""
         self._select_local_nodes()
+        morphology_cache.set_reduction(morphology_reduction.reduce_morphology
+                                       if self.morphology_reduction is not None else None)
         for node in self._local_nodes:
             gid = node.node_id
 
             if node.cell_type == CellTypes.Biophysical:
-                self._cells[gid] = BioCell(node, self.spike_threshold, self.dL, self.calc_ecp)
-                self._local_biophys_gids.append(gid)
+                self._cells[gid] = BioCell(node, self.spike_threshold, self.dL, self.calc_ecp, self.nseg_rule,
+                                           self._splits.get(gid))
+                if self._cells[gid].owns_soma:
+                    self._local_biophys_gids.append(gid)
 
             elif node.cell_type == CellTypes.Point:
                 self._cells[gid] = LIFCell(node)
@@ -147,8 +207,21 @@ class BioNetwork(object):
 
         self.make_morphologies()
         self.set_seg_props()  # set segment properties by creating Morphologies
+        self.scale_membranes()  # scale the membrane of the reduced cells to the area of the full cells
+        self.set_distance_densities()  # densities of the cell models that depend on the distance from the soma
         # self.set_tar_segs()  # set target segments needed for computing the synaptic innervations
         self.calc_seg_coords()  # use for computing the ECP
+        if self.morphology_reduction is not None:
+            self.report_reduction_errors()
+            self.release_full_morphologies()
+        if self.nthreads > 1:
+            pc.nthread(self.nthreads, 1)  # set before the cells are split
+        if self.multisplit is not None:
+            self.split_cells()
+        if self.nthreads > 1:
+            self.partition_threads()
+        if self.multisplit is not None:
+            pc.multisplit()  # after the thread partition
         self._cells_built = True
 
     def save_gids(self, gid_list):
@@ -163,11 +236,28 @@ class BioNetwork(object):
 
     def _select_local_nodes(self):
         """Divide all possible nodes among the various ranks (machines) for MPI usage. For single-processor simulation
-        all nodes will be local."""
+        all nodes will be local.
+
+        With the "cost" load balance the nodes are assigned by their estimated costs (see load_balance), otherwise
+        round-robin.
+        """
         all_nodes = self._graph.get_internal_nodes()
-        for node in all_nodes[rank::nhost]:
+        if self.multisplit is not None:
+            local_nodes = self._split_nodes(all_nodes)
+        elif self.load_balance.get('method', 'cost') == 'cost' and nhost > 1:
+            node_ranks = load_balance.assign_ranks(self.node_costs(), nhost)
+            local_nodes = [node for node in all_nodes if node_ranks[node.node_id] == rank]
+            loads = load_balance.rank_loads(self.node_costs(), node_ranks, nhost)
+            io.print2log0('    Estimated load balance is %g' % (np.mean(loads)/np.max(loads)))
+        else:
             # Simple round-robin spliting of nodes. i.e. Machine i of N will have nodes i, i+N, i+2N, etc.
+            local_nodes = all_nodes[rank::nhost]
+
+        for node in local_nodes:
             self._local_nodes.append(node)
+            if node.node_id in self._splits and self._splits[node.node_id].owner != rank:
+                self._piece_gids.append(node.node_id)
+                continue
             self._local_node_gids.append(node.node_id)
 
             # saves node by node_type_id. Is this used anymore?
@@ -176,30 +266,95 @@ class BioNetwork(object):
             else:
                 self._local_node_types[node.node_type_id] = [node]
 
+    def _split_nodes(self, all_nodes):
+        """Split the biophysical cells into pieces and distribute the pieces and the other cells among the ranks with
+        the cost load balance, see multisplit. By default each cell is split in as many pieces as needed to give a
+        piece to every thread of every rank, the "pieces" option sets the number of pieces of each cell.
+
+        :return: nodes with a piece on this rank
+        """
+        costs = self.node_costs()
+        nbiophys = len([node for node in all_nodes if node.cell_type == CellTypes.Biophysical])
+        npieces = self.multisplit.get('pieces') or -(-nhost*self.nthreads//max(nbiophys, 1))
+        splits = multisplit.plan_splits(all_nodes, costs, npieces, self.dL, self.nseg_rule,
+                                        self.morphology_reduction is not None)
+        node_ranks, loads = multisplit.assign_pieces(costs, splits, nhost, self.nthreads)
+        self._splits = dict((gid, split) for gid, split in splits.items() if split.is_split and split.has_piece(rank))
+
+        io.print2log0('    Split %d cells in pieces, estimated load balance is %g'
+                      % (len([split for split in splits.values() if split.is_split]), np.mean(loads)/np.max(loads)))
+        return [node for node in all_nodes if node_ranks[node.node_id] == rank or node.node_id in self._splits]
+
+    def split_cells(self):
+        """Delete the sections of the split cells on other ranks and cut the pieces of each cell with pc.multisplit,
+        the pieces are joined by the pc.multisplit() call of build_cells"""
+        for gid in self._splits:
+            self._cells[gid].split()
+
+    def partition_threads(self):
+        """Distribute the cells, and the pieces of the split cells, of this rank among the threads by their costs, see
+        load_balance.partition_threads"""
+        cells = dict((gid, self._cells[gid]) for gid in self._local_biophys_gids + self._piece_gids)
+        loads = load_balance.partition_threads(cells, self.node_costs(), self.nthreads)
+        io.print2log0('    Integrating with %d threads, estimated thread balance is %g'
+                      % (self.nthreads, np.mean(loads)/max(np.max(loads), 1e-12)))
+
+    def node_costs(self):
+        """Cost of every internal node by gid, estimated from the cell models and the edges or read from the file of
+        measured costs of the "cost_file" load balance option"""
+        if self._node_costs is None:
+            self._node_costs = load_balance.estimate_costs(self._graph, self._graph.get_internal_nodes(), self.dL,
+                                                           self.nseg_rule, self.morphology_reduction is not None)
+            if self.load_balance.get('cost_file') is not None:
+                measured = load_balance.load_costs(self.load_balance['cost_file'])
+                self._node_costs = load_balance.calibrate_costs(self._node_costs, measured)
+
+        return self._node_costs
+
+    def save_costs(self, file_name, step_time):
+        """Save the costs of the cells measured from the computation time of each rank, see load_balance.measured_costs,
+        to be used as the "cost_file" of the load balance of the next runs. A split cell is weighted on each rank by the
+        estimated cost of its pieces on the rank"""
+        costs = self.node_costs()
+        local_costs = {}
+        for gid in self._local_node_gids + self._piece_gids:
+            split = self._splits.get(gid)
+            local_costs[gid] = costs[gid] if split is None else float(np.sum(split.piece_costs[split.ranks == rank]))
+        measured = load_balance.measured_costs(local_costs, step_time)
+        load_balance.save_costs(file_name, measured)
+
     def make_morphologies(self):
-        """Creating a Morphology object for each biophysical model"""
+        """Creating a Morphology object for each distinct morphology
+
+        Cells share a Morphology object when they have the same morphology file and segmentation and are built by the
+        same cell model function, which decides how the axon is replaced, so node types with the same geometry are
+        processed once. With the d_lambda rule the segmentation also depends on the passive parameters of the cell.
+        With a morphology reduction the full cell is also built, once for each Morphology, to place the synapses.
+        """
         for node in self._local_nodes:
             if node.cell_type == CellTypes.Biophysical:
-                node_type_id = node.node_type_id
+                cell = self._cells[node.node_id]
                 morphology_file = node.morphology_file
-                if node_type_id in self.__morphologies_cache:
-                    # create a single morphology object for each model_group which share that morphology
-                    morph = self.__morphologies_cache[node_type_id]
-
-                    # associate morphology with a cell
-                    self._cells[node.node_id].set_morphology(morph)
+                morph_key = (morphology_file, self.dL, self._graph.property_schema.model_type(node), cell.sec_nsegs)
+                if morph_key in self.__morphologies_cache:
+                    # use the morphology object of the first cell with the same geometry
+                    morph = self.__morphologies_cache[morph_key]
 
                 else:
-                    hobj = self._cells[node.node_id].hobj  # get hoc object (hobj) from the first cell with a new morphologys
-                    morph = Morphology(hobj)
-
-                    # associate morphology with a cell
-                    self._cells[node.node_id].set_morphology(morph)
-
-                    # create a single morphology object for each model_group which share that morphology
-                    self.__morphologies_cache[node_type_id] = morph
-
-        io.print2log0("    Created morphologies")
+                    hobj = cell.hobj  # get hoc object (hobj) from the first cell with a new morphologys
+                    if self.morphology_reduction is not None:
+                        full_hobj = morphology_reduction.load_full_hobj(node, self.dL, self.nseg_rule)
+                        morph = morphology_reduction.ReducedMorphology(hobj, morphology_file, full_hobj)
+                    else:
+                        morph = Morphology(hobj, morphology_file)
+                    self.__morphologies_cache[morph_key] = morph
+                    self.__morphology_gids[morph_key] = []
+
+                # associate morphology with a cell
+                cell.set_morphology(morph)
+                self.__morphology_gids[morph_key].append(node.node_id)
+
+        io.print2log0("    Created %d morphologies" % len(self.__morphologies_cache))
         self._morphologies_built = True
 
     def set_seg_props(self):
@@ -209,16 +364,87 @@ class BioNetwork(object):
 
         io.print2log0("    Set segment properties")
 
+    def scale_membranes(self):
+        """Scale the capacitance and conductances of the reduced cells, see ReducedMorphology.scale_membrane"""
+        for morph_key, morphology in self.__morphologies_cache.items():
+            if isinstance(morphology, morphology_reduction.ReducedMorphology):
+                for gid in self.__morphology_gids[morph_key]:
+                    morphology.scale_membrane(self._cells[gid].hobj)
+
+    def set_distance_densities(self):
+        """Set the "distance_densities" of the cell model parameters using the segment distances of the morphologies
+
+        The densities of reduced cells are evaluated on the full morphology and moved to the reduced segments, they
+        are also set on the full cell of the morphology to compare the two.
+        """
+        ncells = 0
+        full_cells = set()
+        for node in self._local_nodes:
+            model_params = getattr(node, 'model_params', None)
+            if node.cell_type == CellTypes.Biophysical and isinstance(model_params, dict) and \
+                    'distance_densities' in model_params:
+                cell = self._cells[node.node_id]
+                morph = cell.morphology
+                densities = model_params['distance_densities']
+                if isinstance(morph, morphology_reduction.ReducedMorphology):
+                    cell_models.set_distance_densities(cell.hobj, morph.full.seg_prop, densities, morph.map_seg_values)
+                    if id(morph) not in full_cells:
+                        cell_models.set_distance_densities(morph.full.hobj, morph.full.seg_prop, densities)
+                        full_cells.add(id(morph))
+                else:
+                    cell_models.set_distance_densities(cell.hobj, morph.seg_prop, densities)
+                ncells += 1
+
+        if ncells > 0:
+            io.print2log0("    Set distance dependent densities of %d cells" % ncells)
+
+    def report_reduction_errors(self):
+        """Log the errors of the impedances of the reduced cells against the full cells at the frequencies of the
+        "error_freqs" option (Hz) of the morphology reduction, see ReducedMorphology.impedance_errors"""
+        freqs = self.morphology_reduction.get('error_freqs', [0.0, 5.0])
+        if len(freqs) == 0:
+            return
+
+        h.celsius = self.morphology_reduction.get('celsius', h.celsius)
+        h.finitialize(self.morphology_reduction.get('v_init', h.v_init))
+        for morph_key, morphology in self.__morphologies_cache.items():
+            for freq, zin_error, transfer_error in morphology.impedance_errors(freqs):
+                io.print2log0('    Reduced %s: input impedance error %.2f%%, transfer impedance error %.2f%% at %g Hz'
+                              % (morph_key[0], 100*zin_error, 100*transfer_error, freq))
+
+    def release_full_morphologies(self):
+        for _, morphology in self.__morphologies_cache.items():
+            morphology.release_full()
+
     def calc_seg_coords(self):
         """Needed for the ECP calculations"""
-        for node_type_id, morphology in self.__morphologies_cache.items():
+        for morph_key, morphology in self.__morphologies_cache.items():
             morph_seg_coords = morphology.calc_seg_coords()   # needed for ECP calculations
 
-            for node in self._local_node_types[node_type_id]:
-                self._cells[node.node_id].calc_seg_coords(morph_seg_coords)
+            for gid in self.__morphology_gids[morph_key]:
+                self._cells[gid].calc_seg_coords(morph_seg_coords)  # rotate and shift to the position of each cell
 
         io.print2log0("    Set segment coordinates")
 
+    def impedance_profiles(self, freqs, gids=None, v_hold=None, file_name=None, active=True):
+        """Input and transfer impedances of every segment of the local biophysical cells, see
+        impedance.impedance_profiles. Initializing at v_hold changes the state of the whole network, so call before the
+        simulation is initialized.
+
+        :param freqs: frequencies (Hz)
+        :param gids: gids of the cells, all the local biophysical cells by default
+        :param v_hold: holding potentials (mV), None to use the current state of the cells
+        :param file_name: HDF5 file where the profiles of the cells of all ranks are saved, see
+            impedance.save_impedance_profiles
+        :param active: include the linearized active channels
+        :return: dictionary of the impedance profiles of the local cells by gid
+        """
+        gids = self._local_biophys_gids if gids is None else [gid for gid in gids if gid in self._local_biophys_gids]
+        profiles = impedance.impedance_profiles(dict((gid, self._cells[gid]) for gid in gids), freqs, v_hold, active)
+        if file_name is not None:
+            impedance.save_impedance_profiles(file_name, profiles)
+        return profiles
+
     def add_spikes_nwb(self, ext_net, nwb_file, trial):
         h5_file = h5py.File(nwb_file, 'r')
         self._spike_trains_ds[ext_net] = h5_file['processing'][trial]['spike_train']
@@ -245,15 +471,9 @@ class BioNetwork(object):
                 continue
 
             self._stims[network] = {}
-            # Get a list of the external gid's that connect to cells on this node.
-            src_gids_set = set()
-            for trg_gid, trg_cell in self._cells.items():
-                # TODO: Create a function that can return a list of all src_gids
-                for trg_prop, src_prop, edge_prop in self._graph.edges_iterator(trg_gid, network):
-                    src_gids_set.add(src_prop.node_id)  # TODO: just store the src_prop
-
-            # Get the spike trains of each external node and create a Stim object
-            for src_gid in src_gids_set:
+            # Get the spike trains of each external gid that connects to cells on this node and create a Stim object
+            for src_gid in self._graph.source_gids(self._cells.keys(), network):
+                src_gid = int(src_gid)
                 src_prop = self._graph.get_node(src_gid, network)
                 spike_train = self._get_spike_trains(src_gid, network)
                 self._stims[network][src_gid] = Stim(src_prop, spike_train)
@@ -263,9 +483,8 @@ class BioNetwork(object):
         syn_counter = 0
         for src_network in self._graph.internal_networks():
             io.print2log0('    Setting connections from {}'.format(src_network))
-            for trg_gid, trg_cell in self._cells.items():
-                for trg_prop, src_prop, edge_prop in self._graph.edges_iterator(trg_gid, src_network):
-                    syn_counter += trg_cell.set_syn_connection(edge_prop, src_prop)
+            for trg_prop, edge_groups in self._graph.target_edges(self._cells.keys(), src_network):
+                syn_counter += self._cells[trg_prop.node_id].set_syn_connections_batch(edge_groups)
 
 
 
@@ -275,11 +494,9 @@ class BioNetwork(object):
         io.print2log0('    Setting connections from {}'.format(source_network))
         source_stims = self._stims[source_network]
         syn_counter = 0
-        for trg_gid, trg_cell in self._cells.items():
-            for trg_prop, src_prop, edge_prop in self._graph.edges_iterator(trg_gid, source_network):
-                # TODO: reimplement weight function if needed
-                stim = source_stims[src_prop.node_id]
-                syn_counter += trg_cell.set_syn_connection(edge_prop, src_prop, stim)
+        for trg_prop, edge_groups in self._graph.target_edges(self._cells.keys(), source_network):
+            # TODO: reimplement weight function if needed
+            syn_counter += self._cells[trg_prop.node_id].set_syn_connections_batch(edge_groups, source_stims)
 
         for gid in self._local_biophys_gids:
             print gid
@@ -329,8 +546,25 @@ class BioNetwork(object):
             network.spike_threshold = run_dict['spike_threshold']
         if 'dL' in run_dict:
             network.dL = run_dict['dL']
+        network.nseg_rule = dict((key, run_dict[key]) for key in ['nseg_rule', 'd_lambda', 'd_lambda_freq', 'max_nseg']
+                                 if key in run_dict)
         if 'calc_ecp' in run_dict:
             network.calc_ecp = run_dict['calc_ecp']
+        if run_dict.get('morphology_reduction', False):
+            # the impedances of the reduced cells are compared at the initial conditions of the simulation
+            reduction = dict(run_dict['morphology_reduction']) if isinstance(run_dict['morphology_reduction'], dict) \
+                else {}
+            for key in ['v_init', 'celsius']:
+                if key in config.get('conditions', {}):
+                    reduction.setdefault(key, config['conditions'][key])
+            network.morphology_reduction = reduction
+        if run_dict.get('multisplit', False):
+            network.multisplit = dict(run_dict['multisplit']) if isinstance(run_dict['multisplit'], dict) else {}
+        if 'nthreads' in run_dict:
+            network.nthreads = int(run_dict['nthreads'])
+        if 'load_balance' in run_dict:
+            lb = run_dict['load_balance']
+            network.load_balance = dict(lb) if isinstance(lb, dict) else {'method': lb}
 
         # build the cells
         io.print2log('Building cells...')
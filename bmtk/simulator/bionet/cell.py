@@ -40,7 +40,11 @@ class Cell(object):
     a Cell object directly. Cell classes act as wrapper around HOC cell object with extra functionality for setting
     positions, synapses, and other parameters depending on the desired cell class.
     """
-    def __init__(self, node):
+    def __init__(self, node, register=True):
+        """
+        :param node: node of the cell
+        :param register: associate the gid with this rank, False for the pieces of a split cell without the soma
+        """
         self._node = node
         self._gid = node.node_id
         self._props = node
@@ -50,7 +54,8 @@ class Cell(object):
         self.set_soma_position()
 
         # register the cell
-        pc.set_gid2node(self.gid, MPI_RANK)
+        if register:
+            pc.set_gid2node(self.gid, MPI_RANK)
 
         # Load the NEURON HOC object
         self._hobj = node.load_hobj()
@@ -92,3 +97,8 @@ class Cell(object):
 
     def set_syn_connections(self, edge_prop, src_node, stim=None):
         raise NotImplementedError
+
+    def set_syn_connections_batch(self, edge_groups, stims=None):
+        """Sets the incoming connections of a list of edge groups (see SimEdgeGroup), stims has the Stim of each
+        source gid of an external network. Returns the number of synapses"""
+        raise NotImplementedError
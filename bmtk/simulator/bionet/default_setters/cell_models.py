@@ -26,9 +26,11 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 import json
+import numpy as np
 from neuron import h
 
 from bmtk.simulator.bionet.pyfunction_cache import add_cell_model
+from bmtk.simulator.bionet.morphology_cache import load_morphology
 
 """
 Functions for loading NEURON cell objects.
@@ -73,7 +75,7 @@ def Biophys1_dict(cell):
     axon with the stub
     """
     morphology_file = cell['morphology_file']
-    hobj = h.Biophys1(str(morphology_file))
+    hobj = load_morphology(morphology_file)
     fix_axon(hobj)
     set_params_peri(hobj, cell.model_params)
     return hobj
@@ -81,7 +83,7 @@ def Biophys1_dict(cell):
 
 def Biophys1_adjusted(cell_prop):
     morphology_file_name = str(cell_prop['morphology_file'])
-    hobj = h.Biophys1(morphology_file_name)
+    hobj = load_morphology(morphology_file_name)
     fix_axon_allactive(hobj)
     #fix_axon(hobj)
     #set_params_peri(hobj, cell_prop.model_params)
@@ -253,6 +255,74 @@ def fix_axon_allactive(hobj):
     h.define_shape()
 
 
+def distance_density(dist, density):
+    """Values of a distance dependent density at the given path distances from the soma
+
+    :param dist: array of distances (um)
+    :param density: dictionary with the "function" and its parameters
+        linear:      g0*(a + b*dist)
+        exponential: g0*(a + b*exp(k*dist))
+        sigmoid:     g0*(a + b/(1 + exp((dist_half - dist)/slope)))
+        table:       linear interpolation of "values" at "distances", constant beyond the first and last distance
+        g0, a and b default to 1, 0 and 1.
+    :return: array of values
+    """
+    func = density['function']
+    if func == 'table':
+        return np.interp(dist, density['distances'], density['values'])
+
+    g0 = density.get('g0', 1.0)
+    a = density.get('a', 0.0)
+    b = density.get('b', 1.0)
+    if func == 'linear':
+        return g0*(a + b*dist)
+    elif func == 'exponential':
+        return g0*(a + b*np.exp(density['k']*dist))
+    elif func == 'sigmoid':
+        return g0*(a + b/(1.0 + np.exp((density['dist_half'] - dist)/density['slope'])))
+    else:
+        raise Exception('Unknown distance density function {}'.format(func))
+
+
+def set_distance_densities(hobj, seg_prop, densities, seg_map=None):
+    """Set the range variables that depend on the distance from the soma, as given in the "distance_densities" of the
+    cell model json, e.g.
+
+        {"name": "gbar_Ih_mod", "mechanism": "Ih_mod", "sections": ["apic"],
+         "function": "exponential", "g0": 2.849e-07, "a": -0.8696, "b": 2.087, "k": 0.0031}
+
+    :param hobj: NEURON's cell object
+    :param seg_prop: segment properties of the cell morphology (see Morphology.set_seg_props), the distance of the
+        center of each segment from the soma and the type of its section
+    :param densities: list of densities, see distance_density for the functions and their parameters
+    :param seg_map: function mapping the values at the segments of seg_prop to the segments of hobj, when seg_prop is
+        not of the morphology of hobj (see ReducedMorphology.map_seg_values)
+    """
+    secs = list(hobj.all)
+    nsegs = np.array([sec.nseg for sec in secs])
+    seg_ptr = np.concatenate(([0], np.cumsum(nsegs)))
+    sec_type_swc = {'soma': 1, 'axon': 2, 'dend': 3, 'apic': 4}
+    sec_types = np.array([sec_type_swc[sec.name().split('.')[-1][:4]] for sec in secs])
+
+    for density in densities:
+        swc_types = [sec_type_swc[sec_name] for sec_name in density['sections']]
+        seg_mask = np.in1d(seg_prop['type'], swc_types)
+        values = np.zeros(len(seg_mask))
+        values[seg_mask] = distance_density(seg_prop['dist'][seg_mask], density)
+        if seg_map is not None:
+            values = seg_map(values)
+
+        name = density['name']
+        mechanism = density.get('mechanism', '')
+        for sec_ix in np.flatnonzero(np.in1d(sec_types, swc_types)):
+            sec = secs[sec_ix]
+            if mechanism != '' and not h.ismembrane(mechanism, sec=sec):
+                sec.insert(mechanism)
+
+            for seg, value in zip(sec, values[seg_ptr[sec_ix]:seg_ptr[sec_ix+1]]):
+                setattr(seg, name, value)
+
+
 add_cell_model(Biophys1, 'biophysical', overwrite=False)
 add_cell_model(Biophys1, overwrite=False)
 add_cell_model(Biophys1_adjusted, 'biophysical_adjusted', overwrite=False)
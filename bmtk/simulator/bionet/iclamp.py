@@ -29,16 +29,32 @@ from neuron import h
 
 
 class IClamp(object):
-    def __init__(self, conf):
+    """Current clamp at the soma of a cell
+
+    The protocol is either a step, with the "amp" (nA), "del" and "dur" (ms), or a "waveform" of amplitudes (nA)
+    played into the clamp every "waveform_dt" (ms) starting at t = 0, by default the "iclamp" of the config.
+    """
+    def __init__(self, conf, protocol=None):
         self._conf = conf
-        self._iclamp_amp = self._conf['iclamp']['amp']
-        self._iclamp_del = self._conf['iclamp']['del']
-        self._iclamp_dur = self._conf['iclamp']['dur']
+        protocol = protocol if protocol is not None else self._conf['iclamp']
+        self._waveform = protocol.get('waveform', None)
+        if self._waveform is None:
+            self._iclamp_amp = protocol['amp']
+            self._iclamp_del = protocol['del']
+            self._iclamp_dur = protocol['dur']
+        else:
+            self._waveform_dt = protocol['waveform_dt']
 
     def attach_current(self, cell):
         self.cell = cell
         self.stim = h.IClamp(self.cell.hobj.soma[0](0.5))
-        self.stim.delay = self._iclamp_del
-        self.stim.dur = self._iclamp_dur
-        self.stim.amp = self._iclamp_amp
-        return self.stim
\ No newline at end of file
+        if self._waveform is None:
+            self.stim.delay = self._iclamp_del
+            self.stim.dur = self._iclamp_dur
+            self.stim.amp = self._iclamp_amp
+        else:
+            self.stim.delay = 0.0
+            self.stim.dur = 1e9
+            self._waveform_vec = h.Vector(self._waveform)
+            self._waveform_vec.play(self.stim._ref_amp, self._waveform_dt)
+        return self.stim
@@ -0,0 +1,110 @@
+# Allen Institute Software License - This software license is the 2-clause BSD license plus clause a third
+# clause that prohibits redistribution for commercial purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the Allen Institute's written permission. For
+# purposes of this license, commercial purposes is the incorporation of the Allen Institute's software into anything for
+# which you will charge fees or other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Impedance of the cells in the frequency domain.
+
+The small signal impedance of a cell is computed with h.Impedance from the membrane linearized at its current state,
+including the active channels, so the resonance due to Ih is measured at many frequencies and locations with one
+h.Impedance computation per frequency instead of simulating the response to chirp (ZAP) currents. The locations are
+the soma followed by every segment of the cell, in the same order as the variables saved from all the segments.
+"""
+import numpy as np
+import h5py
+from neuron import h
+
+
+pc = h.ParallelContext()  # object to access MPI methods
+MPI_Rank = int(pc.id())
+
+
+def impedance_profiles(cells, freqs, v_hold=None, active=True):
+    """Input impedance of every segment of the cells and transfer impedance between the soma and every segment
+
+    :param cells: dictionary of BioCells, or any objects with the hoc object of the cell as hobj, by gid
+    :param freqs: frequencies (Hz)
+    :param v_hold: holding potentials (mV), the network is initialized at each potential with h.finitialize, as if the
+        cells were voltage clamped at v_hold. None to use the current state of the cells
+    :param active: include the linearized active channels, otherwise only the passive membrane
+    :return: dictionary of the profile of each cell by gid, with the "freqs", the "v_hold" (nan for the current state),
+        the amplitudes (MOhm) of the "input" and "transfer" impedances and their "input_phase" and "transfer_phase"
+        (rad), arrays of shape (number of holding potentials, number of frequencies, nseg + 1) with the soma in column 0
+    """
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+    v_holds = [None] if v_hold is None else list(np.atleast_1d(v_hold))
+
+    profiles = {}
+    locs = {}
+    for gid, cell in cells.items():
+        soma = cell.hobj.soma[0]
+        locs[gid] = [(soma, 0.5)] + [(sec, seg.x) for sec in cell.hobj.all for seg in sec]
+        profiles[gid] = {'freqs': freqs, 'v_hold': np.array([np.nan if v is None else v for v in v_holds])}
+        for name in ['input', 'input_phase', 'transfer', 'transfer_phase']:
+            profiles[gid][name] = np.zeros((len(v_holds), len(freqs), len(locs[gid])))
+
+    for i, v in enumerate(v_holds):
+        if v is not None:
+            h.finitialize(v)
+
+        for gid, cell in cells.items():
+            profile = profiles[gid]
+            imp = h.Impedance()
+            imp.loc(0.5, sec=cell.hobj.soma[0])
+            for j, freq in enumerate(freqs):
+                imp.compute(freq, 1 if active else 0)
+                for k, (sec, x) in enumerate(locs[gid]):
+                    profile['input'][i, j, k] = imp.input(x, sec=sec)
+                    profile['input_phase'][i, j, k] = imp.input_phase(x, sec=sec)
+                    profile['transfer'][i, j, k] = imp.transfer(x, sec=sec)
+                    profile['transfer_phase'][i, j, k] = imp.transfer_phase(x, sec=sec)
+
+    return profiles
+
+
+def save_impedance_profiles(file_name, profiles):
+    """Saves the impedance profiles of the cells of all ranks in an HDF5 file
+
+    The profiles are gathered on rank 0, which writes the "freqs" and "v_hold" of the first profile and a group for each
+    gid with the arrays of its profile.
+
+    :param file_name: name of the HDF5 file
+    :param profiles: dictionary of the impedance profiles of the cells of this rank by gid
+    """
+    ranks_profiles = pc.py_gather(profiles, 0) if int(pc.nhost()) > 1 else [profiles]
+    if MPI_Rank != 0:
+        return
+
+    with h5py.File(file_name, 'w') as h5:
+        for rank_profiles in ranks_profiles:
+            for gid, profile in rank_profiles.items():
+                if 'freqs' not in h5:
+                    h5.create_dataset('freqs', data=profile['freqs'])
+                    h5.create_dataset('v_hold', data=profile['v_hold'])
+
+                grp = h5.create_group(str(gid))
+                for name in ['input', 'input_phase', 'transfer', 'transfer_phase']:
+                    grp.create_dataset(name, data=profile[name])
@@ -33,7 +33,10 @@ import shutil
 import json
 import numpy as np
 import logging
+import threading
+import multiprocessing
 import h5py
+from six.moves import queue
 
 from neuron import h
 
@@ -123,19 +126,105 @@ def print2log0now(string):
         logging.info(full_string) 
 
 
-def extend_output_files(gids):
-    # TODO: resize the files when running from an existing state
-    pass
+def extend_output_files(conf, gids):
+    """Prepare the output files of a previous run to be continued from the last saved state
 
+    Spikes saved after the time of the state are removed and the time series are resized when tstop was extended.
 
-def create_output_files(conf, gids):
+    :param conf: configuration dictionary
+    :param gids: dictionary of gid groups on this rank
+    """
+    t_state = read_checkpoint(conf)["t"]
+    dt = conf["run"]["dt"]
+    tstop = conf["run"]["tstop"]
+    nsteps = int(round(tstop/dt))
+    print2log0('    Extending the output files saved until t_sim: %.3f ms' % t_state)
+
+    if MPI_Rank == 0:
+        with h5py.File(conf["output"]["spikes_hdf5_file"], 'a') as h5:
+            keep = h5["time"][()] <= t_state
+            _truncate_spikes(h5, {"time": keep, "gid": keep})
+            h5.attrs['tstop'] = tstop
+
+        with open(conf["output"]["spikes_ascii_file"], 'r') as f:
+            lines = [line for line in f if line.strip() and float(line.split()[0]) <= t_state]
+        with open(conf["output"]["spikes_ascii_file"], 'w') as f:
+            f.writelines(lines)
+
+        if conf["run"]["calc_ecp"]:
+            with h5py.File(conf["output"]["ecp_file"], 'a') as h5:
+                _resize_time(h5, ['ecp'], nsteps)
+                h5.attrs['tstop'] = tstop
+
+    if conf["run"]["save_cell_vars"]:
+        var_names = conf["run"]["save_cell_vars"]
+        time_series = var_names + [var+"_all_segs" for var in var_names] + ['ecp']
+        if "cell_vars_file" in conf["output"]:
+            if MPI_Rank == 0:
+                with h5py.File(conf["output"]["cell_vars_file"], 'a') as h5:
+                    keep = h5["spikes/timestamps"][()] <= t_state
+                    _truncate_spikes(h5, {"spikes/timestamps": keep, "spikes/gids": keep})
+                    _resize_time(h5, time_series, nsteps)
+                    h5.attrs['tstop'] = tstop
+        else:
+            for gid in gids["save_cell_vars"]:
+                with h5py.File(conf["output"]["cell_vars_dir"]+'/%d.h5' % (gid), 'a') as h5:
+                    _truncate_spikes(h5, {"spikes": h5["spikes"][()] <= t_state})
+                    _resize_time(h5, time_series, nsteps)
+                    h5.attrs['tstop'] = tstop
+
+    pc.barrier()
+
+
+def _truncate_spikes(h5, keep):
+    """Keep the entries of the spike datasets selected by the boolean masks in keep"""
+    for name, mask in keep.items():
+        data = h5[name][()][mask]
+        h5[name].resize((len(data),))
+        h5[name][:] = data
+
+
+def _resize_time(h5, names, nsteps):
+    """Extend the time axis of the datasets in names to nsteps
+
+    Empty datasets with a fixed size (the segments of cells without segments) are created again with nsteps, other
+    datasets must have been created resizable.
+    """
+    for name in names:
+        if name not in h5 or h5[name].shape[0] >= nsteps:
+            continue
+
+        ds = h5[name]
+        shape = (nsteps,) + ds.shape[1:]
+        if ds.maxshape[0] is None:
+            ds.resize(shape)
+        elif ds.size == 0:
+            dtype = ds.dtype
+            del h5[name]
+            h5.create_dataset(name, shape, dtype=dtype)
+        else:
+            raise Exception('Unable to extend {} in {} to {} time steps, the dataset has a fixed size {}'.format(
+                name, h5.filename, nsteps, ds.shape))
+
+
+def create_output_files(conf, gids, nsegs=None):
+    """Create the output files
+
+    :param conf: configuration dictionary
+    :param gids: dictionary of gid groups on this rank
+    :param nsegs: number of segments of each cell in gids['save_cell_vars'], by gid
+    """
+    nsegs = nsegs if nsegs is not None else {}
     if conf["run"]["calc_ecp"]:  # creat single file for ecp from all contributing cells
         print2log0('    Will save time series of the ECP!')
         create_ecp_file(conf)
 
     if conf["run"]["save_cell_vars"]:
         print2log0('    Will save time series of individual cells')
-        create_cell_vars_files(conf, gids)
+        if "cell_vars_file" in conf["output"]:
+            create_cell_vars_file(conf, gids, nsegs)
+        else:
+            create_cell_vars_files(conf, gids, nsegs)
                 
     create_spike_file(conf, gids)  # a single file including all gids
     
@@ -159,30 +248,137 @@ def create_ecp_file(conf):
     pc.barrier()
 
 
-def create_cell_vars_files(conf, gids):
-    """create 1 hfd5 files per gid"""
+def create_cell_vars_files(conf, gids, nsegs):
+    """create 1 hfd5 files per gid
+
+    The datasets are preallocated for the whole simulation with chunks covering a block of time steps, so saving a
+    block is a single write into each dataset.
+    """
 
     dt = conf["run"]["dt"]
     tstop = conf["run"]["tstop"]
+    nsteps_block = conf["run"]["nsteps_block"]
 
     nsteps = int(round(tstop/dt))
+    storage = _cell_vars_storage(conf)
 
     for gid in gids["save_cell_vars"]:
         ofname = conf["output"]["cell_vars_dir"]+'/%d.h5' % (gid)
+        nseg = nsegs.get(gid, 0)
         with h5py.File(ofname, 'w') as h5:
             h5.attrs['dt'] = dt
             h5.attrs['tstart'] = 0.0
             h5.attrs['tstop'] = tstop
 
             for var in conf["run"]["save_cell_vars"]:
-                h5.create_dataset(var, (nsteps,), maxshape=(None,), chunks=True)
-                h5.create_dataset(var+"_all_segs",(0,0),maxshape=(None,None),chunks=True)
+                h5.create_dataset(var, (nsteps,), maxshape=(None,), chunks=_chunk_shape(nsteps, nsteps_block, 1)[:1],
+                                  **storage)
+                if nseg > 0:
+                    h5.create_dataset(var+"_all_segs", (nsteps, nseg), maxshape=(None, nseg),
+                                      chunks=_chunk_shape(nsteps, nsteps_block, nseg), **storage)
+                else:
+                    h5.create_dataset(var+"_all_segs", (nsteps, 0), dtype=storage['dtype'])
 
             h5.create_dataset('spikes', (0,), maxshape=(None,), chunks=True)
 
             if conf["run"]["calc_ecp"]:  # then also create a dataset for the ecp
                 nsites = conf['run']['nsites']
-                h5.create_dataset('ecp', (nsteps, nsites), maxshape=(None, nsites), chunks=True)
+                h5.create_dataset('ecp', (nsteps, nsites), maxshape=(None, nsites),
+                                  chunks=_chunk_shape(nsteps, nsteps_block, nsites), **storage)
+
+
+def create_cell_vars_file(conf, gids, nsegs):
+    """create a single hdf5 file with the variables of all saved gids
+
+    Each variable is saved in a (time, gid_index) dataset and the segments of all cells are saved side by side in
+    (time, segment) datasets. The gids of each rank are given consecutive columns, /mapping/gids has the gid of each
+    column and /mapping/index_pointer the first and last+1 column of each gid in the <var>_all_segs datasets. The
+    spikes of the saved gids are in /spikes/timestamps and /spikes/gids, sorted by time within each block.
+    """
+    dt = conf["run"]["dt"]
+    tstop = conf["run"]["tstop"]
+    nsteps = int(round(tstop/dt))
+    nsteps_block = conf["run"]["nsteps_block"]
+    ofname = conf["output"]["cell_vars_file"]
+    storage = _cell_vars_storage(conf)
+
+    rank_cells = [(gid, nsegs.get(gid, 0)) for gid in sorted(gids["save_cell_vars"])]
+    all_cells = [cell for ranks_cells in pc.py_allgather(rank_cells) for cell in ranks_cells]
+    mapping_gids = np.array([gid for gid, _ in all_cells], dtype=np.uint64)
+    index_pointer = np.concatenate(([0], np.cumsum([nseg for _, nseg in all_cells]))).astype(np.uint64)
+    ngids = len(mapping_gids)
+    nsegs_total = int(index_pointer[-1])
+
+    if MPI_Rank == 0:
+        with h5py.File(ofname, 'w') as h5:
+            h5.attrs['dt'] = dt
+            h5.attrs['tstart'] = 0.0
+            h5.attrs['tstop'] = tstop
+            h5.create_dataset('mapping/gids', data=mapping_gids)
+            h5.create_dataset('mapping/index_pointer', data=index_pointer)
+
+            for var in conf["run"]["save_cell_vars"]:
+                h5.create_dataset(var, (nsteps, ngids), maxshape=(None, ngids),
+                                  chunks=_chunk_shape(nsteps, nsteps_block, ngids), **storage)
+                if nsegs_total > 0:
+                    h5.create_dataset(var+"_all_segs", (nsteps, nsegs_total), maxshape=(None, nsegs_total),
+                                      chunks=_chunk_shape(nsteps, nsteps_block, nsegs_total), **storage)
+
+            if conf["run"]["calc_ecp"]:
+                nsites = conf['run']['nsites']
+                h5.create_dataset('ecp', (nsteps, ngids, nsites), maxshape=(None, ngids, nsites),
+                                  chunks=_chunk_shape(nsteps, nsteps_block, ngids) + (nsites,), **storage)
+
+            h5.create_dataset('spikes/timestamps', (0,), maxshape=(None,), chunks=True, dtype=np.float64)
+            h5.create_dataset('spikes/gids', (0,), maxshape=(None,), chunks=True, dtype=np.uint64)
+
+    _cell_vars_layout[ofname] = _rank_cell_vars_layout(mapping_gids, index_pointer, gids["save_cell_vars"])
+    pc.barrier()
+
+
+def _chunk_shape(nsteps, nsteps_block, ncols, max_chunk_size=2**18):
+    """Chunks covering a whole block in time and as many columns as fit in max_chunk_size elements"""
+    nrows = max(1, min(nsteps, nsteps_block))
+    return nrows, max(1, min(ncols, max_chunk_size//nrows))
+
+
+def _cell_vars_storage(conf):
+    """dtype and compression of the cell variables datasets
+
+    Set with output/cell_vars_dtype (float32 by default) and output/cell_vars_compression ("lzf", "gzip" or None for
+    uncompressed data), output/cell_vars_compression_level sets the level of gzip compression.
+    """
+    storage = {'dtype': np.dtype(conf["output"].get("cell_vars_dtype", "float32"))}
+    compression = conf["output"].get("cell_vars_compression", None)
+    if compression:
+        storage['compression'] = compression
+        if compression == "gzip":
+            storage['compression_opts'] = conf["output"].get("cell_vars_compression_level", 4)
+    return storage
+
+
+def _rank_cell_vars_layout(mapping_gids, index_pointer, rank_gids):
+    """Columns of the consolidated cell variables file written by this rank"""
+    rank_gids = sorted(rank_gids)
+    if not rank_gids:
+        return {'gids': [], 'columns': (0, 0), 'segments': (0, 0)}
+
+    columns = dict((gid, indx) for indx, gid in enumerate(mapping_gids))
+    col0 = columns[rank_gids[0]]
+    col1 = col0 + len(rank_gids)
+    return {'gids': rank_gids, 'columns': (col0, col1),
+            'segments': (int(index_pointer[col0]), int(index_pointer[col1]))}
+
+_cell_vars_layout = {}  # columns written by this rank in each consolidated cell variables file
+
+
+def _get_cell_vars_layout(conf, gids):
+    ofname = conf["output"]["cell_vars_file"]
+    if ofname not in _cell_vars_layout:
+        with h5py.File(ofname, 'r') as h5:
+            _cell_vars_layout[ofname] = _rank_cell_vars_layout(h5['mapping/gids'][()], h5['mapping/index_pointer'][()],
+                                                               gids)
+    return _cell_vars_layout[ofname]
 
 
 def create_spike_file(conf, gids_on_rank):
@@ -217,15 +413,17 @@ def get_spike_trains_handle(file_name, trial_name):
 
 def setup_output_dir(conf):
 
-    start_from_state =False
+    start_from_state = conf["run"].get("start_from_state", False)
     if start_from_state:  # starting from a previously saved state
-        try:
-            assert os.path.exists(conf["output"]["output_dir"])
-            print2log0('Will run simulation from a previously saved state...')
-        except:
+        if not os.path.exists(_checkpoint_file(conf)):
             print('ERROR: directory with the initial state does not exist')
             nrn.quit_execution()
 
+        if int(pc.id()) == 0:
+            create_log(conf)  # appends to the log of the previous run
+        pc.barrier()
+        print2log0('Will run simulation from a previously saved state...')
+
     elif not start_from_state:  # starting from a new (init) state
         if int(pc.id()) == 0:
             if os.path.exists(conf["output"]["output_dir"]):
@@ -238,8 +436,10 @@ def setup_output_dir(conf):
                     nrn.quit_execution()
 
             os.makedirs(conf["output"]["output_dir"])
-            os.makedirs(conf["output"]["cell_vars_dir"])
-#            os.makedirs(conf["output"]["state_dir"])
+            if "cell_vars_dir" in conf["output"]:
+                os.makedirs(conf["output"]["cell_vars_dir"])
+            if conf["run"].get("save_state", False):
+                os.makedirs(conf["output"]["state_dir"])
 
             create_log(conf)
             config.copy(conf)
@@ -252,130 +452,493 @@ def setup_output_dir(conf):
 
 def save_block_to_disk(conf, data_block, time_step_interval):
     """save data in blocks to hdf5"""
-    save_ecp(conf, data_block, time_step_interval)
-    save_cell_vars(conf, data_block, time_step_interval)
-    save_spikes2h5(conf, data_block)
-    save_spikes2ascii(conf, data_block)
+    save_block(conf, collect_block(conf, data_block, time_step_interval, _get_mpi_comm()))
+
+
+def collect_block(conf, data_block, time_step_interval, comm=None):
+    """Collects the data of a block that this rank has to save and clears the block
+
+    All the calls between the ranks needed to save a block are made here, from the main thread at the block boundary:
+    the spikes are gathered on rank 0 and the ECP is summed over the ranks. With an MPI communicator each rank keeps
+    its own slice of the single files to write them collectively with parallel HDF5, otherwise rank 0 gathers them.
+    The values are copied out of data_block, which is zeroed and can be filled again, and the result only holds numpy
+    arrays so it can be written by save_block() without NEURON.
+    """
+    return {'interval': time_step_interval,
+            'tsave': data_block['tsave'],
+            'parallel': comm is not None,
+            'ecp': collect_ecp(conf, data_block, time_step_interval),
+            'cells': collect_cell_vars(conf, data_block, time_step_interval, comm),
+            'cell_spikes': collect_cell_spikes(conf, data_block, comm),
+            'spikes': collect_spikes(data_block, comm)}
+
+
+def save_block(conf, block):
+    """Writes a block returned by collect_block() to disk, only uses h5py and numpy"""
+    save_ecp(conf, block)
+    save_cell_vars(conf, block)
+    save_spikes2h5(conf, block)
+    save_spikes2ascii(conf, block)
+
+
+class BlockWriter(object):
+    """Saves the filled data blocks to disk.
+
+    save_block() makes the collective calls between the ranks from the main thread at the block boundary and copies
+    the data out of the block, which can be filled again right away. With background=True each rank then sends the
+    collected data to its own writer process that only uses h5py and numpy, and the simulation keeps integrating while
+    the files are written (a thread would hardly run since NEURON holds the interpreter lock while integrating). When
+    max_pending blocks are still waiting to be written save_block() waits for the writer, which bounds the memory used
+    when the disk falls behind. The background writer does not use parallel HDF5, rank 0 writes the single files.
+
+    The writer process is forked after MPI was initialized, which some MPI stacks do not support (e.g. OpenMPI over
+    InfiniBand, unless the fork support of the interconnect is enabled with RDMAV_FORK_SAFE=1). The writer is best
+    created before the output files are opened and the data blocks are allocated, and background=False should be used
+    when the MPI stack does not allow fork().
+    """
+    def __init__(self, conf, background=False, max_pending=1):
+        self._conf = conf
+        self._max_pending = max_pending
+        self._npending = 0
+        self._process = None
+        if background:
+            ctx = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+            blocks_in, self._blocks = ctx.Pipe(duplex=False)
+            self._written, written_out = ctx.Pipe(duplex=False)
+            self._process = ctx.Process(target=_write_blocks, args=(conf, blocks_in, written_out))
+            self._process.daemon = True
+            self._process.start()
+            blocks_in.close()
+            written_out.close()
+
+    def save_block(self, data_block, time_step_interval):
+        """Saves the block (in the background if possible), data_block is cleared and can be filled again"""
+        if self._process is None:
+            save_block_to_disk(self._conf, data_block, time_step_interval)
+            return
+
+        block = collect_block(self._conf, data_block, time_step_interval)
+        while self._npending >= self._max_pending:
+            self._wait_written()
+        self._blocks.send(block)
+        self._npending += 1
+
+    def wait(self):
+        """Waits until the blocks passed to save_block have been written"""
+        while self._npending > 0:
+            self._wait_written()
+
+    def close(self):
+        """Waits until all the blocks have been written and stops the writer process, even if a block failed"""
+        if self._process is not None:
+            try:
+                self.wait()
+            finally:
+                self._blocks.send(None)
+                self._process.join()
+                self._process = None
+
+    def _wait_written(self):
+        try:
+            error = self._written.recv()
+        except EOFError:
+            raise Exception('The writer process stopped with exit code {}'.format(self._process.exitcode))
+        self._npending -= 1
+        if error is not None:
+            raise Exception('Unable to save data block: {}'.format(error))
+
+
+def _write_blocks(conf, blocks_in, written_out):
+    """Writer process of a BlockWriter, saves the blocks received until None and must not call NEURON or MPI
+
+    conf is the configuration when the writer was created, the blocks carry everything else they need. The blocks are
+    received by a separate thread so the simulation can send the next block while one is written.
+    """
+    blocks = queue.Queue()
+
+    def receive_blocks():
+        while True:
+            block = blocks_in.recv()
+            blocks.put(block)
+            if block is None:
+                break
+
+    receiver = threading.Thread(target=receive_blocks)
+    receiver.daemon = True
+    receiver.start()
 
+    error = None
+    while True:
+        block = blocks.get()
+        if block is None:
+            break
 
-def save_spikes2h5(conf, data_block):
+        try:
+            if error is None:
+                save_block(conf, block)
+        except Exception as e:
+            error = str(e)
+        written_out.send(error)
+
+
+def _get_mpi_comm():
+    """MPI communicator used for collective HDF5 writes, None if h5py or mpi4py were not built with MPI support"""
+    global _mpi_comm
+    if _mpi_comm is None:
+        _mpi_comm = False
+        if int(pc.nhost()) > 1 and h5py.get_config().mpi:
+            try:
+                from mpi4py import MPI
+                _mpi_comm = MPI.COMM_WORLD
+            except ImportError:
+                pass
+
+    return _mpi_comm if _mpi_comm is not False else None
+
+_mpi_comm = None
+
+
+def _gather_spikes(data_block):
+    """Spikes of all the ranks on rank 0 as time-sorted (time, gid) arrays, None on the other ranks"""
+    ranks_spikes = pc.py_gather(data_block["spikes"], 0)
+    if MPI_Rank != 0:
+        return None
+
+    times = np.concatenate([rank_times for rank_times, _ in ranks_spikes])
+    gids = np.concatenate([rank_gids for _, rank_gids in ranks_spikes])
+    order = np.lexsort((gids, times))
+    return times[order], gids[order]
+
+
+def collect_spikes(data_block, comm=None):
+    """Spikes of the block to save
+
+    The spikes of all the ranks are gathered on rank 0 and sorted by time ('all', None on the other ranks). With an MPI
+    communicator the number of spikes on each rank is exchanged with one allgather, each rank then keeps its own
+    spikes ('local') with their offset among the spikes of all the ranks.
+    """
+    spikes = {'all': _gather_spikes(data_block)}
+    if comm is not None:
+        nspikes_ranks = pc.py_allgather(len(data_block["spikes"][0]))
+        spikes['local'] = data_block["spikes"]
+        spikes['offset'] = sum(nspikes_ranks[:MPI_Rank])
+        spikes['total'] = sum(nspikes_ranks)
+    return spikes
+
+
+def save_spikes2h5(conf, block):
     """Save spikes to h5 file: into time,gid datasets
 
-    Spike times are not necessarily in order. For comparison between runs, need to sort spikes
+    The spikes of a block are sorted by time on each rank. Either all ranks write their own slice using parallel HDF5
+    or rank 0 writes the spikes of all the ranks at once.
 
     :param conf:
-    :param data_block:
+    :param block: block returned by collect_block()
     """
-    spikes = data_block["spikes"]
     ofname = conf["output"]["spikes_hdf5_file"]
-    ranks = xrange(int(pc.nhost()))
-    for rank in ranks:  # iterate over the ranks
-        if rank == int(pc.id()):  # wait until finished with a particular rank
-            with h5py.File(ofname, 'a') as h5:
-                for gid in spikes:                          # save spikes of all gids on this rank
-                    nspikes_saved = h5["gid"].shape[0]      # find number of spikes already in the file
-                    nspikes_to_add = len(spikes[gid])          # find number of spikes to add
-                    nspikes = nspikes_saved+nspikes_to_add     # total number of spikes
-                    h5["time"].resize((nspikes,))         # resize the dataset
-                    h5["gid"].resize((nspikes,))         # resize the dataset
-                    h5["time"][nspikes_saved:nspikes] = np.array(spikes[gid])
-                    h5["gid"][nspikes_saved:nspikes] = np.array([gid]*nspikes_to_add)
-
-        pc.barrier()    # move on to next rank
-
-
-def save_ecp(conf, data_block, time_step_interval):
-    """Save ECP from each rank to disk into a single file"""
+    spikes = block['spikes']
+    if block['parallel']:
+        if spikes['total'] == 0:
+            return
+
+        with h5py.File(ofname, 'a', driver='mpio', comm=_get_mpi_comm()) as h5:
+            _append_spikes(h5, spikes, True)
+
+    elif spikes['all'] is not None and len(spikes['all'][0]) > 0:
+        with h5py.File(ofname, 'a') as h5:
+            _append_spikes(h5, spikes, False)
+
+
+def _append_spikes(h5, spikes, parallel, time_name="time", gid_name="gid"):
+    """Appends the spikes of a block (see collect_spikes) to the time and gid datasets of h5. With parallel=True the
+    file is open on all the ranks and each rank writes its own spikes, otherwise the spikes of all the ranks are
+    written."""
+    if parallel:
+        times, gids = spikes['local']
+        offset, nspikes = spikes['offset'], spikes['total']
+    else:
+        times, gids = spikes['all']
+        offset, nspikes = 0, len(times)
+    if nspikes == 0:
+        return
+
+    nspikes_saved = h5[gid_name].shape[0]      # find number of spikes already in the file
+    h5[time_name].resize((nspikes_saved+nspikes,))  # resize the dataset
+    h5[gid_name].resize((nspikes_saved+nspikes,))
+    h5[time_name][nspikes_saved+offset:nspikes_saved+offset+len(times)] = times
+    h5[gid_name][nspikes_saved+offset:nspikes_saved+offset+len(times)] = gids
+
+
+def collect_ecp(conf, data_block, time_step_interval):
+    """ECP of the block summed over the ranks, on rank 0 (None on the other ranks or when the ECP is not computed)"""
+    if not conf["run"]['calc_ecp']:
+        return None
+
     itstart, itend = time_step_interval
-    ofname = conf["output"]["ecp_file"]
-    if conf["run"]['calc_ecp']:
+    ecp_block = data_block['ecp'][0:itend-itstart, :]
+    if int(pc.nhost()) > 1:
+        ecp_vec = h.Vector(ecp_block.ravel())
+        pc.allreduce(ecp_vec, 1)  # sum over the ranks
+        ecp_block = np.array(ecp_vec).reshape(ecp_block.shape)
+    else:
+        ecp_block = ecp_block.copy()
 
-        ranks = xrange(int(pc.nhost()))
-        for rank in ranks:              # iterate over the ranks
-            if rank == int(pc.id()):      # wait until finished with a particular rank
-                with h5py.File(ofname, 'a') as f5:
-                    f5["ecp"][itstart:itend, :] += data_block['ecp'][0:itend-itstart, :]
-                    f5.attrs["tsave"] = data_block["tsave"]  # update tsave
-                    data_block['ecp'][:] = 0.0
+    data_block['ecp'][:] = 0.0
+    return ecp_block if MPI_Rank == 0 else None
 
-            pc.barrier()    # move on to next rank
 
+def save_ecp(conf, block):
+    """Save the ECP summed over the ranks to disk into a single file, written by rank 0"""
+    if block['ecp'] is not None:
+        itstart, itend = block['interval']
+        with h5py.File(conf["output"]["ecp_file"], 'a') as f5:
+            f5["ecp"][itstart:itend, :] = block['ecp']
+            f5.attrs["tsave"] = block["tsave"]  # update tsave
 
-def save_cell_vars(conf, data_block, time_step_interval):
-    """save to disk with one file per gid"""
+
+def collect_cell_vars(conf, data_block, time_step_interval, comm=None):
+    """Cell variables of the block to save and clears them in data_block
+
+    With one file per gid these are the values of each gid on this rank with its spikes. With the single cell
+    variables file these are the (dataset, column slice, values) written by this rank, which are gathered on rank 0
+    (None on the other ranks) unless the file is written collectively with the MPI communicator.
+    """
     itstart, itend = time_step_interval
-    for gid, cell_data_block in data_block['cells'].items():
+    nsteps = itend - itstart
+    cells_block = data_block['cells']
+
+    if "cell_vars_file" not in conf["output"]:
+        times, spike_gids = data_block["spikes"]
+        cells = {}
+        for gid, cell_data_block in cells_block.items():
+            cells[gid] = dict((name, values[0:nsteps].copy()) for name, values in cell_data_block.items())
+            cells[gid]['spikes'] = times[spike_gids == gid]
+
+    else:
+        layout = _get_cell_vars_layout(conf, cells_block.keys())
+        rank_gids = layout['gids']
+
+        cells = []  # (dataset, column slice, values) saved by this rank
+        if rank_gids:
+            for var in conf["run"]["save_cell_vars"]:
+                values = np.column_stack([cells_block[gid][var][0:nsteps] for gid in rank_gids])
+                cells.append((var, layout['columns'], values))
+
+                seg0, seg1 = layout['segments']
+                if seg1 > seg0:
+                    values = np.hstack([cells_block[gid][var+"_all_segs"][0:nsteps, :] for gid in rank_gids])
+                    cells.append((var+"_all_segs", layout['segments'], values))
+
+            if conf["run"]["calc_ecp"]:
+                nsites = conf['run']['nsites']
+                values = np.stack([cells_block[gid]['ecp'][0:nsteps, :] if 'ecp' in cells_block[gid]
+                                   else np.zeros((nsteps, nsites)) for gid in rank_gids], axis=1)
+                cells.append(('ecp', layout['columns'], values))
+
+        if comm is None and int(pc.nhost()) > 1:
+            ranks_slices = pc.py_gather(cells, 0)
+            cells = [rank_slice for rank_slices in ranks_slices for rank_slice in rank_slices] if MPI_Rank == 0 \
+                else None
+
+    for cell_data_block in cells_block.values():
+        for values in cell_data_block.values():
+            values[:] = 0.0
+
+    return cells
+
+
+def collect_cell_spikes(conf, data_block, comm=None):
+    """Spikes of the gids saved in the single cell variables file, collected like the spikes of all gids (see
+    collect_spikes). None when the cell variables are saved with one file per gid"""
+    if "cell_vars_file" not in conf["output"]:
+        return None
+
+    layout = _get_cell_vars_layout(conf, data_block['cells'].keys())
+    times, gids = data_block["spikes"]
+    saved = np.in1d(gids, layout['gids'])
+    return collect_spikes({"spikes": (times[saved], gids[saved])}, comm)
+
+
+def save_cell_vars(conf, block):
+    """save to disk with one file per gid"""
+    if "cell_vars_file" in conf["output"]:
+        save_cell_vars_consolidated(conf, block)
+        return
+
+    itstart, itend = block['interval']
+    for gid, cell_block in block['cells'].items():
         ofname = conf["output"]["cell_vars_dir"]+'/%d.h5' % (gid)
 
         with h5py.File(ofname, 'a') as h5:
 
-            h5.attrs["tsave"] = data_block["tsave"]  # update tsave
+            h5.attrs["tsave"] = block["tsave"]  # update tsave
             for var in conf["run"]["save_cell_vars"]:
                 # soma only
-                h5[var][itstart:itend] = cell_data_block[var][0:itend-itstart]
-                cell_data_block[var][:] = 0.0
+                h5[var][itstart:itend] = cell_block[var]
 
                 # all segs
-                var_block_arr = np.array(cell_data_block[var+"_all_segs"])
-                (ntime_block,nseg) = var_block_arr.shape
-                ntime_file = h5[var+"_all_segs"].shape[0]
-                h5[var+"_all_segs"].resize((ntime_file+ntime_block,nseg))
-                h5[var+"_all_segs"][itstart:itend,:] = var_block_arr; # addon
+                if cell_block[var+"_all_segs"].shape[1] > 0:
+                    h5[var+"_all_segs"][itstart:itend, :] = cell_block[var+"_all_segs"]
+
+            gid_times = cell_block['spikes']
+            if len(gid_times) > 0:
+                nspikes_saved = h5["spikes"].shape[0]   # find number of spikes
+                nspikes = nspikes_saved+len(gid_times)     # total number of spikes
+                h5["spikes"].resize((nspikes,))         # resize the dataset
+                h5["spikes"][nspikes_saved:nspikes] = gid_times
+
+            if "ecp" in cell_block.keys():
+                h5["ecp"][itstart:itend, :] = cell_block['ecp']
 
-                cell_data_block[var+"_all_segs"] = []
 
-            spikes = data_block["spikes"]
-            nspikes_saved = h5["spikes"].shape[0]   # find number of spikes
-            nspikes_add = len(spikes[gid])     # find number of spikes to add
-            nspikes = nspikes_saved+nspikes_add     # total number of spikes
-            h5["spikes"].resize((nspikes,))         # resize the dataset
-            h5["spikes"][nspikes_saved:nspikes] = np.array(spikes[gid])  # save hocVector as a numpy arrray
+def save_cell_vars_consolidated(conf, block):
+    """save to disk into the single cell variables file, the gids of each rank are written as one slice"""
+    itstart, itend = block['interval']
+    ofname = conf["output"]["cell_vars_file"]
+
+    if block['parallel']:
+        with h5py.File(ofname, 'a', driver='mpio', comm=_get_mpi_comm()) as h5:
+            h5.attrs["tsave"] = block["tsave"]
+            for ds_name, (col0, col1), values in block['cells']:
+                h5[ds_name][itstart:itend, col0:col1] = values
+            _append_spikes(h5, block['cell_spikes'], True, 'spikes/timestamps', 'spikes/gids')
+
+    elif block['cells'] is not None:
+        with h5py.File(ofname, 'a') as h5:
+            h5.attrs["tsave"] = block["tsave"]  # update tsave
+            for ds_name, (col0, col1), values in block['cells']:
+                h5[ds_name][itstart:itend, col0:col1] = values
+            _append_spikes(h5, block['cell_spikes'], False, 'spikes/timestamps', 'spikes/gids')
+
 
-            if "ecp" in cell_data_block.keys():
-                h5["ecp"][itstart:itend, :] = cell_data_block['ecp'][0:itend-itstart, :]
-                cell_data_block['ecp'][:] = 0.0
+def save_sweep(file_name, name, protocol, times, traces, spikes):
+    """Save the traces and spikes of a sweep of current clamp protocols into the group name of file_name
 
+    The traces and spikes of all the ranks are gathered and written by rank 0. The group has the numeric parameters of
+    the protocol as attributes (the "waveform" as a dataset), the "time" of the traces, a cells/<gid>/<var> dataset for
+    each recorded variable and the spikes/timestamps and spikes/gids of the sweep sorted by time.
 
-def save_spikes2ascii(conf, data_block):
-    """Save spikes to ascii file as tuples (t,gid)"""
-    spikes = data_block["spikes"]
+    :param times: times of the traces (ms)
+    :param traces: dictionary of the recorded traces by gid and variable, on this rank
+    :param spikes: (times, gids) arrays of the spikes on this rank
+    """
+    ranks_data = pc.py_gather((traces, spikes), 0) if int(pc.nhost()) > 1 else [(traces, spikes)]
+    if MPI_Rank != 0:
+        return
+
+    with h5py.File(file_name, 'a') as h5:
+        if name in h5:
+            del h5[name]
+        grp = h5.create_group(name)
+        for key, value in protocol.items():
+            if key == 'waveform':
+                grp.create_dataset('waveform', data=np.array(value, dtype=float))
+            elif isinstance(value, (int, float)):
+                grp.attrs[key] = value
+
+        grp.create_dataset('time', data=times)
+        for rank_traces, _ in ranks_data:
+            for gid, gid_traces in rank_traces.items():
+                for var, trace in gid_traces.items():
+                    grp.create_dataset('cells/{}/{}'.format(gid, var), data=trace)
+
+        spike_times = np.concatenate([rank_spikes[0] for _, rank_spikes in ranks_data])
+        spike_gids = np.concatenate([rank_spikes[1] for _, rank_spikes in ranks_data])
+        order = np.lexsort((spike_gids, spike_times))
+        grp.create_dataset('spikes/timestamps', data=spike_times[order])
+        grp.create_dataset('spikes/gids', data=spike_gids[order].astype(np.int32))
+
+
+def save_spikes2ascii(conf, block):
+    """Save spikes to ascii file as tuples (t,gid), the spikes of all ranks are written by rank 0"""
     ofname = conf["output"]["spikes_ascii_file"]
+    if block['spikes']['all'] is not None:
+        times, gids = block['spikes']['all']
+        if len(times) > 0:
+            with open(ofname, 'a') as f:
+                np.savetxt(f, np.column_stack((times, gids)), fmt=['%.3f', '%d'])
 
-    ranks = xrange(int(pc.nhost()))
-    for rank in ranks:
-        if rank == int(pc.id()):
-            f = open(ofname, 'a')
-            for gid in spikes:
-                tVec = spikes[gid]
-                for t in tVec:
-                    f.write('%.3f %d\n' % (t, gid))
-            f.close()
-        pc.barrier()
 
+def save_state(conf, tstep):
+    """Save the state of the cells and the Random streams of each rank to output/state_dir
 
-def save_state(conf):
+    The state files are only swapped in when all ranks have written them, then rank 0 records the time step of the
+    state in the checkpoint file.
+
+    :param conf: configuration dictionary
+    :param tstep: time step of the saved state
+    """
     state = h.SaveState()
     state.save()
 
-    state_dir = conf["output"]["state_dir"]
-    f = h.File('{}/state_rank-{}'.format(state_dir, int(pc.id())))
-    # f = h.File(state_dir + '/state_rank-%d' % (int(pc.id())))
+    state_file = _state_file(conf)
+    f = h.File(state_file + '.tmp')
+    f.wopen()
     state.fwrite(f, 0)
     rlist = h.List('Random')
     for r_tmp in rlist:
         f.printf('%g\n', r_tmp.seq())
     f.close()
 
+    pc.barrier()
+    os.rename(state_file + '.tmp', state_file)
+    pc.barrier()
+
+    if MPI_Rank == 0:
+        checkpoint_file = _checkpoint_file(conf)
+        with open(checkpoint_file + '.tmp', 'w') as f:
+            json.dump({'tstep': tstep, 't': tstep*conf["run"]["dt"], 'nhost': int(pc.nhost())}, f)
+        os.rename(checkpoint_file + '.tmp', checkpoint_file)
+
+    pc.barrier()
+
 
 def read_state(conf):
-    state_dir = conf["output"]["state_dir"]
+    """Restore the state of the cells and the Random streams saved by save_state, must be called after finitialize"""
+    checkpoint = read_checkpoint(conf)
+    if checkpoint['nhost'] != int(pc.nhost()):
+        raise Exception('The state was saved with {} ranks, unable to restore it on {} ranks'.format(
+            checkpoint['nhost'], int(pc.nhost())))
 
     state = h.SaveState()
-    f = h.File('{}/state_rank-{}'.format(state_dir, int(pc.id())))
-    # f = h.File(state_dir+'/state_rank-%d' % (int(pc.id())))
+    f = h.File(_state_file(conf))
+    f.ropen()
     state.fread(f, 0)
     state.restore()
     rlist = h.List('Random')
     for r_tmp in rlist:
         r_tmp.seq(f.scanvar())
     f.close()
+
+
+def save_steady_state(file_name):
+    """Save the state of the cells on this rank, see Simulation.init_steady_state"""
+    state = h.SaveState()
+    state.save()
+
+    f = h.File(file_name + '.tmp')
+    f.wopen()
+    state.fwrite(f)
+    os.rename(file_name + '.tmp', file_name)
+
+
+def read_steady_state(file_name):
+    """Restore the state saved by save_steady_state without replacing the events queued by finitialize"""
+    state = h.SaveState()
+    f = h.File(file_name)
+    f.ropen()
+    state.fread(f)
+    state.restore(1)
+
+
+def read_checkpoint(conf):
+    """Time step, time and number of ranks of the last state saved in output/state_dir"""
+    return load_json(_checkpoint_file(conf))
+
+
+def _state_file(conf):
+    return '{}/state_rank-{}'.format(conf["output"]["state_dir"], int(pc.id()))
+
+
+def _checkpoint_file(conf):
+    return os.path.join(conf["output"]["state_dir"], 'checkpoint.json')
@@ -25,6 +25,8 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
+
 from bmtk.simulator.bionet.cell import Cell
 from bmtk.simulator.bionet import io,nrn
 
@@ -48,28 +50,30 @@ class LIFCell(Cell):
     def set_im_ptr(self):
         pass
 
-    def set_syn_connection(self, edge_prop, src_node, stim=None):
-        src_gid = src_node.node_id
-        syn_params = edge_prop['dynamics_params']
-        nsyns = edge_prop.nsyns
-        delay = edge_prop['delay']
-
-        syn_weight = edge_prop.weight(src_node, self._node)
-        if not edge_prop.preselected_targets:
-            # TODO: this is not very robust, need some other way
-            syn_weight *= syn_params['sign'] * nsyns
-
-        if stim is not None:
-            nc = h.NetCon(stim.hobj, self.hobj)
-        else:
-            nc = pc.gid_connect(src_gid, self.hobj)
-
-        weight = syn_weight
-        nc.weight[0] = weight
-        nc.delay = delay
-        self._netcons.append(nc)
-        self._src_gids.append(src_gid)
-        return nsyns
+    def set_syn_connections_batch(self, edge_groups, stims=None):
+        syn_counter = 0
+        for edges in edge_groups:
+            syn_params = edges.edge['dynamics_params']
+            nsyns = edges.nsyns
+            delays = edges.column('delay')
+
+            weights = edges.weights(self._node)
+            if not edges.preselected_targets:
+                # TODO: this is not very robust, need some other way
+                weights = weights * syn_params['sign'] * nsyns
+
+            for src_gid, weight, delay in zip(edges.source_gids.tolist(), weights, delays):
+                if stims is not None:
+                    nc = h.NetCon(stims[src_gid].hobj, self.hobj)
+                else:
+                    nc = pc.gid_connect(src_gid, self.hobj)
+
+                nc.weight[0] = weight
+                nc.delay = delay
+                self._netcons.append(nc)
+                self._src_gids.append(src_gid)
+            syn_counter += int(np.sum(nsyns))
+        return syn_counter
 
     def set_syn_connections(self, nsyn, syn_weight, edge_type, src_gid, stim=None):
         """Set synaptic connection"""
@@ -0,0 +1,283 @@
+# Allen Institute Software License - This software license is the 2-clause BSD license plus clause a third
+# clause that prohibits redistribution for commercial purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the Allen Institute's written permission. For
+# purposes of this license, commercial purposes is the incorporation of the Allen Institute's software into anything for
+# which you will charge fees or other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Distribution of the cells among the ranks.
+
+Each cell is given a cost, the time it takes to integrate in arbitrary units, and the cells are assigned with the
+greedy longest processing time (LPT) rule: from the most to the least expensive, each cell goes to the rank with the
+smallest total cost so far. The cost of a biophysical cell is estimated from its segments and the mechanisms inserted in
+them, plus its incoming synapses, before the cells are built. A point cell only costs its synapses and the events it
+receives. The costs measured in a previous run (see measured_costs) can be saved to a file and used instead of the
+estimates.
+
+Within a rank the cells can also be integrated by several threads (pc.nthread), the trees of sections of the rank are
+then distributed among the threads with the same rule, see partition_threads.
+"""
+import heapq
+import numpy as np
+from neuron import h
+
+from bmtk.simulator.bionet import morphology_cache, utils
+from bmtk.simulator.bionet.property_schemas import CellTypes
+
+
+pc = h.ParallelContext()  # object to access MPI methods
+MPI_Rank = int(pc.id())
+
+SEG_COST = 1.0  # cost of a segment with only the passive membrane
+MECH_COST = 1.0  # cost of each mechanism inserted in a segment
+SYN_COST = 1.0  # cost of a synapse or incoming edge
+POINT_COST = 1.0  # cost of a point cell without synapses
+AXON_NSEG = 2  # segments of the axon stub that replaces the reconstructed axon in the cell models
+
+SECTION_LISTS = dict(zip(morphology_cache.SECTION_LISTS, morphology_cache.SECTION_TYPES))
+
+
+def estimate_costs(graph, nodes, dL=20, nseg_rule=None, reduced=False):
+    """Estimated cost of each node by gid
+
+    :param graph: BioGraph of the nodes, for the number of incoming edges
+    :param nodes: internal nodes
+    :param dL: maximum length of a segment, see utils.calc_nseg
+    :param nseg_rule: options of utils.calc_nseg
+    :param reduced: estimate the costs of the biophysical cells from their reduced morphologies
+    """
+    nseg_rule = nseg_rule or {}
+    syn_counts = {}
+    costs = {}
+    morphology_costs = {}  # cost of the segments by (morphology file, cell model parameters)
+    for node in nodes:
+        if node.network not in syn_counts:
+            syn_counts[node.network] = graph.target_counts(node.network)
+        counts = syn_counts[node.network]
+        nsyns = counts[node.node_id] if node.node_id < len(counts) else 0
+
+        if node.cell_type == CellTypes.Biophysical:
+            params = node.model_params
+            key = (node.morphology_file, id(params))
+            if key not in morphology_costs:
+                morphology_costs[key] = segments_cost(node.morphology_file, params, dL, nseg_rule, reduced)
+            costs[node.node_id] = morphology_costs[key] + SYN_COST*nsyns
+        else:
+            costs[node.node_id] = POINT_COST + SYN_COST*nsyns
+
+    return costs
+
+
+def segments_cost(morphology_file, params, dL=20, nseg_rule=None, reduced=False):
+    """Estimated cost of the segments of a cell, the number of segments of each section weighted by the number of
+    mechanisms of the section type. The axon is counted as the stub that replaces it in the cell models.
+
+    :param params: cell model parameters, dictionary with the "genome" and "passive" parameters of the Allen cell types
+        models, otherwise only the passive membrane is counted
+    """
+    morph = get_morphology(morphology_file, reduced)
+    return AXON_NSEG*(SEG_COST + MECH_COST*mechanism_counts(params).get('axon', 0)) + \
+        np.sum(section_costs(morph, params, dL, nseg_rule))
+
+
+def get_morphology(morphology_file, reduced=False):
+    """Arrays of the morphology of a cell, see morphology_cache.get_morphology_arrays"""
+    return morphology_cache.get_reduced_morphology(morphology_file)[0] if reduced \
+        else morphology_cache.get_morphology(morphology_file)
+
+
+def section_costs(morph, params, dL=20, nseg_rule=None):
+    """Estimated cost of each section of the morphology arrays morph, 0 for the axon sections, see segments_cost"""
+    nseg_rule = dict(nseg_rule or {})
+    mechs = mechanism_counts(params)
+    Ra, cm = passive_params(params)
+    rule = nseg_rule.pop('nseg_rule', 'dL')
+    d_lambda = nseg_rule.pop('d_lambda', 0.1)
+    d_lambda_freq = nseg_rule.pop('d_lambda_freq', 100.0)
+    max_nseg = nseg_rule.pop('max_nseg', None)
+
+    costs = np.zeros(len(morph['sec_type']))
+    for i, type_id in enumerate(morph['sec_type']):
+        sec_type = morphology_cache.SECTION_TYPES[type_id]
+        if sec_type == 'axon':
+            continue
+
+        pts = morph['pts'][morph['pt_ptr'][i]:morph['pt_ptr'][i+1]]
+        arc = np.concatenate(([0.0], np.cumsum(np.sqrt(np.sum(np.diff(pts[:, :3], axis=0)**2, axis=1)))))
+        lam = utils.lambda_pts(arc, pts[:, 3], Ra, cm.get(sec_type, 1.0), d_lambda_freq) if rule == 'd_lambda' \
+            else None
+        nseg = utils.nseg_of_length(arc[-1], sec_type, dL, rule, d_lambda, lam, max_nseg)
+        costs[i] = nseg*(SEG_COST + MECH_COST*mechs.get(sec_type, 0))
+
+    return costs
+
+
+def mechanism_counts(params):
+    """Number of distinct mechanisms, other than pas, inserted in each section type by the cell model parameters"""
+    if not isinstance(params, dict):
+        return {}
+
+    mechs = dict((sec_type, set()) for sec_type in morphology_cache.SECTION_TYPES)
+    for p in params.get('genome', []):
+        mechanism = p.get('mechanism', '')
+        if mechanism in ['', 'pas']:
+            continue
+
+        section = p.get('section', '')
+        sec_types = morphology_cache.SECTION_TYPES if section == 'all' else [SECTION_LISTS.get(section, section)]
+        for sec_type in sec_types:
+            if sec_type in mechs:
+                mechs[sec_type].add(mechanism)
+
+    return dict((sec_type, len(names)) for sec_type, names in mechs.items())
+
+
+def passive_params(params):
+    """Axial resistance and the membrane capacitance by section type of the cell model parameters, for the d_lambda
+    rule"""
+    Ra, cm = 100.0, {}
+    if not isinstance(params, dict):
+        return Ra, cm
+
+    passive = params.get('passive', [{}])[0]
+    Ra = passive.get('ra', Ra)
+    for c in passive.get('cm', []):
+        cm[c['section']] = c['cm']
+    for p in params.get('genome', []):
+        if p.get('name') == 'cm':
+            for sec_type in (morphology_cache.SECTION_TYPES if p['section'] == 'all'
+                             else [SECTION_LISTS.get(p['section'], p['section'])]):
+                cm[sec_type] = float(p['value'])
+        elif p.get('name') == 'Ra':
+            Ra = float(p['value'])
+
+    return Ra, cm
+
+
+def assign_ranks(costs, nhost):
+    """Rank of each gid with the greedy longest processing time rule
+
+    The cells are sorted by decreasing cost, ties by gid, so every rank computes the same assignment.
+
+    :param costs: cost of each cell by gid
+    :param nhost: number of ranks
+    :return: dictionary of the rank of each gid
+    """
+    loads = [(0.0, r) for r in range(nhost)]  # heap of the total cost of each rank
+    ranks = {}
+    for gid in sorted(costs, key=lambda g: (-costs[g], g)):
+        load, r = heapq.heappop(loads)
+        ranks[gid] = r
+        heapq.heappush(loads, (load + costs[gid], r))
+
+    return ranks
+
+
+def rank_loads(costs, ranks, nhost):
+    """Total cost of each rank"""
+    loads = np.zeros(nhost)
+    for gid, r in ranks.items():
+        loads[r] += costs[gid]
+    return loads
+
+
+def partition_threads(cells, costs, nthreads):
+    """Distribute the trees of sections of this rank among the threads with pc.partition
+
+    The cost of each cell is divided among its sections in proportion to their segments, the pieces of a cell split
+    with multisplit are separate trees. pc.nthread must have been set, and with multisplit the partition has to be set
+    before the final pc.multisplit() call.
+
+    :param cells: biophysical cells of this rank (with pieces of split cells) by gid
+    :param costs: cost of each cell by gid
+    :param nthreads: number of threads
+    :return: total cost of each thread
+    """
+    sec_costs = {}  # cost of a segment of each section of the cells by section name
+    for gid, cell in cells.items():
+        seg_cost = costs[gid]/max(np.sum(cell.sec_nsegs), 1)
+        for sec in cell.hobj.all:
+            sec_costs[sec.name()] = seg_cost
+
+    roots = {}
+    tree_costs = {}  # cost of each tree by the name of its root section
+    for sec in h.allsec():
+        root = h.SectionRef(sec=sec).root
+        roots[root.name()] = root
+        tree_costs[root.name()] = tree_costs.get(root.name(), 0.0) + sec.nseg*sec_costs.get(sec.name(), SEG_COST)
+
+    tree_threads = assign_ranks(tree_costs, nthreads)
+    partitions = [h.SectionList() for _ in range(nthreads)]
+    for name, thread in tree_threads.items():
+        partitions[thread].append(sec=roots[name])
+    for thread, partition in enumerate(partitions):
+        pc.partition(thread, partition)
+
+    return rank_loads(tree_costs, tree_threads, nthreads)
+
+
+def measured_costs(costs, step_time):
+    """Costs of the cells of this rank measured in seconds: the computation time of the rank (pc.step_time()) divided
+    among its cells in proportion to their estimated costs. The costs of all the ranks are returned on every rank, the
+    shares of a cell split among several ranks are summed.
+
+    :param costs: estimated costs of the cells of this rank by gid, of the pieces on this rank for a split cell
+    :param step_time: computation time of this rank
+    """
+    total = float(sum(costs.values()))
+    local = dict((gid, step_time*cost/total) for gid, cost in costs.items()) if total > 0 else {}
+    all_costs = {}
+    for rank_costs in (pc.py_allgather(local) if int(pc.nhost()) > 1 else [local]):
+        for gid, cost in rank_costs.items():
+            all_costs[gid] = all_costs.get(gid, 0.0) + cost
+    return all_costs
+
+
+def calibrate_costs(costs, measured):
+    """Estimated costs replaced by the measured costs of a previous run
+
+    The cells missing from measured, e.g. added to the network since the calibration run, keep their estimated cost
+    scaled by the ratio of the measured to the estimated costs of the other cells.
+    """
+    common = [gid for gid in costs if gid in measured]
+    estimated = sum(costs[gid] for gid in common)
+    scale = sum(measured[gid] for gid in common)/estimated if estimated > 0 else 1.0
+    return dict((gid, measured[gid] if gid in measured else scale*cost) for gid, cost in costs.items())
+
+
+def save_costs(file_name, costs):
+    """Save the costs by gid to a space separated text file with the columns gid and cost, written by rank 0"""
+    if MPI_Rank != 0:
+        return
+
+    gids = np.array(sorted(costs), dtype=np.int64)
+    with open(file_name, 'w') as f:
+        f.write('gid cost\n')
+        np.savetxt(f, np.column_stack((gids, [costs[gid] for gid in gids])), fmt=['%d', '%.6g'])
+
+
+def load_costs(file_name):
+    """Costs by gid saved by save_costs"""
+    data = np.loadtxt(file_name, skiprows=1, ndmin=2)
+    return dict((int(gid), float(cost)) for gid, cost in data)
@@ -25,18 +25,26 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import os
 import numpy as np
 
 from neuron import h
 
+from bmtk.simulator.bionet import morphology_cache
+
 
 pc = h.ParallelContext()  # object to access MPI methods
 
 
 class Morphology(object):
     """Methods for processing morphological data"""
-    def __init__(self, hobj):
-        """reuse hoc object from one of the cells which share the same morphology/model"""
+    def __init__(self, hobj, morphology_file=None):
+        """reuse hoc object from one of the cells which share the same morphology/model
+
+        :param hobj: hoc object of the cell
+        :param morphology_file: SWC file of the cell, used to save the segment geometry when a morphology cache
+        directory is set (see morphology_cache.set_cache_dir)
+        """
         self.hobj = hobj
         self.sec_type_swc = {'soma': 1, 'somatic': 1,  # convert section name and section list names
                              'axon': 2, 'axonal': 2,  # into a consistent swc notation
@@ -45,6 +53,11 @@ class Morphology(object):
         self.nseg = self.get_nseg()
         self._segments = {}
 
+        self._cache_file = morphology_cache.get_geometry_file(morphology_file, hobj)
+        self._cached = {}
+        if self._cache_file is not None and os.path.exists(self._cache_file):
+            self._cached = morphology_cache.load_arrays(self._cache_file)
+
     def get_nseg(self):
         nseg = 0
         for sec in self.hobj.all:
@@ -52,80 +65,56 @@ class Morphology(object):
         return nseg
 
     def get_soma_pos(self):
-        n3dsoma = 0
-        r3dsoma = np.zeros(3)
-        for sec in self.hobj.somatic:
-            n3d = int(h.n3d())  # get number of n3d points in each section
-            r3d = np.zeros((3, n3d))  # to hold locations of 3D morphology for the current section
-            n3dsoma += n3d
-
-            for i in range(n3d):
-                r3dsoma[0] += h.x3d(i)
-                r3dsoma[1] += h.y3d(i)
-                r3dsoma[2] += h.z3d(i)
-
-        r3dsoma /= n3dsoma
-        return r3dsoma
+        """Average position of the 3d points of the soma sections"""
+        pts = np.concatenate([morphology_cache.get_pt3d(sec) for sec in self.hobj.somatic])
+        return pts[:, :3].mean(axis=0)
 
     def calc_seg_coords(self):   
         """Calculate segment coordinates from 3d point coordinates"""
-        ix = 0  # segment index
+        if self._load_cached('seg_coords', ['p0', 'p1', 'd0', 'd1']):
+            self.psoma = self._cached['psoma']
+            return self.seg_coords
 
         p3dsoma = self.get_soma_pos()
         self.psoma = p3dsoma
-        
-        p0 = np.zeros((3, self.nseg))  # hold the coordinates of segment starting points
-        p1 = np.zeros((3, self.nseg))  # hold the coordinates of segment end points
-        d0 = np.zeros(self.nseg) 
-        d1 = np.zeros(self.nseg) 
 
-        for sec in self.hobj.all:
-            n3d = int(h.n3d())  # get number of n3d points in each section
-            p3d = np.zeros((3, n3d))  # to hold locations of 3D morphology for the current section
-            l3d = np.zeros(n3d)  # to hold locations of 3D morphology for the current section
-            diam3d = np.zeros(n3d)  # to diameters
-
-            for i in range(n3d):
-                p3d[0, i] = h.x3d(i) - p3dsoma[0]
-                p3d[1, i] = h.y3d(i) - p3dsoma[1]  # shift coordinates such to place soma at the origin.
-                p3d[2, i] = h.z3d(i) - p3dsoma[2]
-                diam3d[i] = h.diam3d(i)
-                l3d[i] = h.arc3d(i)
-
-            l3d /= sec.L                  # normalize
-            nseg = sec.nseg
-            
-            l0 = np.zeros(nseg)     # keep range of segment starting point 
-            l1 = np.zeros(nseg)     # keep range of segment ending point 
-            
-            for iseg, seg in enumerate(sec):
-                l0[iseg] = seg.x - 0.5*1/nseg   # x (normalized distance along the section) for the beginning of the segment
-                l1[iseg] = seg.x + 0.5*1/nseg   # x for the end of the segment
-
-            p0[0, ix:ix+nseg] = np.interp(l0, l3d, p3d[0, :])
-            p0[1, ix:ix+nseg] = np.interp(l0, l3d, p3d[1, :])
-            p0[2, ix:ix+nseg] = np.interp(l0, l3d, p3d[2, :])
-            d0[ix:ix+nseg] = np.interp(l0, l3d, diam3d[:])
+        # The 3d points of all sections are placed on a single axis, section i spans [2*i, 2*i+1] with its arc length
+        # normalized by sec.L, so the start and end of all segments are interpolated with one call per coordinate.
+        pts = []
+        arc = []
+        seg_x0 = []
+        seg_x1 = []
+        for i, sec in enumerate(self.hobj.all):
+            sec_pts = morphology_cache.get_pt3d(sec)
+            pts.append(sec_pts[:, :4])
+            arc.append(2*i + sec_pts[:, 4]/sec.L)
 
-            p1[0, ix:ix+nseg] = np.interp(l1, l3d, p3d[0, :])
-            p1[1, ix:ix+nseg] = np.interp(l1, l3d, p3d[1, :])
-            p1[2, ix:ix+nseg] = np.interp(l1, l3d, p3d[2, :])
-            d1[ix:ix+nseg] = np.interp(l1, l3d, diam3d[:])
-            ix += nseg
+            nseg = sec.nseg
+            seg_x0.append(2*i + np.arange(nseg, dtype=float)/nseg)  # x (normalized distance along the section) for the beginning of the segment
+            seg_x1.append(2*i + np.arange(1, nseg+1, dtype=float)/nseg)  # x for the end of the segment
 
+        pts = np.concatenate(pts)
+        pts[:, :3] -= p3dsoma  # shift coordinates such to place soma at the origin.
+        arc = np.concatenate(arc)
+        seg_x0 = np.concatenate(seg_x0)
+        seg_x1 = np.concatenate(seg_x1)
 
         self.seg_coords = {}
 
-        self.seg_coords['p0'] = p0
-        self.seg_coords['p1'] = p1
+        self.seg_coords['p0'] = np.array([np.interp(seg_x0, arc, pts[:, k]) for k in range(3)])
+        self.seg_coords['p1'] = np.array([np.interp(seg_x1, arc, pts[:, k]) for k in range(3)])
 
-        self.seg_coords['d0'] = d0
-        self.seg_coords['d1'] = d1
+        self.seg_coords['d0'] = np.interp(seg_x0, arc, pts[:, 3])
+        self.seg_coords['d1'] = np.interp(seg_x1, arc, pts[:, 3])
 
+        self._save_cached('seg_coords', self.seg_coords, psoma=self.psoma)
         return self.seg_coords
 
     def set_seg_props(self):
         """Set segment properties which are invariant for all cell using this morphology"""
+        if self._load_cached('seg_prop', ['type', 'area', 'x', 'dist', 'length', 'dist0', 'dist1']):
+            return
+
         seg_type = []
         seg_area = []
         seg_x = []
@@ -141,11 +130,11 @@ class Morphology(object):
 
             for seg in sec:
 
-                seg_area.append(h.area(seg.x))
+                seg_area.append(seg.area())
                 seg_x.append(seg.x)
                 seg_length.append(sec.L/sec.nseg)
                 seg_type.append(sec_type_swc)           # record section type in a list
-                seg_dist.append(h.distance(seg.x))  # distance to the center of the segment
+                seg_dist.append(h.distance(seg.x, sec=sec))  # distance to the center of the segment
 
 
         self.seg_prop = {}
@@ -159,20 +148,71 @@ class Morphology(object):
         self.seg_prop['dist0'] = self.seg_prop['dist'] - self.seg_prop['length']/2
         self.seg_prop['dist1'] = self.seg_prop['dist'] + self.seg_prop['length']/2
 
+        self._save_cached('seg_prop', self.seg_prop)
+
+    def _load_cached(self, name, keys):
+        # sets self.<name> from the geometry cache file, False if it was not saved or does not match the cell
+        arrays = {}
+        for key in keys:
+            value = self._cached.get('{}/{}'.format(name, key))
+            if value is None or value.shape[-1] != self.nseg:
+                return False
+            arrays[key] = value
+
+        setattr(self, name, arrays)
+        return True
+
+    def _save_cached(self, name, arrays, **other):
+        if self._cache_file is None:
+            return
+
+        for key, value in arrays.items():
+            self._cached['{}/{}'.format(name, key)] = value
+        self._cached.update(other)
+        morphology_cache.save_arrays(self._cache_file, self._cached)
+
     def get_target_segments(self, edge_type):
-        # Determine the target segments and their probabilities of connections for each new edge-type. Save the
-        # information for each additional time a given edge-type is used on this morphology
-        if edge_type in self._segments:
-            return self._segments[edge_type]
+        """Indexes of the segments targeted by an edge-type and their probabilities of connection"""
+        tar_seg_ix, tar_seg_prob, _ = self.find_target_segments(edge_type.target_sections, edge_type.target_distance)
+        return tar_seg_ix, tar_seg_prob
 
-        tar_sec_labels = edge_type.target_sections
-        drange = edge_type.target_distance
+    def get_target_cdf(self, edge_type):
+        """Indexes of the segments targeted by an edge-type and the cumulative distribution of their probabilities,
+        the same used by RandomState.choice so cdf.searchsorted(prng.random_sample(n), side='right') picks the segments
+        that prng.choice(tar_seg_ix, n, p=tar_seg_prob) would"""
+        tar_seg_ix, _, tar_seg_cdf = self.find_target_segments(edge_type.target_sections, edge_type.target_distance)
+        return tar_seg_ix, tar_seg_cdf
+
+    def seg_locations(self, segs_ix, xs=None):
+        """Segments and positions along their sections where synapses placed on the given segments are connected
+
+        :param segs_ix: indexes of the segments returned by find_target_segments
+        :param xs: positions along the sections, the centers of the segments by default
+        """
+        segs_ix = np.asarray(segs_ix, dtype=np.int64)
+        return segs_ix, (self.seg_prop['x'][segs_ix] if xs is None else np.asarray(xs, dtype=float))
+
+    def find_target_segments(self, target_sections, target_distance):
+        """Segments within the target sections and distance range from the soma
+
+        The segments are determined once for each combination of target sections and distance range, edge-types are
+        distinct objects for each edge so are not used as the key.
+
+        :param target_sections: list of section names or section list names, e.g. ['dend', 'apical']
+        :param target_distance: [min, max] distance from the soma
+        :return: indexes of the segments, probability of placing a synapse on each segment and its cumulative sum
+        """
+        key = (tuple(target_sections), tuple(np.atleast_1d(target_distance)))
+        if key not in self._segments:
+            self._segments[key] = self._find_target_segments(target_sections, target_distance)
+        return self._segments[key]
+
+    def _find_target_segments(self, tar_sec_labels, drange):
         dmin, dmax = drange[0], drange[1]
 
         seg_d0 = self.seg_prop['dist0']  # use a more compact variables
         seg_d1 = self.seg_prop['dist1']
         seg_length = self.seg_prop['length']
-        seg_area = self.seg_prop['area']
         seg_type = self.seg_prop['type']
 
         # Find the fractional overlap between the segment and the distance range:
@@ -191,22 +231,15 @@ class Morphology(object):
             ix_labels = np.append(ix_labels, ix_label)  # target segment indexes
 
         tar_seg_ix = np.intersect1d(ix_drange, ix_labels)  # find intersection between indexes for range and labels
+        if len(tar_seg_ix) == 0:
+            raise ValueError('No segments in {} within distance range {}'.format(list(tar_sec_labels), list(drange)))
+
         tar_seg_length = seg_length[tar_seg_ix] * frac_overlap[tar_seg_ix]  # weighted length of targeted segments
         tar_seg_prob = tar_seg_length / np.sum(tar_seg_length)  # probability of targeting segments
+        tar_seg_cdf = tar_seg_prob.cumsum()
+        tar_seg_cdf /= tar_seg_cdf[-1]
 
-        self._segments[edge_type] = (tar_seg_ix, tar_seg_prob)
-
-
-        # print connected segments distances
-        #print "tar_seg_ix:", tar_seg_ix
-        #print "dist0: ", self.seg_prop['dist0'][tar_seg_ix]
-        #print "dist1: ", self.seg_prop['dist1'][tar_seg_ix]
-        #print "dist: ", self.seg_prop['dist'][tar_seg_ix]
-        #print "seg_length: ", self.seg_prop['length'][tar_seg_ix]
-
-        #print dmin,dmax
-        #print frac_overlap[tar_seg_ix]
-        return tar_seg_ix, tar_seg_prob
+        return tar_seg_ix, tar_seg_prob, tar_seg_cdf
 
 
     """
@@ -0,0 +1,265 @@
+# Allen Institute Software License - This software license is the 2-clause BSD license plus clause a third
+# clause that prohibits redistribution for commercial purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the Allen Institute's written permission. For
+# purposes of this license, commercial purposes is the incorporation of the Allen Institute's software into anything for
+# which you will charge fees or other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Cache of the morphologies imported from SWC files.
+
+Each SWC file is imported once per process with the Biophys1 template (Import3d). The 3d points and the topology of the
+imported sections are kept as arrays and every cell with that morphology is built from the arrays into a BioMorphology
+object, which has the same sections and section lists as Biophys1. With set_cache_dir the arrays are also saved to disk
+keyed by the hash of the SWC file so later runs do not import the file at all, the segment geometry computed by
+Morphology is saved in the same directory. With set_reduction the cells are built from a reduced version of the
+arrays instead (see morphology_reduction.reduce_morphology).
+"""
+import os
+import json
+import hashlib
+import numpy as np
+from neuron import h
+
+
+SECTION_TYPES = ['soma', 'dend', 'apic', 'axon']
+SECTION_LISTS = ['somatic', 'basal', 'apical', 'axonal']
+
+_template = """
+begintemplate BioMorphology
+
+public soma, dend, apic, axon
+public all, somatic, basal, apical, axonal
+
+objref all, somatic, basal, apical, axonal
+objref this
+
+create soma[1], dend[1], apic[1], axon[1]
+
+proc init() {
+    all = new SectionList()
+    somatic = new SectionList()
+    basal = new SectionList()
+    apical = new SectionList()
+    axonal = new SectionList()
+    forall delete_section()
+}
+
+endtemplate BioMorphology
+"""
+
+_morphologies = {}  # arrays of each morphology by the path of the SWC file
+_reductions = {}  # reduced arrays and the mapping from the full morphology, by the path of the SWC file
+_file_hashes = {}
+_cache_dir = None
+_reduce_func = None
+
+
+def set_cache_dir(cache_dir):
+    """Directory where the imported morphologies are saved, None to keep them in memory only"""
+    global _cache_dir
+    _cache_dir = cache_dir
+
+
+def set_reduction(reduce_func):
+    """Function returning the (reduced arrays, mapping) of the arrays of a morphology, used by load_morphology to build
+    reduced cells, None to build the full morphologies"""
+    global _reduce_func
+    _reduce_func = reduce_func
+
+
+def get_reduction():
+    return _reduce_func
+
+
+def load_morphology(morphology_file, reduced=None):
+    """Creates the sections of a cell with the morphology of an SWC file
+
+    :param morphology_file: path of the SWC file
+    :param reduced: build the reduced morphology, by default when a reduction was set with set_reduction
+    :return: BioMorphology hoc object with the soma, dend, apic and axon sections and the all, somatic, basal, apical and
+    axonal section lists of the Biophys1 template
+    """
+    morphology_file = str(morphology_file)
+    if reduced is None:
+        reduced = _reduce_func is not None
+
+    if reduced:
+        return build_morphology(get_reduced_morphology(morphology_file)[0])
+
+    return build_morphology(get_morphology(morphology_file))
+
+
+def get_morphology(morphology_file):
+    """The arrays of an SWC file (see get_morphology_arrays), imported once per process"""
+    morphology_file = str(morphology_file)
+    if morphology_file not in _morphologies:
+        _morphologies[morphology_file] = _read_morphology(morphology_file)
+    return _morphologies[morphology_file]
+
+
+def get_reduced_morphology(morphology_file):
+    """The arrays of the reduced morphology of an SWC file and the mapping of the full sections onto them, computed
+    once per process with the function given to set_reduction"""
+    morphology_file = str(morphology_file)
+    if morphology_file not in _reductions:
+        _reductions[morphology_file] = _reduce_func(get_morphology(morphology_file))
+    return _reductions[morphology_file]
+
+
+def build_morphology(morph):
+    """Creates a new BioMorphology hoc object from the arrays returned by get_morphology_arrays"""
+    if not hasattr(h, 'BioMorphology'):
+        h(_template)
+
+    hobj = h.BioMorphology()
+    for type_indx, sec_type in enumerate(SECTION_TYPES):
+        nsecs = int(np.count_nonzero(morph['sec_type'] == type_indx))
+        if nsecs > 0:
+            h.execute('create {}[{}]'.format(sec_type, nsecs), hobj)
+
+    secs = [getattr(hobj, SECTION_TYPES[sec_type])[int(sec_index)]
+            for sec_type, sec_index in zip(morph['sec_type'], morph['sec_index'])]
+    sec_lists = [getattr(hobj, name) for name in SECTION_LISTS]
+    pt_ptr = morph['pt_ptr']
+    for i, sec in enumerate(secs):
+        pts = morph['pts'][pt_ptr[i]:pt_ptr[i+1]]
+        h.pt3dadd(h.Vector(pts[:, 0]), h.Vector(pts[:, 1]), h.Vector(pts[:, 2]), h.Vector(pts[:, 3]), sec=sec)
+        if morph['pt3dstyle'][i]:
+            x, y, z = morph['logical_pt'][i]
+            h.pt3dstyle(1, x, y, z, sec=sec)
+
+        if morph['parent'][i] >= 0:
+            sec.connect(secs[morph['parent'][i]](morph['parent_x'][i]), morph['orientation'][i])
+        sec.nseg = int(morph['nseg'][i])
+
+        hobj.all.append(sec=sec)
+        sec_lists[morph['sec_type'][i]].append(sec=sec)
+
+    return hobj
+
+
+def get_morphology_arrays(hobj):
+    """The 3d points, topology and number of segments of the sections in hobj.all as a dictionary of arrays"""
+    secs = list(hobj.all)
+    sec_ids = dict((sec.name(), i) for i, sec in enumerate(secs))
+
+    sec_type = np.zeros(len(secs), dtype=np.int8)
+    sec_index = np.zeros(len(secs), dtype=np.int32)
+    parent = np.full(len(secs), -1, dtype=np.int32)
+    parent_x = np.zeros(len(secs))
+    orientation = np.zeros(len(secs))
+    nseg = np.zeros(len(secs), dtype=np.int32)
+    pt3dstyle = np.zeros(len(secs), dtype=np.int8)
+    logical_pt = np.zeros((len(secs), 3))
+    pt_ptr = np.zeros(len(secs)+1, dtype=np.int64)
+    pts = []
+    x, y, z = h.ref(0), h.ref(0), h.ref(0)
+    for i, sec in enumerate(secs):
+        name = sec.name().split('.')[-1]
+        sec_type[i] = SECTION_TYPES.index(name.split('[')[0])
+        sec_index[i] = int(name.split('[')[1].rstrip(']'))
+
+        parent_seg = sec.parentseg()
+        if parent_seg is not None:
+            parent[i] = sec_ids[parent_seg.sec.name()]
+            parent_x[i] = parent_seg.x
+        orientation[i] = h.section_orientation(sec=sec)
+        nseg[i] = sec.nseg
+
+        pt3dstyle[i] = h.pt3dstyle(1, x, y, z, sec=sec)  # with references returns the logical connection point
+        if pt3dstyle[i]:
+            logical_pt[i] = (x[0], y[0], z[0])
+
+        sec_pts = get_pt3d(sec)
+        pt_ptr[i+1] = pt_ptr[i] + len(sec_pts)
+        pts.append(sec_pts[:, :4])
+
+    pts = np.concatenate(pts) if pts else np.zeros((0, 4))
+    return {'sec_type': sec_type, 'sec_index': sec_index, 'parent': parent, 'parent_x': parent_x,
+            'orientation': orientation, 'nseg': nseg, 'pt3dstyle': pt3dstyle, 'logical_pt': logical_pt,
+            'pt_ptr': pt_ptr, 'pts': pts}
+
+
+def get_pt3d(sec):
+    """The 3d points of a section as an (n3d, 5) array of x, y, z, diam and arc length"""
+    n3d = int(h.n3d(sec=sec))
+    return np.array([[h.x3d(i, sec=sec), h.y3d(i, sec=sec), h.z3d(i, sec=sec), h.diam3d(i, sec=sec),
+                      h.arc3d(i, sec=sec)] for i in range(n3d)]).reshape(n3d, 5)
+
+
+def get_geometry_file(morphology_file, hobj):
+    """File where the segment geometry of a cell built from morphology_file is saved, None without a cache directory
+
+    The name depends on the SWC file and on the name, number of segments and length of each section of the cell so
+    changes to dL or to the axon replacement use a different file.
+    """
+    if _cache_dir is None or morphology_file is None:
+        return None
+
+    key = [_file_hash(str(morphology_file))] + [[sec.name().split('.')[-1], sec.nseg, sec.L] for sec in hobj.all]
+    key_hash = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+    return os.path.join(_cache_dir, 'geometry_{}.npz'.format(key_hash))
+
+
+def save_arrays(file_name, arrays):
+    """Saves a dictionary of arrays in the cache directory, the file is replaced once it is complete"""
+    cache_dir = os.path.dirname(file_name)
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass  # created by another rank
+
+    tmp_file = '{}.{}.tmp.npz'.format(file_name[:-4], os.getpid())
+    np.savez(tmp_file, **arrays)
+    os.rename(tmp_file, file_name)
+
+
+def load_arrays(file_name):
+    """Dictionary of the arrays saved by save_arrays"""
+    with np.load(file_name) as npz:
+        return dict((key, npz[key]) for key in npz.files)
+
+
+def _file_hash(file_name):
+    if file_name not in _file_hashes:
+        with open(file_name, 'rb') as f:
+            _file_hashes[file_name] = hashlib.sha1(f.read()).hexdigest()
+    return _file_hashes[file_name]
+
+
+def _read_morphology(morphology_file):
+    cache_file = None
+    if _cache_dir is not None:
+        cache_file = os.path.join(_cache_dir, 'morphology_{}.npz'.format(_file_hash(morphology_file)))
+        if os.path.exists(cache_file):
+            return load_arrays(cache_file)
+
+    hobj = h.Biophys1(morphology_file)  # import the SWC file with Import3d
+    morph = get_morphology_arrays(hobj)
+
+    if cache_file is not None:
+        save_arrays(cache_file, morph)
+
+    return morph
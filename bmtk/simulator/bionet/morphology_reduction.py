@@ -0,0 +1,382 @@
+# Allen Institute Software License - This software license is the 2-clause BSD license plus clause a third
+# clause that prohibits redistribution for commercial purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the Allen Institute's written permission. For
+# purposes of this license, commercial purposes is the incorporation of the Allen Institute's software into anything for
+# which you will charge fees or other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Reduced morphologies for fast simulations of single cells.
+
+reduce_morphology replaces every dendritic tree growing from the soma (a stem and all its branches) by a single cable
+with the diameter of the stem and the electrotonic length of the longest path of the tree, the soma and axon are kept.
+The electrotonic distances are measured in units of sqrt(um), the length constant of a cylinder being proportional to
+the square root of its diameter when Ra and Rm are the same in the whole tree, so the reduction only depends on the
+geometry. Each point of the full tree is mapped to the point of its cable at the same electrotonic distance from the
+soma.
+
+The cells are built from the reduced morphologies when run/morphology_reduction is set (see BioNetwork). Synapses are
+still placed and distance dependent densities evaluated on the segments of the full cell, which are then moved to the
+reduced segments by ReducedMorphology, and the membrane of each reduced segment is scaled to the area of the full
+segments mapped onto it.
+"""
+import numpy as np
+from neuron import h
+
+from bmtk.simulator.bionet import morphology_cache, utils
+from bmtk.simulator.bionet.morphology import Morphology
+
+
+SOMA, DEND, APIC, AXON = [morphology_cache.SECTION_TYPES.index(name) for name in ['soma', 'dend', 'apic', 'axon']]
+
+_conductances = {}  # names of the conductance densities of each mechanism
+
+
+def reduce_morphology(morph):
+    """Reduces each dendritic tree of a morphology to an equivalent cable
+
+    :param morph: arrays of the morphology (see morphology_cache.get_morphology_arrays)
+    :return: arrays of the reduced morphology and the mapping of the full morphology onto it, a dictionary with the
+        index of the reduced section of every full section ("section") and the normalized position on that section of
+        every 3d point of the full morphology ("x")
+    """
+    sec_type = morph['sec_type']
+    parent = morph['parent']
+    parent_x = morph['parent_x']
+    pt_ptr = morph['pt_ptr']
+    pts = morph['pts']
+    nsecs = len(sec_type)
+    dendritic = np.in1d(sec_type, [DEND, APIC])
+
+    # arc length and electrotonic distance from the start of the section of every 3d point
+    arc = np.zeros(len(pts))
+    elec = np.zeros(len(pts))
+    for i in range(nsecs):
+        sec_pts = pts[pt_ptr[i]:pt_ptr[i+1]]
+        if len(sec_pts) > 1:
+            darc = np.sqrt(np.sum(np.diff(sec_pts[:, :3], axis=0)**2, axis=1))
+            diam = np.maximum((sec_pts[:-1, 3] + sec_pts[1:, 3])/2.0, 1e-6)
+            arc[pt_ptr[i]+1:pt_ptr[i+1]] = np.cumsum(darc)
+            elec[pt_ptr[i]+1:pt_ptr[i+1]] = np.cumsum(darc/np.sqrt(diam))
+    sec_L = np.array([arc[pt_ptr[i+1]-1] if pt_ptr[i+1] > pt_ptr[i] else 0.0 for i in range(nsecs)])
+
+    # electrotonic distance of every point from the start of its stem, parents first
+    children = [[] for _ in range(nsecs)]
+    for i in range(nsecs):
+        if parent[i] >= 0:
+            children[parent[i]].append(i)
+    order = [i for i in range(nsecs) if parent[i] < 0]
+    for i in order:
+        order.extend(children[i])
+
+    stem = np.full(nsecs, -1, dtype=np.int64)
+    for i in order:
+        if not dendritic[i]:
+            continue
+        p = parent[i]
+        if p >= 0 and dendritic[p]:
+            stem[i] = stem[p]
+            elec[pt_ptr[i]:pt_ptr[i+1]] += _interp_pts(parent_x[i]*sec_L[p], arc, elec, pt_ptr, p)
+        else:
+            stem[i] = i
+
+    stems = np.flatnonzero(stem == np.arange(nsecs))
+    pt_sec = np.repeat(np.arange(nsecs), np.diff(pt_ptr))
+    elec_max = {}
+    stem_diam = {}
+    stem_pts = {}
+    for s in stems:
+        tree_pts = stem[pt_sec] == s
+        elec_max[s] = elec[tree_pts].max() if np.any(tree_pts) else 0.0
+        sec_pts = pts[pt_ptr[s]:pt_ptr[s+1]]
+        if sec_L[s] > 0:
+            stem_diam[s] = np.trapz(sec_pts[:, 3], arc[pt_ptr[s]:pt_ptr[s+1]])/sec_L[s]
+        else:
+            stem_diam[s] = sec_pts[0, 3] if len(sec_pts) > 0 else 1.0
+
+        # the cable points from the start of the stem towards the center of its tree, at least 1 um long
+        p0 = sec_pts[0, :3] if len(sec_pts) > 0 else np.zeros(3)
+        direction = pts[tree_pts, :3].mean(axis=0) - p0 if np.any(tree_pts) else np.zeros(3)
+        norm = np.sqrt(np.dot(direction, direction))
+        direction = direction/norm if norm > 0 else np.array([0.0, 1.0, 0.0])
+        length = max(elec_max[s]*np.sqrt(stem_diam[s]), 1.0)
+        stem_pts[s] = np.array([np.append(p0, stem_diam[s]), np.append(p0 + length*direction, stem_diam[s])])
+
+    # the soma and axon sections are kept, each stem becomes a section of its type
+    kept = np.flatnonzero(~dendritic | (stem == np.arange(nsecs)))
+    new_index = np.full(nsecs, -1, dtype=np.int64)
+    new_index[kept] = np.arange(len(kept))
+    stem_counts = dict((t, 0) for t in [DEND, APIC])
+
+    reduced = dict((key, []) for key in ['sec_type', 'sec_index', 'parent', 'parent_x', 'orientation', 'nseg',
+                                         'pt3dstyle', 'logical_pt', 'pts'])
+    for i in kept:
+        p = parent[i]
+        if dendritic[i]:
+            sec_index = stem_counts[sec_type[i]]
+            stem_counts[sec_type[i]] += 1
+            sec_pts = stem_pts[i]
+            nseg = 1
+        else:
+            sec_index = morph['sec_index'][i]
+            sec_pts = pts[pt_ptr[i]:pt_ptr[i+1]]
+            nseg = morph['nseg'][i]
+
+        if p < 0:
+            new_parent, new_parent_x = -1, parent_x[i]
+        elif new_index[p] >= 0:
+            new_parent, new_parent_x = new_index[p], parent_x[i]
+        else:
+            # a kept section growing from a dendrite connects to the cable of the dendrite
+            s = stem[p]
+            new_parent = new_index[s]
+            new_parent_x = _interp_pts(parent_x[i]*sec_L[p], arc, elec, pt_ptr, p)/elec_max[s] if elec_max[s] > 0 else 0.0
+
+        reduced['sec_type'].append(sec_type[i])
+        reduced['sec_index'].append(sec_index)
+        reduced['parent'].append(new_parent)
+        reduced['parent_x'].append(new_parent_x)
+        reduced['orientation'].append(morph['orientation'][i])
+        reduced['nseg'].append(nseg)
+        reduced['pt3dstyle'].append(morph['pt3dstyle'][i])
+        reduced['logical_pt'].append(morph['logical_pt'][i])
+        reduced['pts'].append(sec_pts)
+
+    npts = [len(sec_pts) for sec_pts in reduced['pts']]
+    reduced_arrays = {'sec_type': np.array(reduced['sec_type'], dtype=np.int8),
+                      'sec_index': np.array(reduced['sec_index'], dtype=np.int32),
+                      'parent': np.array(reduced['parent'], dtype=np.int32),
+                      'parent_x': np.array(reduced['parent_x'], dtype=float),
+                      'orientation': np.array(reduced['orientation'], dtype=float),
+                      'nseg': np.array(reduced['nseg'], dtype=np.int32),
+                      'pt3dstyle': np.array(reduced['pt3dstyle'], dtype=np.int8),
+                      'logical_pt': np.array(reduced['logical_pt'], dtype=float).reshape(len(kept), 3),
+                      'pt_ptr': np.concatenate(([0], np.cumsum(npts))).astype(np.int64),
+                      'pts': np.concatenate(reduced['pts']) if reduced['pts'] else np.zeros((0, 4))}
+
+    # position of every full point on its reduced section
+    pt_x = np.zeros(len(pts))
+    for i in range(nsecs):
+        sl = slice(pt_ptr[i], pt_ptr[i+1])
+        if dendritic[i]:
+            pt_x[sl] = elec[sl]/elec_max[stem[i]] if elec_max[stem[i]] > 0 else 0.0
+        elif sec_L[i] > 0:
+            pt_x[sl] = arc[sl]/sec_L[i]
+
+    mapping = {'section': new_index[np.where(dendritic, stem, np.arange(nsecs))], 'x': np.clip(pt_x, 0.0, 1.0)}
+    return reduced_arrays, mapping
+
+
+def _interp_pts(dist, arc, values, pt_ptr, sec):
+    # value at an arc length along a section, from the values at its 3d points
+    sl = slice(pt_ptr[sec], pt_ptr[sec+1])
+    if pt_ptr[sec+1] == pt_ptr[sec]:
+        return 0.0
+    return np.interp(dist, arc[sl], values[sl])
+
+
+def load_full_hobj(node, dL, nseg_rule=None):
+    """Builds the full morphology of a cell with its cell model, segmented as BioCell.set_nseg would"""
+    reduce_func = morphology_cache.get_reduction()
+    morphology_cache.set_reduction(None)
+    try:
+        hobj = node.load_hobj()
+    finally:
+        morphology_cache.set_reduction(reduce_func)
+
+    for sec in hobj.all:
+        sec.nseg = utils.calc_nseg(sec, dL, **(nseg_rule or {}))
+    return hobj
+
+
+class ReducedMorphology(Morphology):
+    """Morphology of the cells built from a reduced morphology
+
+    Keeps the Morphology of a cell built with the full morphology and the same cell model (full). The target segments
+    of the synapses are found on the full segments and moved to the reduced segments with seg_locations, and the
+    values of the full segments are moved with map_seg_values, which keeps their integral over the membrane.
+    """
+    def __init__(self, hobj, morphology_file, full_hobj):
+        super(ReducedMorphology, self).__init__(hobj, morphology_file)
+        self._morphology_file = morphology_file
+        self.full = Morphology(full_hobj, morphology_file)
+
+    def set_seg_props(self):
+        super(ReducedMorphology, self).set_seg_props()
+        self.full.set_seg_props()
+        self._map_segments()
+
+    def _map_segments(self):
+        # section and positions on the reduced morphology of the start and end of every full segment
+        full_morph = morphology_cache.get_morphology(self._morphology_file)
+        red_morph, mapping = morphology_cache.get_reduced_morphology(self._morphology_file)
+        full_ids = dict((_section_name(t, i), k) for k, (t, i) in enumerate(zip(full_morph['sec_type'],
+                                                                                full_morph['sec_index'])))
+        red_names = [_section_name(t, i) for t, i in zip(red_morph['sec_type'], red_morph['sec_index'])]
+
+        red_secs = list(self.hobj.all)
+        red_ids = dict((sec.name().split('.')[-1], k) for k, sec in enumerate(red_secs))
+        self._red_nseg = np.array([sec.nseg for sec in red_secs])
+        self._red_ptr = np.concatenate(([0], np.cumsum(self._red_nseg)))
+
+        red_sec, x0, x1, xr0, xr1 = [], [], [], [], []
+        for sec in self.full.hobj.all:
+            name = sec.name().split('.')[-1]
+            k = full_ids.get(name)
+            if k is not None and full_morph['sec_type'][k] in [DEND, APIC]:
+                name = red_names[mapping['section'][k]]
+                pt_arc = morphology_cache.get_pt3d(sec)[:, 4]/sec.L
+                pt_x = mapping['x'][full_morph['pt_ptr'][k]:full_morph['pt_ptr'][k+1]]
+            else:
+                pt_arc, pt_x = [0.0, 1.0], [0.0, 1.0]  # the soma and axon are the same in both morphologies
+
+            if name not in red_ids:
+                name, pt_x = 'soma[0]', [0.5, 0.5]
+
+            seg_x = np.arange(sec.nseg + 1, dtype=float)/sec.nseg
+            seg_xr = np.interp(seg_x, pt_arc, pt_x)
+            red_sec.extend([red_ids[name]]*sec.nseg)
+            x0.extend(seg_x[:-1])
+            x1.extend(seg_x[1:])
+            xr0.extend(seg_xr[:-1])
+            xr1.extend(seg_xr[1:])
+
+        self._seg_red_sec = np.array(red_sec)
+        self._seg_x0, self._seg_x1 = np.array(x0), np.array(x1)
+        self._seg_xr0, self._seg_xr1 = np.array(xr0), np.array(xr1)
+
+        # fraction of each full segment within each reduced segment
+        rows, cols, weights = [], [], []
+        for sec_ix in np.unique(self._seg_red_sec):
+            full_ix = np.flatnonzero(self._seg_red_sec == sec_ix)
+            a = np.minimum(self._seg_xr0[full_ix], self._seg_xr1[full_ix])
+            b = np.maximum(self._seg_xr0[full_ix], self._seg_xr1[full_ix])
+            edges = np.arange(self._red_nseg[sec_ix] + 1, dtype=float)/self._red_nseg[sec_ix]
+            overlap = np.maximum(0, np.minimum(b[:, None], edges[None, 1:]) - np.maximum(a[:, None], edges[None, :-1]))
+            width = b - a
+            point = width <= 0
+            overlap[point] = 0.0
+            overlap[point, np.minimum((a[point]*self._red_nseg[sec_ix]).astype(int), self._red_nseg[sec_ix]-1)] = 1.0
+            width[point] = 1.0
+
+            frac = overlap/width[:, None]
+            full_nz, red_nz = np.nonzero(frac)
+            rows.append(self._red_ptr[sec_ix] + red_nz)
+            cols.append(full_ix[full_nz])
+            weights.append(frac[full_nz, red_nz])
+
+        self._map_rows = np.concatenate(rows)
+        self._map_cols = np.concatenate(cols)
+        self._map_weights = np.concatenate(weights)
+        self.seg_scale = self.map_seg_values(np.ones(self.full.nseg))
+
+    def find_target_segments(self, target_sections, target_distance):
+        """Target segments of the full morphology, see seg_locations"""
+        return self.full.find_target_segments(target_sections, target_distance)
+
+    def seg_locations(self, segs_ix, xs=None):
+        """Reduced segments and positions along their sections of locations on full segments
+
+        :param segs_ix: indexes of full segments
+        :param xs: positions along the full sections, the centers of the segments by default
+        """
+        segs_ix = np.asarray(segs_ix, dtype=np.int64)
+        xs = self.full.seg_prop['x'][segs_ix] if xs is None else np.asarray(xs, dtype=float)
+
+        frac = np.clip((xs - self._seg_x0[segs_ix])/(self._seg_x1[segs_ix] - self._seg_x0[segs_ix]), 0.0, 1.0)
+        xr = self._seg_xr0[segs_ix] + frac*(self._seg_xr1[segs_ix] - self._seg_xr0[segs_ix])
+        red_sec = self._seg_red_sec[segs_ix]
+        nseg = self._red_nseg[red_sec]
+        return self._red_ptr[red_sec] + np.minimum((xr*nseg).astype(np.int64), nseg - 1), xr
+
+    def map_seg_values(self, values):
+        """Densities of the reduced segments with the same total amount as the values of the full segments"""
+        amount = self._map_weights*self.full.seg_prop['area'][self._map_cols]*values[self._map_cols]
+        return np.bincount(self._map_rows, weights=amount, minlength=self.nseg)/self.seg_prop['area']
+
+    def scale_membrane(self, hobj):
+        """Scales the capacitance and conductance densities of every segment of a reduced cell to the area of the full
+        segments mapped onto it (seg_scale)"""
+        for sec, scales in zip(hobj.all, np.split(self.seg_scale, self._red_ptr[1:-1])):
+            for seg, scale in zip(sec, scales):
+                seg.cm *= scale
+                for mech in seg:
+                    for name in _get_conductances(mech.name()):
+                        setattr(seg, name, getattr(seg, name)*scale)
+
+    def impedance_errors(self, freqs):
+        """Relative errors of the impedances of the reduced cell (hobj) against the full cell, the cells must be
+        initialized
+
+        :param freqs: frequencies (Hz) of the test currents
+        :return: list of (freq, error of the input impedance of the soma, mean error of the transfer impedance between
+            the soma and every full segment weighted by its area)
+        """
+        full_secs = [(sec, seg.x) for sec in self.full.hobj.all for seg in sec]
+        red_secs = list(self.hobj.all)
+        red_segs, red_xs = self.seg_locations(np.arange(self.full.nseg))
+        red_sec_ix = np.searchsorted(self._red_ptr, red_segs, side='right') - 1
+        area = self.full.seg_prop['area']
+
+        errors = []
+        for freq in freqs:
+            full_imp = _soma_impedance(self.full.hobj, freq)
+            red_imp = _soma_impedance(self.hobj, freq)
+
+            full_zin = full_imp.input(0.5, sec=self.full.hobj.soma[0])
+            red_zin = red_imp.input(0.5, sec=self.hobj.soma[0])
+            full_tr = np.array([full_imp.transfer(x, sec=sec) for sec, x in full_secs])
+            red_tr = np.array([red_imp.transfer(x, sec=red_secs[k]) for k, x in zip(red_sec_ix, red_xs)])
+
+            tr_error = np.sum(area*np.abs(red_tr/full_tr - 1.0))/np.sum(area)
+            errors.append((freq, red_zin/full_zin - 1.0, tr_error))
+        return errors
+
+    def release_full(self):
+        """Deletes the sections of the full cell, which would otherwise be simulated"""
+        self.full.hobj = None
+
+
+def _section_name(sec_type, sec_index):
+    return '{}[{}]'.format(morphology_cache.SECTION_TYPES[sec_type], sec_index)
+
+
+def _soma_impedance(hobj, freq):
+    imp = h.Impedance()
+    imp.loc(0.5, sec=hobj.soma[0])
+    imp.compute(freq, 1)  # with the linearized active channels
+    return imp
+
+
+def _get_conductances(mech_name):
+    # PARAMETER range variables named as conductance densities, e.g. g_pas, gbar_Ih or gIhbar_Ih
+    if mech_name not in _conductances:
+        names = []
+        ms = h.MechanismStandard(mech_name, 0)
+        name = h.ref('')
+        for i in range(int(ms.count())):
+            ms.name(name, i)
+            if name[0].startswith('g_') or (name[0].startswith('g') and 'bar' in name[0]):
+                names.append(name[0])
+        _conductances[mech_name] = names
+    return _conductances[mech_name]
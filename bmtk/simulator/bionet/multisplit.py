@@ -0,0 +1,285 @@
+# Allen Institute Software License - This software license is the 2-clause BSD license plus clause a third
+# clause that prohibits redistribution for commercial purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the Allen Institute's written permission. For
+# purposes of this license, commercial purposes is the incorporation of the Allen Institute's software into anything for
+# which you will charge fees or other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Splitting of the biophysical cells among the ranks with ParallelContext.multisplit.
+
+The tree of sections of a cell is cut at the nodes where subtrees attach: a cut detaches all the children of a section
+at the same location (x) and every piece touching the node gets the same split id (sid), so NEURON solves the pieces as
+one cell. Starting from the whole cell, the most expensive piece is cut at its root section until every piece costs less
+than the cost of the cell divided by the number of pieces requested, each piece having at most two sids. The pieces of
+all the cells are then distributed among the ranks with the load balance (see load_balance.assign_ranks); a cut is only
+made when the pieces on its two sides are on different ranks. With several threads per rank the pieces are distributed
+among the threads of all the ranks and a cut is also made between pieces on the same rank, so each thread can get its own
+piece (see load_balance.partition_threads).
+
+Every rank with a piece of a cell builds the whole cell, so the segment properties and synapse locations are the same as
+without splitting, then deletes the sections of the other ranks. The rank with the soma owns the gid, its spike detector
+and the variables recorded from the soma; the synapses and the membrane currents of the ECP are on the rank of their
+segment.
+"""
+import numpy as np
+from neuron import h
+
+from bmtk.simulator.bionet import morphology_cache, load_balance
+from bmtk.simulator.bionet.property_schemas import CellTypes
+
+
+pc = h.ParallelContext()  # object to access MPI methods
+
+AXON = morphology_cache.SECTION_TYPES.index('axon')
+
+
+def split_tree(morph, sec_costs, npieces):
+    """Pieces of a cell with a cost of at most 1/npieces of the whole cell, when the tree can be cut that finely
+
+    The axon always stays with the soma.
+
+    :param morph: morphology arrays, see morphology_cache.get_morphology_arrays
+    :param sec_costs: cost of each section
+    :param npieces: number of pieces
+    :return: (piece of each section, cuts) where piece 0 has the soma and each cut is a (section, x, children) tuple
+        of the parent section, the location and the child sections detached from it
+    """
+    parent = morph['parent']
+    nsecs = len(parent)
+    children = [[] for _ in range(nsecs)]
+    for i, p in enumerate(parent):
+        if p >= 0:
+            children[p].append(i)
+
+    roots = [i for i in range(nsecs) if parent[i] < 0]
+    order = []  # sections with the parents before their children
+    stack = list(roots)
+    while stack:
+        sec = stack.pop()
+        order.append(sec)
+        stack.extend(children[sec])
+
+    subtree_costs = np.array(sec_costs, dtype=float)
+    for sec in reversed(order):
+        if parent[sec] >= 0:
+            subtree_costs[parent[sec]] += subtree_costs[sec]
+
+    piece_of = np.zeros(nsecs, dtype=np.int32)
+    pieces = [{'root': roots[0] if roots else -1, 'cost': float(np.sum(sec_costs)), 'nsids': 0}]
+    cuts = []
+    max_cost = pieces[0]['cost']/max(npieces, 1)
+    while True:
+        # locations on the root section of each piece where subtrees can be detached
+        candidates = []
+        for indx, piece in enumerate(pieces):
+            if piece['nsids'] >= 2 or piece['cost'] <= max_cost:
+                continue
+
+            nodes = {}
+            for child in children[piece['root']] if piece['root'] >= 0 else []:
+                # the 0 end of a detached root section already has the sid of its parent
+                if piece_of[child] == indx and morph['sec_type'][child] != AXON and \
+                        (indx == 0 or morph['parent_x'][child] > 0.0):
+                    nodes.setdefault(float(morph['parent_x'][child]), []).append(child)
+            if nodes:
+                candidates.append((piece['cost'], -indx, nodes))
+
+        if not candidates:
+            break
+
+        _, indx, nodes = max(candidates)
+        piece = pieces[-indx]
+        x = max(nodes, key=lambda loc: (sum(subtree_costs[child] for child in nodes[loc]), -loc))
+        for child in nodes[x]:
+            stack = [child]
+            while stack:
+                sec = stack.pop()
+                piece_of[sec] = len(pieces)
+                stack.extend(children[sec])
+            pieces.append({'root': child, 'cost': float(subtree_costs[child]), 'nsids': 1})
+            piece['cost'] -= subtree_costs[child]
+
+        piece['nsids'] += 1
+        cuts.append((piece['root'], x, nodes[x]))
+
+    return piece_of, cuts
+
+
+class CellSplit(object):
+    """Pieces of a cell and the rank of each piece"""
+    def __init__(self, sec_names, piece_of, cuts, piece_costs):
+        """
+        :param sec_names: name of each section of the morphology arrays, e.g. "dend[3]"
+        :param piece_of: piece of each section
+        :param cuts: (section, x, children) of each cut, see split_tree
+        :param piece_costs: cost of each piece
+        """
+        self.sec_names = sec_names
+        self.piece_of = piece_of
+        self.cuts = cuts
+        self.piece_costs = piece_costs
+        self.workers = np.zeros(len(piece_costs), dtype=np.int32)  # rank*nthreads + thread of each piece
+        self.nthreads = 1
+        self.sids = [None]*len(cuts)  # split id of each cut made, the workers and sids are set by assign_pieces
+
+    @property
+    def npieces(self):
+        return len(self.piece_costs)
+
+    @property
+    def ranks(self):
+        """Rank of each piece"""
+        return self.workers//self.nthreads
+
+    @property
+    def owner(self):
+        """Rank of the piece with the soma"""
+        return int(self.ranks[0])
+
+    @property
+    def is_split(self):
+        return len(set(self.workers)) > 1
+
+    def has_piece(self, rank):
+        return rank in self.ranks
+
+    def section_ranks(self):
+        """Rank of each section by name, the sections missing from the morphology arrays (the axon stub of the cell
+        models) are on the rank of the soma"""
+        return dict((name, int(self.ranks[piece])) for name, piece in zip(self.sec_names, self.piece_of))
+
+    def cut_ranks(self, cut):
+        """Ranks of the parent side and of each child of a cut"""
+        sec, _, children = self.cuts[cut]
+        return int(self.ranks[self.piece_of[sec]]), [int(self.ranks[self.piece_of[child]]) for child in children]
+
+    def cut_workers(self, cut):
+        """Workers (rank and thread) of the parent side and of each child of a cut"""
+        sec, _, children = self.cuts[cut]
+        return int(self.workers[self.piece_of[sec]]), [int(self.workers[self.piece_of[child]]) for child in children]
+
+
+def plan_splits(nodes, costs, npieces, dL=20, nseg_rule=None, reduced=False):
+    """Split of each biophysical cell into pieces, see split_tree
+
+    The estimated cost of each cell (including its synapses) is divided among its pieces in proportion to the cost of
+    their segments.
+
+    :param nodes: internal nodes
+    :param costs: cost of each node by gid, see load_balance.estimate_costs
+    :param npieces: number of pieces of each cell
+    :return: dictionary of CellSplit by gid
+    """
+    splits = {}
+    trees = {}  # pieces of each morphology and cell model parameters
+    for node in nodes:
+        if node.cell_type != CellTypes.Biophysical:
+            continue
+
+        key = (node.morphology_file, id(node.model_params))
+        if key not in trees:
+            morph = load_balance.get_morphology(node.morphology_file, reduced)
+            sec_costs = load_balance.section_costs(morph, node.model_params, dL, nseg_rule)
+            piece_of, cuts = split_tree(morph, sec_costs, npieces)
+            piece_costs = np.bincount(piece_of, weights=sec_costs, minlength=piece_of.max() + 1)
+            sec_names = ['{}[{}]'.format(morphology_cache.SECTION_TYPES[t], i)
+                         for t, i in zip(morph['sec_type'], morph['sec_index'])]
+            trees[key] = (sec_names, piece_of, cuts, piece_costs/max(np.sum(piece_costs), 1e-12))
+
+        sec_names, piece_of, cuts, piece_fractions = trees[key]
+        splits[node.node_id] = CellSplit(sec_names, piece_of, cuts, costs[node.node_id]*piece_fractions)
+
+    return splits
+
+
+def assign_pieces(costs, splits, nhost, nthreads=1):
+    """Distribute the cells and the pieces of the split cells among the threads of the ranks
+
+    Sets the worker (rank and thread) of each piece and the split id of each cut between pieces on different workers,
+    numbered in the order of the gids so they are the same on every rank.
+
+    :param costs: cost of each cell by gid
+    :param splits: CellSplit of the biophysical cells by gid, see plan_splits
+    :param nthreads: number of threads of each rank
+    :return: dictionary of the rank of each cell by gid (the rank of the soma for the split cells) and the total cost
+        of each worker
+    """
+    piece_costs = {}
+    for gid, cost in costs.items():
+        if gid in splits:
+            for piece, piece_cost in enumerate(splits[gid].piece_costs):
+                piece_costs[(gid, piece)] = piece_cost
+        else:
+            piece_costs[(gid, 0)] = cost
+
+    piece_workers = load_balance.assign_ranks(piece_costs, nhost*nthreads)
+    sid = 0
+    for gid in sorted(splits):
+        split = splits[gid]
+        split.workers = np.array([piece_workers[(gid, piece)] for piece in range(split.npieces)], dtype=np.int32)
+        split.nthreads = nthreads
+        for cut in range(len(split.cuts)):
+            parent_worker, child_workers = split.cut_workers(cut)
+            if any(w != parent_worker for w in child_workers):
+                split.sids[cut] = sid
+                sid += 1
+
+    node_ranks = dict((gid, piece_workers[(gid, 0)]//nthreads) for gid in costs)
+    return node_ranks, load_balance.rank_loads(piece_costs, piece_workers, nhost*nthreads)
+
+
+def split_hobj(hobj, split, rank):
+    """Delete the sections of hobj on the other ranks and join the pieces left with pc.multisplit
+
+    pc.multisplit() still has to be called, on every rank, once all the cells are split.
+
+    :return: boolean array of the sections of hobj.all kept on this rank, in the order of hobj.all
+    """
+    sec_ranks = split.section_ranks()
+    owner = split.owner
+    secs = list(hobj.all)
+    kept = np.array([sec_ranks.get(sec.name().split('.')[-1], owner) == rank for sec in secs], dtype=bool)
+    secs_by_name = dict((sec.name().split('.')[-1], sec) for sec in secs)
+
+    for cut, (sec_ix, x, children) in enumerate(split.cuts):
+        sid = split.sids[cut]
+        if sid is None:
+            continue  # all the pieces of the cut are on the same worker
+
+        # every child is detached, also from a parent on the same rank, so no piece gets more sids than planned
+        parent_rank, child_ranks = split.cut_ranks(cut)
+        for child_ix, child_rank in zip(children, child_ranks):
+            if child_rank == rank:
+                child = secs_by_name[split.sec_names[child_ix]]
+                h.disconnect(sec=child)
+                pc.multisplit(0.0, sid, sec=child)
+
+        if parent_rank == rank:
+            pc.multisplit(x, sid, sec=secs_by_name[split.sec_names[sec_ix]])
+
+    for sec, keep in zip(secs, kept):
+        if not keep:
+            h.delete_section(sec=sec)
+
+    return kept
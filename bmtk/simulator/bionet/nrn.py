@@ -34,6 +34,7 @@ from neuron import h
 from bmtk.simulator.bionet.pyfunction_cache import py_modules
 from bmtk.simulator.bionet.pyfunction_cache import load_py_modules
 from bmtk.simulator.bionet.pyfunction_cache import synapse_model, synaptic_weight, cell_model
+from bmtk.simulator.bionet import morphology_cache
 
 
 pc = h.ParallelContext()
@@ -63,6 +64,7 @@ def load_neuron_modules(conf, **cm):
 
     neuron.load_mechanisms(str(conf["components"]["mechanisms_dir"]))
     load_templates(conf["components"]["templates_dir"])
+    morphology_cache.set_cache_dir(conf["run"].get("morphology_cache", None))
 
 
 def load_templates(template_dir):
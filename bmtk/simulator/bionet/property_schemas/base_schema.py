@@ -25,6 +25,8 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
+
 from bmtk.simulator.bionet import nrn
 
 class CellTypes:
@@ -66,7 +68,7 @@ class PropertySchema(object):
     def get_edge_weight(self, src_node, trg_node, edge):
         raise NotImplementedError()
 
-    def preselected_targets(self):
+    def preselected_targets(self, edge):
         raise NotImplementedError()
 
     def target_sections(self, edge):
@@ -78,6 +80,15 @@ class PropertySchema(object):
     def nsyns(self, edge):
         raise NotImplementedError()
 
+    def get_edges_weights(self, trg_node, edges):
+        """Weights of a group of edges with the same edge type (see SimEdgeGroup), one edge at a time by default"""
+        return np.array([self.get_edge_weight(src_node, trg_node, edge) for src_node, edge in edges.edges()],
+                        dtype=float)
+
+    def edges_nsyns(self, edges):
+        """Number of synapses of each edge of a group of edges with the same edge type"""
+        return np.array([self.nsyns(edge) for _, edge in edges.edges()], dtype=np.int64)
+
     def load_synapse_obj(self, edge, section_x, section_id):
         synapse_fnc = nrn.py_modules.synapse_model(edge['set_params_function'])
         return synapse_fnc(edge['dynamics_params'], section_x, section_id)
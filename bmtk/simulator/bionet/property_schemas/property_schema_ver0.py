@@ -61,8 +61,9 @@ class PropertySchema(BaseSchema):
         weight_fnc = nrn.py_modules.synaptic_weight(edge['weight_function'])
         return weight_fnc(trg_node, src_node, edge)
 
-    def preselected_targets(self):
-        return False
+    def preselected_targets(self, edge):
+        # synapse locations placed when the network was built (see bmtk.builder.synapse_locations)
+        return 'sec_id' in edge and 'sec_x' in edge
 
     def target_sections(self, edge):
         try:
@@ -84,6 +85,11 @@ class PropertySchema(BaseSchema):
             return edge['nsyns']
         return 1
 
+    def edges_nsyns(self, edges):
+        if 'nsyns' in edges:
+            return np.asarray(edges.column('nsyns'), dtype=np.int64)
+        return np.ones(len(edges), dtype=np.int64)
+
     def get_params_column(self):
         return 'params_file'
 
@@ -25,6 +25,8 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
+
 from .. import nrn
 from base_schema import CellTypes, PropertySchema as BaseSchema
 
@@ -57,7 +59,10 @@ class PropertySchema(BaseSchema):
         #weight_fnc = nrn.py_modules.synaptic_weight(edge['syn_weight'])
         #return weight_fnc(trg_node, src_node, edge)
 
-    def preselected_targets(self):
+    def get_edges_weights(self, trg_node, edges):
+        return np.asarray(edges.column('syn_weight'), dtype=float)
+
+    def preselected_targets(self, edge):
         return True
 
     def target_sections(self, edge):
@@ -75,6 +80,11 @@ class PropertySchema(BaseSchema):
             return edge['nsyns']
         return 1
 
+    def edges_nsyns(self, edges):
+        if 'nsyns' in edges:
+            return np.asarray(edges.column('nsyns'), dtype=np.int64)
+        return np.ones(len(edges), dtype=np.int64)
+
     def get_params_column(self):
         return 'dynamics_params'
 
@@ -44,6 +44,9 @@ class RecXElectrode(object):
         self.nsites = self.pos.shape[1]
         self.conf['run']['nsites'] = self.nsites  # add to the config
         self.transfer_resistances = {}   # V_e = transfer_resistance*Im
+        self.tr_gids = []   # cells whose membrane currents are side by side in the columns passed to calc_ecp
+        self.tr_offsets = {}   # gid --> (first, last+1) column of the cell
+        self.nseg_total = 0   # number of columns of all the cells
 
     def drift(self):
         # will include function to model electrode drift
@@ -52,6 +55,34 @@ class RecXElectrode(object):
     def get_transfer_resistance(self, gid):
         return self.transfer_resistances[gid]
     
+    def set_im_columns(self, gids):
+        """Place the membrane currents of the cells side by side in the order of gids, see calc_ecp"""
+        col = 0
+        self.tr_gids = list(gids)
+        self.tr_offsets = {}
+        for gid in self.tr_gids:
+            nseg = self.transfer_resistances[gid].shape[1]
+            self.tr_offsets[gid] = (col, col + nseg)
+            col += nseg
+        self.nseg_total = col
+
+    def calc_ecp(self, im):
+        """ECP summed over all the cells from the membrane currents im with shape (nsteps, nseg_total)
+
+        The cells are added one at a time in the order of set_im_columns, as the ECP of each time step was summed
+        over the cells, so the result is exactly the sum of calc_cell_ecp. The product of a cell over all the time
+        steps agrees with the products of the single time steps only to rounding.
+        """
+        ecp = np.zeros((im.shape[0], self.nsites))
+        for gid in self.tr_gids:
+            ecp += self.calc_cell_ecp(gid, im)
+        return ecp
+
+    def calc_cell_ecp(self, gid, im):
+        """ECP from a single cell, im has the same columns as in calc_ecp"""
+        col0, col1 = self.tr_offsets[gid]
+        return np.dot(im[:, col0:col1], self.transfer_resistances[gid].T)
+
     def calc_transfer_resistance(self, gid, seg_coords):
         """Precompute mapping from segment to electrode locations"""
         sigma = 0.3  # mS/mm
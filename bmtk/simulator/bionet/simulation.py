@@ -27,6 +27,8 @@
 #
 import os
 import time
+import json
+import hashlib
 from neuron import h
 import numpy as np
 from bmtk.simulator.bionet import io
@@ -51,10 +53,21 @@ class Simulation(object):
         self.conf = conf
 
         self.gids = {'save_cell_vars': self.net.saved_gids, 
-                     'biophysical': self.net.biopyhys_gids}
+                     'biophysical': self.net.biopyhys_gids,
+                     'ecp': self.net.biopyhys_gids + self.net.piece_gids}  # also the pieces of cells split with multisplit
         #self.gids = self.net.graph.gids_on_rank   # returns dictionary of gid groups
 
-        self._start_from_state = False
+        self._start_from_state = self.conf["run"].get("start_from_state", False)
+        self._save_state = self.conf["run"].get("save_state", False)
+        self._steady_state_cache = self.conf["run"].get("steady_state_cache", None)
+        self._initialized = False  # set when the simulation was initialized before run, continues with h.continuerun
+        self._vector_recording = self.conf["run"].get("recording_mode", "callback") == "vector"
+
+        # With background_output the writer process is forked here, before the output files are opened and the data
+        # blocks are allocated. It is forked after MPI was initialized, see io.BlockWriter for the MPI stacks that do
+        # not support it.
+        nblocks = self.conf["run"].get("output_buffers", 2)
+        self.writer = io.BlockWriter(self.conf, self.conf["run"].get("background_output", False), nblocks-1)
 
         h.dt = self.conf["run"]["dt"]
         h.tstop = self.conf["run"]["tstop"]
@@ -82,12 +95,7 @@ class Simulation(object):
         self.tstep = int(round(h.t/h.dt))
         self.tstep_start_block = self.tstep
 
-        if self._start_from_state==True:
-            io.read_state()
-            io.print2log0('Read the initial state saved at t_sim: %.2f ms' %(h.t))
-
-        else:
-            h.v_init = self.conf["conditions"]["v_init"]
+        h.v_init = self.conf["conditions"]["v_init"]
 
         h.celsius = self.conf["conditions"]["celsius"]
 
@@ -105,9 +113,13 @@ class Simulation(object):
             self.set_ecp_recording()
 
         if not(self._start_from_state): # if starting from a new initial state
-            io.create_output_files(self.conf, self.gids)
+            nsegs = {gid: self.net.cells[gid].nseg for gid in self.gids['biophysical']}
+            io.create_output_files(self.conf, self.gids, nsegs)
         else:
-            io.extend_output_files(self.gids)
+            io.extend_output_files(self.conf, self.gids)
+
+        if self.conf["run"]["save_cell_vars"]:
+            self.set_cell_vars_recording()
 
         self.create_data_block()
         self.set_spike_recording()
@@ -125,20 +137,38 @@ class Simulation(object):
 
         self.rel = RecXElectrode(self.conf)
         
-        for gid in self.gids['biophysical']:
+        for gid in self.gids['ecp']:
             cell = self.net.cells[gid]
             self.rel.calc_transfer_resistance(gid, cell.get_seg_coords())
+        self.rel.set_im_columns(self.gids['ecp'])
         
         h.cvode.use_fast_imem(1)   # make i_membrane_ a range variable
-        self.fih1 = h.FInitializeHandler(0, self.set_pointers)
-
-    def attach_current_clamp(self):
+        if self._vector_recording:
+            for gid in self.gids['ecp']:
+                self.net.cells[gid].set_im_record(self.conf['run']['nsteps_block'])
+        else:
+            self.fih1 = h.FInitializeHandler(0, self.set_pointers)
 
+    def set_cell_vars_recording(self):
+        '''
+        Bind pointers to the variables saved from every segment of the biophysical cells
+        '''
+        self._save_vars_gids = sorted(set(self.gids['save_cell_vars']) & set(self.gids['biophysical']))
+        for gid in self._save_vars_gids:
+            if self._vector_recording:
+                self.net.cells[gid].set_vars_record(self.conf["run"]["save_cell_vars"], self.conf['run']['nsteps_block'])
+            else:
+                self.net.cells[gid].set_vars_ptr(self.conf["run"]["save_cell_vars"])
+
+    def attach_current_clamp(self, protocol=None):
+        '''
+        Attach a current clamp to the soma of every biophysical cell, with the protocol of conf["iclamp"] by default
+        '''
         #self.Ic = IClamp(self.conf)
         #self.Ic.attach_current(self.net.cells[0])
         for gid in self.gids['biophysical']:
             cell = self.net.cells[gid]
-            Ic = IClamp(self.conf)
+            Ic = IClamp(self.conf, protocol)
             Ic.attach_current(cell)
             self._iclamps.append(Ic)
 
@@ -154,46 +184,62 @@ class Simulation(object):
     def create_data_block(self):
 
         '''
-        Create block in memory to store ouputs from each time step
+        Create a block in memory to store ouputs from each time step.
+        When writing in the background the data of up to output_buffers-1 saved blocks is being written to disk while
+        the block is filled again
         '''
+        self.data_block = self._new_data_block()
+
+    def _new_data_block(self):
         nt_block = self.conf['run']['nsteps_block']
             
-        self.data_block = {}
-        self.data_block["tsave"] = round(h.t,3)
+        data_block = {}
+        data_block["tsave"] = round(h.t,3)
         
         if self.conf["run"]['calc_ecp']:
             nsites = self.rel.nsites
-            self.data_block['ecp'] = np.empty((nt_block,nsites))
+            data_block['ecp'] = np.zeros((nt_block,nsites))
+            data_block['im'] = np.zeros((nt_block,self.rel.nseg_total))  # i_membrane_ of all segments, columns as in rel.set_im_columns
 
-        self.data_block['cells'] = {}
+        data_block['cells'] = {}
 
         if self.conf["run"]["save_cell_vars"]:
 
             for gid in self.gids["save_cell_vars"]:   # only includes gids on this rank
 
-                self.data_block['cells'][gid] = {}        
+                data_block['cells'][gid] = {}        
+                nseg = self.net.cells[gid].nseg if gid in self.gids['biophysical'] else 0
                 for var in self.conf["run"]["save_cell_vars"]:
-                    self.data_block['cells'][gid][var] = np.zeros(nt_block)
-                    self.data_block['cells'][gid][var+"_all_segs"] = []
+                    data_block['cells'][gid][var] = np.zeros(nt_block)
+                    data_block['cells'][gid][var+"_all_segs"] = np.zeros((nt_block, nseg))
 
                 if self.conf["run"]["calc_ecp"] and gid in self.gids['biophysical']: # then also create a dataset for the ecp
-                    self.data_block['cells'][gid]['ecp'] = np.empty((nt_block,nsites))   # for extracellular potential
+                    data_block['cells'][gid]['ecp'] = np.empty((nt_block,nsites))   # for extracellular potential
+
+        return data_block
 
 
     def set_spike_recording(self):
         '''
-        Set dictionary of hocVectors for spike recordings
+        Record the spikes of all the cells on this rank into a single pair of hocVectors
         '''
+        self._spike_tvec = h.Vector()
+        self._spike_gidvec = h.Vector()
+        pc.spike_record(-1, self._spike_tvec, self._spike_gidvec)
 
-        spikes = {}
 
-        for gid in self.net.cells:
-            tVec = h.Vector()
-            gidVec = h.Vector()
-            pc.spike_record(gid,tVec,gidVec)
-            spikes[gid] = tVec
-            
-        self.data_block["spikes"] = spikes
+    def get_block_spikes(self):
+        '''
+        Returns the spikes recorded since the last call as a pair of (time, gid) arrays sorted by time
+        and empties the spike recording vectors
+        '''
+        times = np.array(self._spike_tvec)
+        gids = np.array(self._spike_gidvec).astype(np.int32)
+        self._spike_tvec.resize(0)
+        self._spike_gidvec.resize(0)
+
+        order = np.lexsort((gids, times))
+        return times[order], gids[order]
 
 
     def __elapsed_time(self, time_s):
@@ -212,7 +258,7 @@ class Simulation(object):
         '''
         Run the simulation: 
         if beginning from a blank state, then will use h.run(),
-        if continuing from the saved state, then will use h.continuerun() 
+        if continuing from the saved state or from the steady state, then will use h.continuerun() 
         
         '''
         self.start_time = h.startsw()
@@ -220,15 +266,24 @@ class Simulation(object):
         pc.timeout(0) #
          
         pc.barrier() # wait for all hosts to get to this point
+        if self._start_from_state:
+            self.restore_state()
+        elif self._steady_state_cache is not None:
+            self.init_steady_state()
+
         io.print2log0('Running simulation until tstop: %.3f ms with the time step %.3f ms' %(self.conf["run"]['tstop'],self.conf["run"]['dt']))
 
         io.print2log0('Starting timestep: %d at t_sim: %.3f ms' %(self.tstep,h.t))
         io.print2log0('Block save every %d steps' % (self.conf["run"]['nsteps_block']))
 
-        if self._start_from_state:
+        if self._vector_recording:
+            self.run_blocks()
+        elif self._initialized:
             h.continuerun(h.tstop)
         else:
             h.run(h.tstop)        # <- runs simuation: works in parallel
+
+        self.writer.close()  # wait for the blocks still being written
                     
         pc.barrier() #
 
@@ -237,6 +292,10 @@ class Simulation(object):
         sim_time = self.__elapsed_time(end_time - s_time)
         io.print2log0now('Simulation completed in {} '.format(sim_time))
 
+        if self.net.load_balance.get('save_costs') is not None:
+            # measured costs of the cells for the load balance of the next runs
+            self.net.save_costs(self.net.load_balance['save_costs'], pc.step_time())
+
         
     def report_load_balance(self):
 
@@ -256,7 +315,9 @@ class Simulation(object):
         '''
         Runs after every execution of fadvance (see advance.hoc)
         Called after every time step to perform computation and save data to memory block or to disk.
-        The initial condition tstep=0 is not being saved 
+        The initial condition tstep=0 is not being saved
+        With several threads (run/nthreads) fadvance returns once every thread finished the step, so the PtrVector
+        gathers read a consistent state; the pointers are updated by their callbacks when the threads move the data
         '''
 
 
@@ -267,18 +328,218 @@ class Simulation(object):
         self.save_data_to_block(tstep_block)
 
         if (self.tstep % self.conf["run"]["nsteps_block"]==0) or self.tstep==self.nsteps: 
+            self.save_block()
 
-            io.print2log0('    step:%d t_sim:%.3f ms' %(self.tstep,h.t))
-            self.tstep_end_block = self.tstep
-           
-            time_step_interval = (self.tstep_start_block,self.tstep_end_block)
-            io.save_block_to_disk(self.conf,self.data_block,time_step_interval)  # block save data
+    def run_sweeps(self, protocols, file_name, var_names=None):
+        '''
+        Run the built network once for each current clamp protocol, reinitializing it with h.finitialize (or the
+        steady state cache) between sweeps, and save each sweep in its own group of file_name (see io.save_sweep).
+        protocols is a list of IClamp protocols, a step or a waveform, each with an optional "tstop" (ms).
+        The variables in var_names (by default run/save_cell_vars or ["v"]) are recorded from the soma of the
+        save_cell_vars gids, or of all the biophysical gids when none are selected.
+        '''
+        var_names = var_names or self.conf["run"].get("save_cell_vars") or ["v"]
+        gids = [gid for gid in self.gids['biophysical'] if gid in self.gids['save_cell_vars']] or self.gids['biophysical']
+        if not hasattr(self, '_spike_tvec'):
             self.set_spike_recording()
 
-            self.tstep_start_block = self.tstep   # starting point for the next block
+        tvec = h.Vector()
+        tvec.record(h._ref_t)
+        traces = {}
+        for gid in gids:
+            soma = self.net.cells[gid].hobj.soma[0]
+            traces[gid] = {}
+            for var in var_names:
+                traces[gid][var] = h.Vector()
+                traces[gid][var].record(getattr(soma(0.5), '_ref_' + var), sec=soma)
+
+        pc.timeout(0)
+        for isweep, protocol in enumerate(protocols):
+            self._iclamps = []  # the clamps of the previous sweep are deleted
+            self.attach_current_clamp(protocol)
+
+            if self._steady_state_cache is not None:
+                self.init_steady_state()
+            else:
+                h.finitialize(self.conf["conditions"]["v_init"])
+            self.get_block_spikes()  # empty the spike vectors
+
+            tstop = protocol.get("tstop", self.conf["run"]["tstop"])
+            pc.psolve(tstop)
+
+            sweep_traces = dict((gid, dict((var, np.array(vec)) for var, vec in gid_traces.items()))
+                                for gid, gid_traces in traces.items())
+            io.save_sweep(file_name, 'sweep_%d' % isweep, protocol, np.array(tvec), sweep_traces,
+                          self.get_block_spikes())
+            io.print2log0('    sweep %d of %d done, t_sim: %.3f ms' % (isweep+1, len(protocols), h.t))
 
-#            if self.conf["run"]["save_state"]:    
-#                io.save_state()
+        self._iclamps = []
+
+    def run_blocks(self):
+        '''
+        Run the simulation one block at a time without calling back into python on every time step.
+        The variables are recorded by NEURON with Vector.record and moved into the data block at the end of each block
+        '''
+        if not self._initialized:
+            h.stdinit()
+        self.clear_recordings()  # the initial condition tstep=0 is not being saved
+
+        nsteps_block = self.conf["run"]["nsteps_block"]
+        while self.tstep < self.nsteps:
+            tstep_end_block = min((self.tstep//nsteps_block + 1)*nsteps_block, self.nsteps)
+            pc.psolve(tstep_end_block*h.dt)
+            self.tstep = int(round(h.t/h.dt))
+
+            self.save_recordings_to_block(self.tstep - self.tstep_start_block)
+            self.clear_recordings()
+            self.save_block()
+
+    def save_block(self):
+        '''
+        Save the data block to disk and start a new block
+        '''
+        io.print2log0('    step:%d t_sim:%.3f ms' %(self.tstep,h.t))
+        self.tstep_end_block = self.tstep
+
+        if self.conf["run"]["calc_ecp"]:
+            self.calc_ecp_block(self.tstep_end_block - self.tstep_start_block)
+
+        self.data_block["spikes"] = self.get_block_spikes()
+
+        time_step_interval = (self.tstep_start_block,self.tstep_end_block)
+        self.writer.save_block(self.data_block, time_step_interval)  # block save data, waits if the writer falls behind
+
+        self.tstep_start_block = self.tstep   # starting point for the next block
+
+        if self._save_state:
+            self.writer.wait()  # the output files must be complete up to the saved state
+            io.save_state(self.conf, self.tstep)
+
+    def restore_state(self):
+        '''
+        Initialize the simulation and restore the state saved in output/state_dir.
+        The state is read once the recordings are set since SaveState requires the same point processes as when it was saved
+        '''
+        h.stdinit()
+        io.read_state(self.conf)
+        self.tstep = int(round(h.t/h.dt))
+        self.tstep_start_block = self.tstep
+        self._initialized = True
+        io.print2log0('Read the initial state saved at t_sim: %.2f ms' %(h.t))
+
+    def init_steady_state(self):
+        '''
+        Initialize the cells to their steady state at v_init and celsius instead of relaxing from v_init during the run.
+        The steady state is found once by integrating with a very large time step and saved in run/steady_state_cache,
+        later runs of the same model restore it from there.
+        '''
+        cache_dir = self._steady_state_cache
+        if int(pc.id()) == 0 and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        pc.barrier()
+
+        h.stdinit()
+        state_file = os.path.join(cache_dir, 'steady_state_{}'.format(self._steady_state_key()))
+        if os.path.exists(state_file):
+            io.read_steady_state(state_file)
+            h.fcurrent()
+            io.print2log0('Restored the steady state from %s' % cache_dir)
+        else:
+            self._integrate_to_steady_state()
+            h.fcurrent()
+            io.save_steady_state(state_file)
+            io.print2log0('Saved the steady state to %s' % cache_dir)
+
+        self._spike_tvec.resize(0)  # drop the spikes fired while relaxing to the steady state
+        self._spike_gidvec.resize(0)
+        self._initialized = True
+
+    def _integrate_to_steady_state(self):
+        # fully implicit steps of 1e9 ms from t = -1e10 ms, the stimuli and events start at t >= 0
+        dt = h.dt
+        cvode_active = h.cvode.active()
+        if cvode_active:
+            h.cvode.active(0)
+
+        h.t = -1e10
+        h.dt = 1e9
+        while h.t < -1e9:
+            h.fadvance()
+
+        h.dt = dt
+        if cvode_active:
+            h.cvode.active(1)
+        h.t = 0.0
+
+    def _steady_state_key(self):
+        '''
+        Hash of the parameters, morphologies and conditions the steady state of the cells on this rank depends on
+        '''
+        file_hashes = {}
+
+        def file_hash(file_name):
+            if file_name not in file_hashes:
+                with open(file_name, 'rb') as f:
+                    file_hashes[file_name] = hashlib.sha1(f.read()).hexdigest()
+            return file_hashes[file_name]
+
+        cells = []
+        for gid in sorted(self.net.cells):
+            node = self.net.cells[gid]._node
+            model_params = getattr(node, 'model_params', None)
+            morphology_file = getattr(node, 'morphology_file', None)
+            if isinstance(model_params, basestring) and os.path.isfile(model_params):
+                model_params = file_hash(model_params)
+            if morphology_file is not None and os.path.isfile(morphology_file):
+                morphology_file = file_hash(morphology_file)
+            cells.append([gid, model_params, morphology_file])
+
+        description = {'cells': cells,
+                       'dL': self.conf["run"].get("dL"),
+                       'morphology_reduction': self.conf["run"].get("morphology_reduction", False),
+                       'celsius': self.conf["conditions"]["celsius"],
+                       'v_init': self.conf["conditions"]["v_init"],
+                       'nseg': [sec.nseg for sec in h.allsec()],
+                       'netcons': int(h.List('NetCon').count()),
+                       'rank': int(pc.id()),
+                       'nhost': int(pc.nhost())}
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def calc_ecp_block(self, nsteps):
+        '''
+        Compute the ECP of all the cells from the membrane currents saved during the last nsteps of the block
+        '''
+        im = self.data_block['im'][0:nsteps, :]
+        self.data_block['ecp'][0:nsteps, :] = self.rel.calc_ecp(im)
+
+        if self.conf['run']['save_cell_vars']:
+            for gid in self.gids['save_cell_vars']:
+                if gid in self.rel.tr_offsets:
+                    self.data_block['cells'][gid]['ecp'][0:nsteps, :] = self.rel.calc_cell_ecp(gid, im)
+
+    def clear_recordings(self):
+        for gid in self.gids['ecp']:
+            self.net.cells[gid].clear_recordings()
+
+    def save_recordings_to_block(self, nsteps):
+        '''
+        Copy the variables recorded with Vector.record during the last nsteps into the memory block
+        '''
+        self.data_block["tsave"] = round(h.t,3)
+
+        if self.conf["run"]["calc_ecp"]:
+            for gid in self.gids['ecp']:
+                col0, col1 = self.rel.tr_offsets[gid]
+                self.data_block['im'][0:nsteps, col0:col1] = self.net.cells[gid].get_recorded_im()
+
+        if self.conf['run']['save_cell_vars']:
+            for gid in self._save_vars_gids:
+                cell_data_block = self.data_block['cells'][gid]
+                cell_vars = self.net.cells[gid].get_recorded_vars()  # (nvars, nsteps, nseg+1)
+
+                for ivar, var in enumerate(self.conf['run']['save_cell_vars']):
+                    cell_data_block[var][0:nsteps] = cell_vars[ivar, :, 0]
+                    cell_data_block[var+"_all_segs"][0:nsteps, :] = cell_vars[ivar, :, 1:]
 
 
 
@@ -292,39 +553,21 @@ class Simulation(object):
 
         self.data_block["tsave"] = round(h.t,3)
 
-#    compute and save the ECP         
+#    save the membrane currents, the ECP is computed at the end of the block
         if self.conf["run"]["calc_ecp"]:
- 
-            for gid in self.gids['biophysical']: # compute ecp only from the biophysical cells
-                 
-                cell = self.net.cells[gid]    
-                im = cell.get_im()
-                tr = self.rel.get_transfer_resistance(gid)
-                ecp = np.dot(tr,im)
-     
-                if self.conf['run']['save_cell_vars'] and gid in self.gids['save_cell_vars'] :
-                    cell_data_block = self.data_block['cells'][gid] 
-                    cell_data_block['ecp'][tstep_block-1,:] = ecp
-      
-                self.data_block['ecp'][tstep_block-1,:] += ecp
+            im_block = self.data_block['im']
+            for gid in self.gids['ecp']:
+                col0, col1 = self.rel.tr_offsets[gid]
+                im_block[tstep_block-1, col0:col1] = self.net.cells[gid].get_im()
 
 #    save to block the intracellular variables
         if self.conf['run']['save_cell_vars']:
-            for gid in list(set(self.gids['save_cell_vars'])&set(self.gids['biophysical'])):
+            save_vars = self.conf['run']['save_cell_vars']
+            for gid in self._save_vars_gids:
                  
                 cell_data_block = self.data_block['cells'][gid] 
-                cell = self.net.cells[gid] 
+                cell_vars = self.net.cells[gid].get_vars()  # (nvars, nseg+1) with the soma in the first column
 
-                for var in self.conf['run']['save_cell_vars']:
-                    cell_data_block[var][tstep_block-1] = getattr(cell.hobj.soma[0](0.5),var)   # subtract 1 because indexes start at 0 while the time step starts at 1
-                    
-                    v_sec = []
-                    for sec in cell.hobj.all:
-                        for seg in sec:
-                            x=seg.x
-                            v_sec.append(getattr(sec(x),var))
-
-                    cell_data_block[var+"_all_segs"].append(np.array(v_sec))
-                    
-                    
-                    
\ No newline at end of file
+                for ivar, var in enumerate(save_vars):
+                    cell_data_block[var][tstep_block-1] = cell_vars[ivar, 0]   # subtract 1 because indexes start at 0 while the time step starts at 1
+                    cell_data_block[var+"_all_segs"][tstep_block-1, :] = cell_vars[ivar, 1:]
@@ -48,6 +48,61 @@ def rotation_matrix(axis, theta):
                      [2*(bd+ac), 2*(cd-ab), aa+dd-bb-cc]])
 
 
+def calc_nseg(sec, dL, nseg_rule='dL', d_lambda=0.1, d_lambda_freq=100.0, max_nseg=None):
+    """Number of segments of a section, always odd so there is a node in the middle of the section
+
+    :param sec: NEURON section, with Ra and cm already set when using the d_lambda rule
+    :param dL: maximum length of a segment for the "dL" rule
+    :param nseg_rule: "dL" to split the section in segments of at most dL, or "d_lambda" to make the segments at most a
+        fraction d_lambda of the length constant of the section at d_lambda_freq (Hz), see the d_lambda rule of the
+        NEURON book (Hines and Carnevale)
+    :param d_lambda: maximum length of a segment as a fraction of the length constant, for the "d_lambda" rule
+    :param d_lambda_freq: frequency (Hz) of the length constant, for the "d_lambda" rule
+    :param max_nseg: maximum number of segments of the sections of each type, e.g. {"soma": 1, "axon": 3}
+    :return: number of segments
+    """
+    lam = lambda_f(sec, d_lambda_freq) if nseg_rule == 'd_lambda' else None
+    return nseg_of_length(sec.L, sec.name().split('.')[-1][:4], dL, nseg_rule, d_lambda, lam, max_nseg)
+
+
+def nseg_of_length(L, sec_type, dL, nseg_rule='dL', d_lambda=0.1, lam=None, max_nseg=None):
+    """Number of segments of a section of length L (um) and type sec_type ("soma", "dend", ...), see calc_nseg
+
+    :param lam: length constant (um) of the section, for the "d_lambda" rule
+    """
+    if nseg_rule == 'd_lambda':
+        nseg = int((L/(d_lambda*lam) + 0.9)/2)*2 + 1
+    else:
+        nseg = 1 + 2*int(L/(2*dL))
+
+    if max_nseg is not None and sec_type in max_nseg:
+        nseg = min(nseg, max(1, max_nseg[sec_type] - (1 - max_nseg[sec_type] % 2)))  # largest odd number allowed
+
+    return nseg
+
+
+def lambda_f(sec, freq):
+    """Length constant (um) of a section at a frequency (Hz), from the 3d points when the diameter is not uniform"""
+    n3d = int(h.n3d(sec=sec))
+    if n3d < 2:
+        return 1e5*math.sqrt(sec.diam/(4*math.pi*freq*sec.Ra*sec.cm))
+
+    arc = np.array([h.arc3d(i, sec=sec) for i in range(n3d)])
+    diam = np.array([h.diam3d(i, sec=sec) for i in range(n3d)])
+    return lambda_pts(arc, diam, sec.Ra, sec.cm, freq)
+
+
+def lambda_pts(arc, diam, Ra, cm, freq):
+    """Length constant (um) at a frequency (Hz) of a section with the arc lengths (um) and diameters (um) of its 3d
+    points, the length averaged over the points so thin parts of the section count more"""
+    lam = np.sum(np.diff(arc)/np.sqrt(diam[:-1] + diam[1:]))
+    if lam <= 0:
+        return 1e5*math.sqrt(np.mean(diam)/(4*math.pi*freq*Ra*cm))
+
+    lam *= math.sqrt(2)*1e-5*math.sqrt(4*math.pi*freq*Ra*cm)
+    return (arc[-1] - arc[0])/lam
+
+
 ##################################################
 # TODO: Move these functions to default_setters
 ##################################################
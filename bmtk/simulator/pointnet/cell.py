@@ -25,6 +25,7 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
 import nest
 
 
@@ -76,16 +77,18 @@ class NestCell(Cell):
     def set_spike_detector(self, spike_detector):
         nest.Connect(self._nest_id_list, spike_detector)
 
-    def set_synaptic_connection(self, src_cell, trg_cell, edge_props):
-        src_id = src_cell.nest_id_list
-        trg_id = self.nest_id_list
-        syn_model = edge_props['synapse_model']
-        syn_dict = edge_props['dynamics_params']
-        syn_dict['delay'] = edge_props.delay  # TODO: delay may be in the dynamic params
-        syn_dict['weight'] = edge_props.weight(src_cell._node_params, trg_cell._node_params)
+    def set_synaptic_connections(self, src_cells, edges):
+        """Connects the sources of a group of edges with the same edge type (see SimEdgeGroup) with one call to NEST
 
-        # TODO: don't build the rule every time
-        nest.Connect(src_id, trg_id, {'rule': 'all_to_all'}, syn_dict)
+        :param src_cells: table of the cells of the source network
+        :param edges: the edges onto the cell
+        """
+        src_ids = [src_cells[src_gid].nest_id for src_gid in edges.source_gids.tolist()]
+        syn_dict = dict(edges.edge['dynamics_params'])
+        syn_dict['delay'] = np.asarray(edges.column('delay'), dtype=float)  # TODO: delay may be in the dynamic params
+        syn_dict['weight'] = edges.weights(self._node_params)
+
+        nest.Connect(src_ids, [self.nest_id]*len(src_ids), {'rule': 'one_to_one'}, syn_dict)
 
 
 class VirtualCell(Cell):
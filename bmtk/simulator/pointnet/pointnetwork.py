@@ -148,10 +148,10 @@ class PointNetwork(object):
     def set_recurrent_connections(self):
         """Creates recurrent (internal) connections"""
         for src_network in self._graph.internal_networks():
-            for trg_gid, trg_cell in self._internal_cells.items():
-                for _, src_prop, edge_prop in self._graph.edges_iterator(trg_gid, src_network):
-                    src_cell = self._internal_cells[src_prop.node_id]
-                    trg_cell.set_synaptic_connection(src_cell, trg_cell, edge_prop)
+            for trg_prop, edge_groups in self._graph.target_edges(self._internal_cells.keys(), src_network):
+                trg_cell = self._internal_cells[trg_prop.node_id]
+                for edges in edge_groups:
+                    trg_cell.set_synaptic_connections(self._internal_cells, edges)
 
     def set_external_connections(self, source_network):
         """Connect virtual nodes of an external network onto the internal network.
@@ -159,10 +159,11 @@ class PointNetwork(object):
         :param source_network: Name of external network that targets internal nodes.
         """
         # for every internal target get source nodes and edges that connect to it create a NEST connection.
-        for trg_gid, trg_cell in self._internal_cells.items():
-            for _, src_prop, edge_prop in self._graph.edges_iterator(trg_gid, source_network):
-                src_cell = self._external_cells[source_network][src_prop.node_id]  # NEST implementation of source
-                trg_cell.set_synaptic_connection(src_cell, trg_cell, edge_prop)
+        for trg_prop, edge_groups in self._graph.target_edges(self._internal_cells.keys(), source_network):
+            trg_cell = self._internal_cells[trg_prop.node_id]
+            for edges in edge_groups:
+                # NEST implementation of the sources
+                trg_cell.set_synaptic_connections(self._external_cells[source_network], edges)
 
     def add_spikes_nwb(self, network, nwb_file, trial):
         """Adds spike trains from nwb file
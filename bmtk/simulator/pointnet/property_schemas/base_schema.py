@@ -25,6 +25,9 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
+
+
 class CellTypes:
     """Essentially an enum to store the type/group of each cell. It's faster and more robust than doing multiple string
     comparisons.
@@ -66,3 +69,8 @@ class PropertySchema(object):
     def get_edge_weight(self, src_node, trg_node, edge_props):
         raise NotImplementedError()
 
+    def get_edges_weights(self, trg_node, edges):
+        """Weights of a group of edges with the same edge type (see SimEdgeGroup), one edge at a time by default"""
+        return np.array([self.get_edge_weight(src_node, trg_node, edge) for src_node, edge in edges.edges()],
+                        dtype=float)
+
@@ -25,6 +25,8 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
+
 from base_schema import PropertySchema as BaseSchema
 
 
@@ -40,3 +42,6 @@ class PropertySchema(BaseSchema):
 
     def get_edge_weight(self, src_node, trg_node, edge_props):
         return edge_props['syn_weight']
+
+    def get_edges_weights(self, trg_node, edges):
+        return np.asarray(edges.column('syn_weight'), dtype=float)
@@ -27,6 +27,7 @@
 #
 import os
 import json
+import numpy as np
 
 import config as cfg
 from bmtk.utils.io import TabularNetwork
@@ -52,6 +53,61 @@ class SimEdge(object):
         else:
             return self._orig_params[item]
 
+    def __contains__(self, item):
+        return item in self._updated_params or item in self._orig_params
+
+
+class SimEdgeGroup(object):
+    """The edges onto a target with the same edge type and edge group, see EdgesBlock.type_groups
+
+    The properties of the edges are read as arrays with column(). The properties shared by the edges, like the
+    dynamics params and the columns of the edge type, are read from edge, the SimEdge of the edge type.
+    """
+    def __init__(self, graph, block, rows, edge, source_nodes):
+        """
+        :param block: EdgesBlock with the edges
+        :param rows: rows of the edges in block
+        :param edge: SimEdge created for the first edge of the edge type
+        :param source_nodes: table of the nodes of the source network
+        """
+        self._graph = graph
+        self._block = block
+        self._rows = rows
+        self._edge = edge
+        self._source_nodes = source_nodes
+
+    @property
+    def edge(self):
+        return self._edge
+
+    @property
+    def rows(self):
+        return self._rows
+
+    @property
+    def source_gids(self):
+        return self.column('source_gid')
+
+    def column(self, name):
+        """Array of the property name of every edge"""
+        return self._block.column(name, self._rows)
+
+    def weights(self, target_node):
+        return self._graph.property_schema.get_edges_weights(target_node, self)
+
+    def edges(self):
+        """(source_node, SimEdge) of every edge, for the properties that can only be computed one edge at a time"""
+        dynamics_params = self._edge['dynamics_params']
+        for row in self._rows:
+            e = self._block.edge(row)
+            yield self._source_nodes[e.source_gid], self._graph._create_edge(e, dynamics_params)
+
+    def __contains__(self, item):
+        return item in self._edge
+
+    def __len__(self):
+        return len(self._rows)
+
 
 class SimNode(object):
     def __init__(self, node_id, graph, network, params):
@@ -231,25 +287,86 @@ class SimGraph(object):
     def edges_table(self, target_network, source_network):
         return self._edges_table.get((target_network, source_network), None)
 
+    def target_counts(self, target_network):
+        """Number of edges onto each gid of target_network from all the source networks, indexed by the gid"""
+        counts = np.zeros(0, dtype=np.int64)
+        for (trg_network, _), edges in self._edges_table.items():
+            if trg_network != target_network:
+                continue
+
+            edges_counts = edges.target_counts()
+            if len(edges_counts) > len(counts):
+                counts = np.concatenate((counts, np.zeros(len(edges_counts) - len(counts), dtype=np.int64)))
+            counts[:len(edges_counts)] += edges_counts
+
+        return counts
+
     def edges_iterator(self, target_gid, source_network):
-        target_node = self._internal_nodes_table[target_gid]
-        target_network = target_node.network
-        source_network_table = self._networks[source_network]
+        for target_node, edge_groups in self.target_edges([target_gid], source_network):
+            # one edge at a time in the order of the edges file
+            edges = [(row, edge) for edges in edge_groups for row, edge in zip(edges.rows, edges.edges())]
+            for _, (source_node, edge_wrapper) in sorted(edges, key=lambda e: e[0]):
+                yield target_node, source_node, edge_wrapper
 
-        edges = self.edges_table(target_network, source_network)
-        if edges is None:
-            return
+    def target_edges(self, target_gids, source_network):
+        """Edges from source_network onto each of the internal target_gids
 
-        for e in edges.edges_itr(target_gid):
-            dynamics_params = self._get_edge_params(e)
-            edge_wrapper = self._create_edge(e, dynamics_params)
-            source_node = source_network_table[e.source_gid]
+        The edges onto all the targets of a network are read from the edges file at once (see EdgesFile.edges_block)
+        instead of one edge at a time, and the edges onto a target are grouped by edge type (see SimEdgeGroup) with
+        their properties as arrays. The edge type of a group, with its dynamics params, is created once for each
+        edge_type_id and edge group of the network.
 
-            yield target_node, source_node, edge_wrapper
+        :return: generator of (target_node, [SimEdgeGroup, ...]) for each target with edges from source_network
+        """
+        source_network_table = self._networks[source_network]
+        for target_network, gids in self._targets_by_network(target_gids):
+            edges = self.edges_table(target_network, source_network)
+            if edges is None:
+                continue
+
+            block = edges.edges_block(gids)
+            type_edges = {}
+            for gid in gids:
+                edge_groups = []
+                for rows in block.type_groups(gid):
+                    key = block.type_key(rows[0])
+                    edge = type_edges.get(key) if key is not None else None
+                    if edge is None:
+                        e = block.edge(rows[0])
+                        edge = self._create_edge(e, self._get_edge_params(e))
+                        if key is not None:
+                            type_edges[key] = edge
+                    edge_groups.append(self._create_edge_group(block, rows, edge, source_network_table))
+                yield self._internal_nodes_table[gid], edge_groups
+
+    def source_gids(self, target_gids, source_network):
+        """Sorted array of the gids of source_network with edges onto the internal target_gids, only the source gids
+        of the edges are read"""
+        source_gids = [np.zeros(0, dtype=np.int64)]
+        for target_network, gids in self._targets_by_network(target_gids):
+            edges = self.edges_table(target_network, source_network)
+            if edges is not None:
+                source_gids.append(np.asarray(edges.source_gids(gids), dtype=np.int64))
+        return np.unique(np.concatenate(source_gids))
+
+    def _targets_by_network(self, target_gids):
+        """(network, gids) of the internal target gids of each network, in the order of target_gids"""
+        networks = []
+        network_gids = {}
+        for gid in target_gids:
+            network = self._internal_nodes_table[gid].network
+            if network not in network_gids:
+                networks.append(network)
+                network_gids[network] = []
+            network_gids[network].append(gid)
+        return [(network, network_gids[network]) for network in networks]
 
     def _create_edge(self, edge, dynamics_params):
         return SimEdge(edge, dynamics_params)
 
+    def _create_edge_group(self, block, rows, edge, source_nodes):
+        return SimEdgeGroup(self, block, rows, edge, source_nodes)
+
     def _get_edge_params(self, edge):
         if edge.with_dynamics_params:
             return edge['dynamics_params']
@@ -0,0 +1,85 @@
+import numpy as np
+from neuron import h
+
+from bmtk.builder.synapse_locations import SynapseLocations
+from bmtk.simulator.bionet.biocell import BioCell
+from bmtk.simulator.bionet.morphology import Morphology
+
+
+def cell_morphology():
+    # the soma, 4 basal and 5 apical segments at increasing distances from the soma
+    morph = Morphology.__new__(Morphology)
+    morph.sec_type_swc = {'soma': 1, 'dend': 3, 'apic': 4}
+    morph._segments = {}
+    morph.seg_prop = {'type': np.array([1, 3, 3, 3, 3, 4, 4, 4, 4, 4]),
+                      'dist0': np.array([0.0, 10.0, 30.0, 10.0, 30.0, 10.0, 30.0, 50.0, 70.0, 90.0]),
+                      'dist1': np.array([10.0, 30.0, 50.0, 30.0, 50.0, 30.0, 50.0, 70.0, 90.0, 110.0]),
+                      'length': np.array([10.0, 20.0, 20.0, 20.0, 20.0, 20.0, 20.0, 20.0, 20.0, 20.0]),
+                      'x': np.array([0.5, 0.25, 0.75, 0.25, 0.75, 0.1, 0.3, 0.5, 0.7, 0.9])}
+    return morph
+
+
+class Node(dict):
+    def __init__(self, node_id, **props):
+        super(Node, self).__init__(props)
+        self.node_id = node_id
+
+
+class Stim(object):
+    def __init__(self):
+        self.hobj = h.NetStim()
+
+
+class EdgeGroup(object):
+    """Edges of an edge type with one synapse each and no sec_id/sec_x, placed when the simulation starts"""
+    preselected_targets = False
+
+    def __init__(self, rows, source_gids, target_sections, target_distance):
+        self.edge = self
+        self.rows = np.array(rows)
+        self.source_gids = np.array(source_gids)
+        self.target_sections = target_sections
+        self.target_distance = target_distance
+        self.nsyns = np.ones(len(rows), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def weights(self, target_node):
+        return np.ones(len(self.rows))
+
+    def column(self, name):
+        return np.ones(len(self.rows))
+
+    def load_synapses(self, section_x, section_id):
+        return [h.ExpSyn(x, sec=sec) for x, sec in zip(section_x, section_id)]
+
+
+def test_synapse_locations():
+    # the edges of two edge types onto the same target, in the order of the edges file
+    rules = [(['dend'], [0.0, 50.0]), (['apic'], [20.0, 100.0])]
+    edges = [(0, 1, 0), (1, 2, 1), (2, 3, 0), (3, 4, 1), (4, 5, 1), (5, 6, 0)]  # row, source_gid, rule
+    target = Node(7, morphology_file='cell.swc')
+
+    locations = SynapseLocations('morphologies', 'templates')
+    locations._morphologies[(locations._morphology_file(target), None)] = cell_morphology()
+    built = [locations(Node(src), target, *rules[rule]) for _, src, rule in edges]
+
+    # the synapses placed when the simulation starts are on the same segments
+    cell = BioCell.__new__(BioCell)
+    cell._gid = target.node_id
+    cell._node = target
+    cell._morph = cell_morphology()
+    cell._seg_kept = None
+    cell._secs = np.array([h.Section(name='seg{}'.format(i)) for i in range(10)])
+    cell._synapses, cell._syn_seg_ix, cell._syn_src_gid, cell._syn_sec_x, cell._netcons = [], [], [], [], []
+    cell.init_connections()
+
+    edge_groups = [EdgeGroup([row for row, _, r in edges if r == rule], [src for _, src, r in edges if r == rule],
+                             *rules[rule]) for rule in range(2)]
+    stims = dict((src, Stim()) for _, src, _ in edges)
+    assert(cell.set_syn_connections_batch(edge_groups, stims) == len(edges))
+
+    placed = dict(zip(cell._syn_src_gid, zip(cell._syn_seg_ix, cell._syn_sec_x)))
+    assert([placed[src] for _, src, _ in edges] == built)
+    assert(len(set(sec_id for sec_id, _ in built)) > 1)
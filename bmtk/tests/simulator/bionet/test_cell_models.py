@@ -0,0 +1,16 @@
+import numpy as np
+
+from bmtk.simulator.bionet.default_setters.cell_models import distance_density
+
+
+def test_distance_density():
+    dist = np.array([0.0, 50.0, 200.0, 600.0])
+    assert(np.allclose(distance_density(dist, {'function': 'linear', 'g0': 2.0, 'a': 1.0, 'b': 0.01}),
+                       2.0*(1.0 + 0.01*dist)))
+    assert(np.allclose(distance_density(dist, {'function': 'exponential', 'a': -0.5, 'b': 2.0, 'k': 0.003}),
+                       -0.5 + 2.0*np.exp(0.003*dist)))
+    assert(np.allclose(distance_density(dist, {'function': 'sigmoid', 'b': 4.0, 'dist_half': 200.0, 'slope': 50.0}),
+                       4.0/(1.0 + np.exp((200.0 - dist)/50.0))))
+    assert(np.allclose(distance_density(dist, {'function': 'table', 'distances': [0.0, 100.0, 400.0],
+                                               'values': [1.0, 3.0, 0.0]}),
+                       [1.0, 2.0, 2.0, 0.0]))
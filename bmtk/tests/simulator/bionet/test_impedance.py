@@ -0,0 +1,33 @@
+import numpy as np
+from neuron import h
+
+from bmtk.simulator.bionet.impedance import impedance_profiles
+
+
+class SomaCell(object):
+    def __init__(self):
+        soma = h.Section()
+        soma.L = soma.diam = 10.0
+        soma.cm = 1.0
+        soma.insert('pas')
+        soma.g_pas = 1e-4
+        self.soma = [soma]
+        self.hobj = self
+        self.all = [soma]
+
+
+def test_impedance_profiles():
+    cell = SomaCell()
+    freqs = [0.0, 10.0, 100.0]
+    profile = impedance_profiles({0: cell}, freqs, v_hold=[-70.0, -60.0])[0]
+    assert(profile['input'].shape == (2, 3, 2))
+
+    # single compartment: Z = 1/(G + i*2*pi*f*C)
+    area = np.pi*10.0*10.0*1e-8  # cm^2
+    G = 1e-4*area  # S
+    C = 1e-6*area  # F
+    Z = 1.0/(G + 2j*np.pi*np.array(freqs)*C)/1e6  # MOhm
+    for ivhold in range(2):
+        for name in ['input', 'transfer']:
+            assert(np.allclose(profile[name][ivhold], np.abs(Z)[:, None], rtol=1e-3))
+            assert(np.allclose(profile[name + '_phase'][ivhold], np.angle(Z)[:, None], atol=1e-3))
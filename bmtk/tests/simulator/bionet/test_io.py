@@ -0,0 +1,167 @@
+import os
+import json
+import tempfile
+import numpy as np
+import h5py
+
+from bmtk.simulator.bionet import io
+from bmtk.analyzer.cell_vars import load_cell_vars, load_cell_var
+
+
+def cell_vars_conf(dir_name, nsteps_block=5, tstop=1.0):
+    return {'run': {'dt': 0.1, 'tstop': tstop, 'nsteps_block': nsteps_block, 'save_cell_vars': ['v'],
+                    'calc_ecp': False},
+            'output': {'cell_vars_file': os.path.join(dir_name, 'cell_vars.h5')}}
+
+
+def cell_vars_block(nsegs, nsteps_block, spikes, iblock):
+    # the values of a gid are gid + block + 0.1*segment
+    cells = {}
+    for gid, nseg in nsegs.items():
+        cells[gid] = {'v': np.full(nsteps_block, gid + iblock, dtype=float),
+                      'v_all_segs': gid + iblock + 0.1*np.tile(np.arange(nseg), (nsteps_block, 1))}
+    return {'tsave': iblock, 'cells': cells, 'spikes': spikes}
+
+
+def save_cell_vars_blocks(conf, nsegs, spikes):
+    for iblock, block_spikes in enumerate(spikes):
+        data_block = cell_vars_block(nsegs, 5, block_spikes, iblock)
+        interval = (iblock*5, (iblock+1)*5)
+        io.save_cell_vars(conf, {'interval': interval, 'tsave': iblock, 'parallel': False,
+                                 'cells': io.collect_cell_vars(conf, data_block, interval),
+                                 'cell_spikes': io.collect_cell_spikes(conf, data_block)})
+
+
+def test_cell_vars_file():
+    conf = cell_vars_conf(tempfile.mkdtemp())
+    nsegs = {5: 3, 2: 0, 9: 2}
+    io.create_cell_vars_file(conf, {'save_cell_vars': list(nsegs.keys())}, nsegs)
+
+    save_cell_vars_blocks(conf, nsegs, [(np.array([0.2, 0.3, 0.4]), np.array([9, 2, 7])),
+                                        (np.array([0.6, 0.9]), np.array([9, 9]))])
+
+    # the same datasets as the file of a single gid
+    cell_vars = load_cell_vars(conf['output']['cell_vars_file'], 9)
+    assert(sorted(cell_vars.keys()) == ['spikes', 'v', 'v_all_segs'])
+    assert(np.allclose(cell_vars['v'], [9.0]*5 + [10.0]*5))
+    assert(np.allclose(cell_vars['v_all_segs'][:, 1], [9.1]*5 + [10.1]*5))
+    assert(np.allclose(cell_vars['spikes'], [0.2, 0.6, 0.9]))
+    cell_vars = load_cell_vars(conf['output']['cell_vars_file'], 2)
+    assert(cell_vars['v_all_segs'].shape == (10, 0) and np.allclose(cell_vars['spikes'], [0.3]))
+
+    # the values are in the order of the requested gids
+    gids, values = load_cell_var(conf['output']['cell_vars_file'], 'v', [9, 2, 5])
+    assert(list(gids) == [9, 2, 5])
+    assert(np.allclose(values[0], [9.0, 2.0, 5.0]) and np.allclose(values[-1], [10.0, 3.0, 6.0]))
+
+
+def writer_conf(dir_name):
+    return {'run': {'dt': 0.1, 'tstop': 1.5, 'nsteps_block': 5, 'save_cell_vars': ['v'], 'calc_ecp': False},
+            'output': {'cell_vars_dir': dir_name, 'spikes_hdf5_file': os.path.join(dir_name, 'spikes.h5'),
+                       'spikes_ascii_file': os.path.join(dir_name, 'spikes.txt')}}
+
+
+def writer_block(iblock):
+    return {'tsave': iblock, 'cells': {3: {'v': np.full(5, float(iblock)), 'v_all_segs': np.zeros((5, 0))}},
+            'spikes': (np.array([iblock*0.5 + 0.1]), np.array([3]))}
+
+
+def test_block_writer():
+    conf = writer_conf(tempfile.mkdtemp())
+    io.create_cell_vars_files(conf, {'save_cell_vars': [3]}, {})
+    io.create_spike_file(conf, [3])
+
+    # save_block waits for the writer when max_pending blocks are not written yet, the block can be filled again
+    writer = io.BlockWriter(conf, background=True, max_pending=1)
+    for iblock in range(3):
+        data_block = writer_block(iblock)
+        writer.save_block(data_block, (iblock*5, (iblock+1)*5))
+        assert(writer._npending <= 1 and not data_block['cells'][3]['v'].any())
+
+    # close waits for the pending blocks and stops the writer
+    writer.close()
+    assert(writer._npending == 0 and writer._process is None)
+    with h5py.File(os.path.join(conf['output']['cell_vars_dir'], '3.h5'), 'r') as h5:
+        assert(np.allclose(h5['v'][0:15], [0.0]*5 + [1.0]*5 + [2.0]*5) and h5.attrs['tsave'] == 2)
+        assert(np.allclose(h5['spikes'][()], [0.1, 0.6, 1.1]))
+    with h5py.File(conf['output']['spikes_hdf5_file'], 'r') as h5:
+        assert(np.allclose(h5['time'][()], [0.1, 0.6, 1.1]) and list(h5['gid'][()]) == [3, 3, 3])
+
+
+def test_block_writer_error():
+    # the cell variables can not be written into a missing directory
+    conf = writer_conf(os.path.join(tempfile.mkdtemp(), 'missing'))
+    writer = io.BlockWriter(conf, background=True, max_pending=1)
+    writer.save_block(writer_block(0), (0, 5))
+    try:
+        writer.close()
+        raised = False
+    except Exception as e:
+        raised = 'Unable to save data block' in str(e)
+    assert(raised and writer._process is None)
+
+
+def write_checkpoint(conf, t):
+    conf['output']['state_dir'] = os.path.dirname(conf['output']['spikes_hdf5_file'])
+    with open(os.path.join(conf['output']['state_dir'], 'checkpoint.json'), 'w') as f:
+        json.dump({'tstep': int(round(t/conf['run']['dt'])), 't': t, 'nhost': 1}, f)
+
+
+def test_extend_output_files():
+    conf = writer_conf(tempfile.mkdtemp())
+    conf['run']['tstop'] = 1.0
+    io.create_cell_vars_files(conf, {'save_cell_vars': [3, 4]}, {3: 2})
+    io.create_spike_file(conf, [3, 4])
+
+    # spikes of a run that went past the checkpoint at 0.5 ms
+    spikes = (np.array([0.2, 0.5, 0.7]), np.array([3, 4, 3]))
+    with h5py.File(conf['output']['spikes_hdf5_file'], 'a') as h5:
+        io._append_spikes(h5, {'all': spikes}, False)
+    with open(conf['output']['spikes_ascii_file'], 'w') as f:
+        f.writelines('%.3f %d\n' % (t, gid) for t, gid in zip(*spikes))
+    with h5py.File(os.path.join(conf['output']['cell_vars_dir'], '3.h5'), 'a') as h5:
+        h5['spikes'].resize((2,))
+        h5['spikes'][:] = [0.2, 0.7]
+    write_checkpoint(conf, 0.5)
+
+    # the spikes after the checkpoint are dropped and the time series are extended to the new tstop
+    conf['run']['tstop'] = 1.5
+    io.extend_output_files(conf, {'save_cell_vars': [3, 4]})
+    with h5py.File(conf['output']['spikes_hdf5_file'], 'r') as h5:
+        assert(np.allclose(h5['time'][()], [0.2, 0.5]) and list(h5['gid'][()]) == [3, 4])
+        assert(h5.attrs['tstop'] == 1.5)
+    with open(conf['output']['spikes_ascii_file'], 'r') as f:
+        assert(f.read().split() == ['0.200', '3', '0.500', '4'])
+    with h5py.File(os.path.join(conf['output']['cell_vars_dir'], '3.h5'), 'r') as h5:
+        assert(np.allclose(h5['spikes'][()], [0.2]))
+        assert(h5['v'].shape == (15,) and h5['v_all_segs'].shape == (15, 2))
+    with h5py.File(os.path.join(conf['output']['cell_vars_dir'], '4.h5'), 'r') as h5:
+        assert(h5['v'].shape == (15,) and h5['v_all_segs'].shape == (15, 0))
+
+
+def test_extend_cell_vars_file():
+    conf = cell_vars_conf(tempfile.mkdtemp())
+    conf['output']['spikes_hdf5_file'] = os.path.join(os.path.dirname(conf['output']['cell_vars_file']), 'spikes.h5')
+    conf['output']['spikes_ascii_file'] = os.path.join(os.path.dirname(conf['output']['cell_vars_file']), 'spikes.txt')
+    nsegs = {5: 3, 2: 0}
+    io.create_cell_vars_file(conf, {'save_cell_vars': list(nsegs.keys())}, nsegs)
+    io.create_spike_file(conf, list(nsegs.keys()))
+    save_cell_vars_blocks(conf, nsegs, [(np.array([0.2, 0.3]), np.array([5, 2])), (np.array([0.6]), np.array([5]))])
+    write_checkpoint(conf, 0.5)
+
+    conf['run']['tstop'] = 2.0
+    io.extend_output_files(conf, {'save_cell_vars': list(nsegs.keys())})
+    cell_vars = load_cell_vars(conf['output']['cell_vars_file'], 5)
+    assert(cell_vars['v'].shape == (20,) and cell_vars['v_all_segs'].shape == (20, 3))
+    assert(np.allclose(cell_vars['v'][0:10], [5.0]*5 + [6.0]*5) and np.allclose(cell_vars['spikes'], [0.2]))
+
+
+def test_resize_time_fixed():
+    with h5py.File(os.path.join(tempfile.mkdtemp(), 'fixed.h5'), 'w') as h5:
+        h5.create_dataset('v', data=np.zeros(10))
+        try:
+            io._resize_time(h5, ['v'], 15)
+            raised = False
+        except Exception as e:
+            raised = 'fixed size' in str(e)
+        assert(raised and h5['v'].shape == (10,))
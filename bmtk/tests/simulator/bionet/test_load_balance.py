@@ -0,0 +1,29 @@
+import numpy as np
+
+from bmtk.simulator.bionet import load_balance
+
+
+def test_assign_ranks():
+    costs = {0: 100.0, 1: 1.0, 2: 1.0, 3: 60.0, 4: 50.0, 5: 1.0, 6: 1.0}
+    ranks = load_balance.assign_ranks(costs, 2)
+    assert(ranks[0] != ranks[3] and ranks[3] == ranks[4])
+    assert(np.allclose(sorted(load_balance.rank_loads(costs, ranks, 2)), [104.0, 110.0]))
+
+    # every rank gets a cell before any rank gets a second one
+    ranks = load_balance.assign_ranks(dict((gid, 1.0) for gid in range(8)), 4)
+    assert(sorted(ranks.values()) == [0, 0, 1, 1, 2, 2, 3, 3])
+
+
+def test_mechanism_counts():
+    params = {'genome': [{'section': 'soma', 'mechanism': 'NaTs2_t', 'name': 'gNaTs2_tbar_NaTs2_t'},
+                         {'section': 'somatic', 'mechanism': 'Ih', 'name': 'gbar_Ih'},
+                         {'section': 'all', 'mechanism': 'Ih', 'name': 'gbar_Ih'},
+                         {'section': 'apic', 'mechanism': 'pas', 'name': 'g_pas'},
+                         {'section': 'apic', 'mechanism': '', 'name': 'cm'}]}
+    assert(load_balance.mechanism_counts(params) == {'soma': 2, 'dend': 1, 'apic': 1, 'axon': 1})
+    assert(load_balance.mechanism_counts('params.nml') == {})
+
+
+def test_calibrate_costs():
+    costs = load_balance.calibrate_costs({0: 10.0, 1: 20.0, 2: 5.0}, {0: 1.0, 1: 2.0})
+    assert(np.allclose([costs[0], costs[1], costs[2]], [1.0, 2.0, 0.5]))
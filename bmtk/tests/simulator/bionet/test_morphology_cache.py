@@ -0,0 +1,34 @@
+import numpy as np
+
+from bmtk.simulator.bionet.morphology_cache import build_morphology, get_morphology_arrays
+
+
+def morphology_arrays():
+    # soma, two dendrites branching from the soma and the end of the first dendrite, and an axon
+    pts = np.array([[0.0, -5.0, 0.0, 10.0], [0.0, 0.0, 0.0, 10.0], [0.0, 5.0, 0.0, 10.0],
+                    [0.0, 5.0, 0.0, 2.0], [0.0, 50.0, 0.0, 1.5],
+                    [0.0, 50.0, 0.0, 1.0], [30.0, 80.0, 0.0, 0.8], [40.0, 120.0, 5.0, 0.5],
+                    [0.0, -5.0, 0.0, 1.0], [0.0, -60.0, 0.0, 1.0]])
+    return {'sec_type': np.array([0, 1, 1, 3], dtype=np.int8),
+            'sec_index': np.array([0, 0, 1, 0], dtype=np.int32),
+            'parent': np.array([-1, 0, 1, 0], dtype=np.int32),
+            'parent_x': np.array([0.0, 0.5, 1.0, 0.5]),
+            'orientation': np.zeros(4),
+            'nseg': np.array([1, 3, 5, 1], dtype=np.int32),
+            'pt3dstyle': np.array([0, 1, 0, 0], dtype=np.int8),
+            'logical_pt': np.array([[0.0, 0.0, 0.0], [0.0, 5.0, 0.0], [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]),
+            'pt_ptr': np.array([0, 3, 5, 8, 10]),
+            'pts': pts}
+
+
+def test_build_morphology():
+    morph = morphology_arrays()
+    hobj = build_morphology(morph)
+    assert([len(list(getattr(hobj, name))) for name in ['all', 'somatic', 'basal', 'apical', 'axonal']] ==
+           [4, 1, 2, 0, 1])
+    assert(np.isclose(hobj.dend[0].L, 45.0))
+    assert(hobj.dend[1].parentseg().sec.name() == hobj.dend[0].name())
+
+    rebuilt = get_morphology_arrays(hobj)
+    for key, value in morph.items():
+        assert(np.allclose(rebuilt[key], value))
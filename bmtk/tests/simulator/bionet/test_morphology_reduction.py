@@ -0,0 +1,27 @@
+import numpy as np
+
+from bmtk.simulator.bionet.morphology_reduction import reduce_morphology
+from test_morphology_cache import morphology_arrays
+
+
+def test_reduce_morphology():
+    morph = morphology_arrays()
+    reduced, mapping = reduce_morphology(morph)
+
+    # the soma and the axon are kept and the two dendrites become a single cable
+    assert(reduced['sec_type'].tolist() == [0, 1, 3])
+    assert(reduced['parent'].tolist() == [-1, 0, 0])
+    assert(mapping['section'].tolist() == [0, 1, 1, 2])
+
+    # the cable has the diameter of the stem and the electrotonic length of the longest path
+    pts = morph['pts']
+    elec = lambda p0, p1: np.sqrt(np.sum((pts[p1, :3] - pts[p0, :3])**2))/np.sqrt((pts[p0, 3] + pts[p1, 3])/2)
+    elec_dend0 = elec(3, 4)
+    elec_dend1 = elec(5, 6) + elec(6, 7)
+    cable = reduced['pts'][reduced['pt_ptr'][1]:reduced['pt_ptr'][2]]
+    assert(np.allclose(cable[:, 3], 1.75))
+    assert(np.isclose(np.sqrt(np.sum((cable[1, :3] - cable[0, :3])**2)), (elec_dend0 + elec_dend1)*np.sqrt(1.75)))
+
+    # points of the dendrites are mapped at the same electrotonic distance from the soma
+    assert(np.allclose(mapping['x'][3:8], [0.0, elec_dend0, elec_dend0, elec_dend0 + elec(5, 6), elec_dend0 + elec_dend1]
+                       / (elec_dend0 + elec_dend1)))
@@ -0,0 +1,99 @@
+import numpy as np
+from neuron import h
+
+from bmtk.simulator.bionet import multisplit
+
+
+def cell_morphology():
+    # soma[0] with dend[0] and dend[1] at x=0, apic[0] at x=1 branching into apic[1] and apic[2], and the axon
+    return {'sec_type': np.array([0, 1, 1, 2, 2, 2, 3]),
+            'sec_index': np.array([0, 0, 1, 0, 1, 2, 0]),
+            'parent': np.array([-1, 0, 0, 0, 3, 3, 0]),
+            'parent_x': np.array([0.0, 0.0, 0.0, 1.0, 1.0, 1.0, 0.5])}
+
+
+def test_split_tree():
+    morph = cell_morphology()
+    sec_costs = np.array([1.0, 5.0, 5.0, 10.0, 10.0, 10.0, 0.0])
+
+    piece_of, cuts = multisplit.split_tree(morph, sec_costs, 1)
+    assert(np.all(piece_of == 0) and cuts == [])
+
+    piece_of, cuts = multisplit.split_tree(morph, sec_costs, 4)
+    assert(cuts[0] == (0, 1.0, [3]))  # the apical tree is the most expensive
+    assert(cuts[1] == (3, 1.0, [4, 5]))
+    assert(piece_of[0] == 0 and piece_of[6] == 0)  # the axon stays with the soma
+    assert(len(set(piece_of[[3, 4, 5]])) == 3)
+    piece_costs = np.bincount(piece_of, weights=sec_costs)
+    assert(np.max(piece_costs) <= np.sum(sec_costs)/4)
+
+
+def test_assign_pieces():
+    morph = cell_morphology()
+    sec_costs = np.array([1.0, 5.0, 5.0, 10.0, 10.0, 10.0, 0.0])
+    piece_of, cuts = multisplit.split_tree(morph, sec_costs, 4)
+    piece_costs = np.bincount(piece_of, weights=sec_costs)
+    names = ['soma[0]', 'dend[0]', 'dend[1]', 'apic[0]', 'apic[1]', 'apic[2]', 'axon[0]']
+    split = multisplit.CellSplit(names, piece_of, cuts, piece_costs)
+
+    node_ranks, loads = multisplit.assign_pieces({0: np.sum(sec_costs), 1: 1.0}, {0: split}, 3)
+    assert(split.is_split and node_ranks[0] == split.owner)
+    assert(np.isclose(np.sum(loads), np.sum(sec_costs) + 1.0))
+    # only the cuts between pieces on different ranks get a split id
+    for cut, sid in enumerate(split.sids):
+        parent_rank, child_ranks = split.cut_ranks(cut)
+        assert((sid is None) == all(r == parent_rank for r in child_ranks))
+
+
+def test_assign_pieces_threads():
+    morph = cell_morphology()
+    sec_costs = np.array([1.0, 5.0, 5.0, 10.0, 10.0, 10.0, 0.0])
+    piece_of, cuts = multisplit.split_tree(morph, sec_costs, 4)
+    piece_costs = np.bincount(piece_of, weights=sec_costs)
+    names = ['soma[0]', 'dend[0]', 'dend[1]', 'apic[0]', 'apic[1]', 'apic[2]', 'axon[0]']
+    split = multisplit.CellSplit(names, piece_of, cuts, piece_costs)
+
+    # a single rank with two threads still cuts the cell between the pieces of different threads
+    node_ranks, loads = multisplit.assign_pieces({0: np.sum(sec_costs)}, {0: split}, 1, 2)
+    assert(split.is_split and np.all(split.ranks == 0) and node_ranks[0] == 0)
+    assert(len(loads) == 2 and np.isclose(np.sum(loads), np.sum(sec_costs)))
+    assert(any(sid is not None for sid in split.sids))
+
+
+class RecordSplits(object):
+    # stands in for the ParallelContext of split_hobj and records the split id given to each section
+    def __init__(self):
+        self.sids = []
+
+    def multisplit(self, x, sid, sec=None):
+        self.sids.append((sec, sid))
+
+
+def test_split_hobj_sids():
+    # soma[0] - dend[0] - dend[1] - dend[3] with dend[2] also on dend[0](1), one piece per section. The pieces of
+    # dend[0] and dend[1] are on the same rank and each tree left on a rank must get at most two split ids
+    names = ['soma[0]', 'dend[0]', 'dend[1]', 'dend[2]', 'dend[3]']
+    parents = [None, 0, 1, 1, 2]
+    split = multisplit.CellSplit(names, np.arange(5), [(0, 1.0, [1]), (1, 1.0, [2, 3]), (2, 1.0, [4])], np.ones(5))
+    split.workers = np.array([0, 1, 1, 0, 0], dtype=np.int32)
+    split.sids = [0, 1, 2]
+
+    pc = multisplit.pc
+    try:
+        for rank in [0, 1]:
+            cell = type('Cell', (object,), {})()
+            cell.all = [h.Section(name=name) for name in names]
+            for sec, parent in zip(cell.all, parents):
+                if parent is not None:
+                    sec.connect(cell.all[parent](1.0))
+
+            multisplit.pc = RecordSplits()
+            kept = multisplit.split_hobj(cell, split, rank)
+            assert(list(kept) == [r == rank for r in split.ranks])
+
+            tree_sids = {}
+            for sec, sid in multisplit.pc.sids:
+                tree_sids.setdefault(h.SectionRef(sec=sec).root.name(), set()).add(sid)
+            assert(all(len(sids) <= 2 for sids in tree_sids.values()))
+    finally:
+        multisplit.pc = pc
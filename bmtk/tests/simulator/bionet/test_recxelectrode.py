@@ -0,0 +1,45 @@
+import pytest
+import tempfile
+import numpy as np
+
+from bmtk.simulator.bionet.recxelectrode import RecXElectrode
+
+
+@pytest.fixture
+def electrode():
+    positions_file = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+    positions_file.write(b'x_pos y_pos z_pos\n0.0 100.0 20.0\n10.0 -50.0 20.0\n50.0 300.0 -20.0\n')
+    positions_file.close()
+    return RecXElectrode({'recXelectrode': {'positions': positions_file.name}, 'run': {}})
+
+
+def seg_coords(nseg, offset):
+    p0 = np.zeros((3, nseg))
+    p0[1, :] = np.arange(nseg)*10.0
+    p0[0, :] = offset
+    p1 = p0.copy()
+    p1[1, :] += 10.0
+    return {'p0': p0, 'p1': p1}
+
+
+def test_calc_ecp(electrode):
+    nsegs = {0: 5, 3: 11, 7: 2}
+    for gid, nseg in nsegs.items():
+        electrode.calc_transfer_resistance(gid, seg_coords(nseg, gid*20.0))
+    electrode.set_im_columns(sorted(nsegs.keys()))
+    assert(electrode.nseg_total == 18 and electrode.tr_offsets[3] == (5, 16))
+
+    im = np.random.RandomState(1).randn(25, 18)
+    ecp = np.zeros((25, 3))
+    for gid in sorted(nsegs.keys()):
+        col0, col1 = electrode.tr_offsets[gid]
+        cell_ecp = electrode.calc_cell_ecp(gid, im)
+        assert(np.array_equal(cell_ecp, np.dot(im[:, col0:col1], electrode.get_transfer_resistance(gid).T)))
+        ecp += cell_ecp
+
+        # the products of the single time steps agree to rounding
+        step_ecp = np.array([np.dot(electrode.get_transfer_resistance(gid), im[t, col0:col1]) for t in range(25)])
+        assert(np.allclose(cell_ecp, step_ecp))
+
+    # the cells are summed in the same order
+    assert(np.array_equal(electrode.calc_ecp(im), ecp))
@@ -0,0 +1,130 @@
+import os
+import tempfile
+import numpy as np
+import h5py
+
+from bmtk.utils.io import tabular_network as tn
+from bmtk.utils.io import tabular_network_v1 as tn_v1
+
+
+def write_edges(dir_name):
+    # 3 targets, the edges of target 1 are split between two groups with different properties
+    edges_file = os.path.join(dir_name, 'edges.h5')
+    with h5py.File(edges_file, 'w') as h5:
+        grp = h5.create_group('edges')
+        grp.create_dataset('index_pointer', data=[0, 2, 5, 6])
+        grp.create_dataset('target_gid', data=[0, 0, 1, 1, 1, 2])
+        grp.create_dataset('source_gid', data=[5, 6, 7, 8, 9, 5])
+        grp.create_dataset('edge_type_id', data=[100, 100, 101, 100, 101, 100])
+        grp.create_dataset('edge_group', data=[0, 0, 1, 0, 1, 0])
+        grp.create_dataset('edge_group_index', data=[0, 1, 0, 2, 1, 3])
+        grp.create_dataset('0/syn_weight', data=[0.1, 0.2, 0.3, 0.4])
+        grp.create_dataset('0/nsyns', data=[1, 2, 3, 4])
+        grp.create_dataset('1/sec_x', data=[0.5, 0.9])
+
+    edge_types_file = os.path.join(dir_name, 'edge_types.csv')
+    with open(edge_types_file, 'w') as f:
+        f.write('edge_type_id delay\n100 2.0\n101 3.0\n')
+    return edges_file, edge_types_file
+
+
+def test_read_rows():
+    with h5py.File(os.path.join(tempfile.mkdtemp(), 'ds.h5'), 'w') as h5:
+        ds = h5.create_dataset('ds', data=np.arange(100)*10)
+        rows = [2, 3, 4, 50, 51, 97]
+        assert(np.all(tn.read_rows(ds, rows, chunk_size=4) == np.array(rows)*10))
+        assert(len(tn.read_rows(ds, [])) == 0)
+
+
+def test_edges_block():
+    edges = tn_v1.EdgesFile()
+    edges.load(*write_edges(tempfile.mkdtemp()))
+
+    block = edges.edges_block([2, 1, 5])
+    assert(list(block.target_gids) == [1, 2])
+    assert(list(block.columns['source_gid']) == [7, 8, 9, 5])
+    assert(block.target_range(1) == (0, 3) and block.target_range(0) == (0, 0))
+    assert(list(edges.source_gids([2, 1, 5])) == [7, 8, 9, 5])
+
+    # the views have the same properties as the edges read one at a time
+    for view, iloc in zip(block.rows(1) + block.rows(2), [2, 3, 4, 5]):
+        edge = edges[iloc]
+        assert(view.source_gid == edge.source_gid and view.target_gid == edge.target_gid)
+        for name in ['syn_weight', 'nsyns', 'sec_x', 'delay']:
+            assert((name in view) == (name in edge))
+            if name in edge:
+                assert(view[name] == edge[name])
+
+
+def test_edges_type_groups():
+    edges = tn_v1.EdgesFile()
+    edges.load(*write_edges(tempfile.mkdtemp()))
+
+    # groups in the order of their first edge, the type properties are repeated for every edge of a group
+    block = edges.edges_block([1, 2])
+    groups = block.type_groups(1)
+    assert([list(rows) for rows in groups] == [[0, 2], [1]])
+    assert(block.type_key(0) == block.type_key(2) == (101, 1))
+    assert(list(block.column('source_gid', groups[0])) == [7, 9])
+    assert(list(block.column('sec_x', groups[0])) == [0.5, 0.9])
+    assert(list(block.column('nsyns', groups[1])) == [3])
+    assert(np.allclose(block.column('delay', groups[0]).astype(float), [3.0, 3.0]))
+    assert([list(rows) for rows in block.type_groups(2)] == [[3]] and block.type_groups(0) == [])
+
+
+def test_edges_unknown_type():
+    edges_file, edge_types_file = write_edges(tempfile.mkdtemp())
+    with open(edge_types_file, 'w') as f:
+        f.write('edge_type_id delay\n100 2.0\n')
+    edges = tn_v1.EdgesFile()
+    edges.load(edges_file, edge_types_file)
+
+    # the edges of a type missing from the edge types file can not be read
+    block = edges.edges_block([1])
+    assert(block.row_get(1, 'delay') == 2.0)
+    for get in [lambda: block.row_get(0, 'delay'), lambda: block.row_contains(0, 'delay'),
+                lambda: block.row_type_props(0)]:
+        try:
+            get()
+            assert(False)
+        except KeyError:
+            pass
+
+
+def write_nodes(dir_name):
+    # the gids are not in order and the nodes of group 1 have no positions
+    nodes_file = os.path.join(dir_name, 'nodes.h5')
+    with h5py.File(nodes_file, 'w') as h5:
+        grp = h5.create_group('nodes')
+        grp.attrs['network'] = 'V1'
+        grp.create_dataset('node_gid', data=[2, 0, 1, 3])
+        grp.create_dataset('node_type_id', data=[100, 100, 101, 101])
+        grp.create_dataset('node_group', data=[0, 0, 1, 1])
+        grp.create_dataset('node_group_index', data=[1, 0, 0, 1])
+        grp.create_dataset('0/positions', data=[[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]])
+        grp.create_dataset('0/rotation_angle_yaxis', data=[0.1, 0.2])
+        grp.create_dataset('1/tuning_angle', data=[45.0, 90.0])
+
+    node_types_file = os.path.join(dir_name, 'node_types.csv')
+    with open(node_types_file, 'w') as f:
+        f.write('node_type_id model_type\n100 biophysical\n101 virtual\n')
+    return nodes_file, node_types_file
+
+
+def test_nodes_table():
+    nodes = tn_v1.NodesFile()
+    nodes.load(*write_nodes(tempfile.mkdtemp()))
+    assert(nodes.name == 'V1' and len(nodes) == 4)
+    assert(nodes.gids == [2, 0, 1, 3])
+
+    node = nodes.get_node(2)
+    assert(node.gid == 2 and node['model_type'] == 'biophysical')
+    assert(np.allclose(node['positions'], [3.0, 4.0, 5.0]) and node['rotation_angle_yaxis'] == 0.2)
+    assert('tuning_angle' not in node and nodes.get_node(3)['tuning_angle'] == 90.0)
+    assert([n.gid for n in nodes] == [2, 0, 1, 3])
+
+    try:
+        nodes.get_node(4)
+        assert(False)
+    except KeyError:
+        pass
@@ -25,6 +25,7 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
 import pandas as pd
 import h5py
 
@@ -41,8 +42,14 @@ In general the developed formats have all take schema:
  * Each type is made up of rows (NodeRow, EdgeRow)
  * Each row has its own set column properties (ColumnProperty), depending on the file/group it belongs too.
  * Each row also has properties from (edge/node)-type metadata.
+
+The nodes are kept in memory as columns of numpy arrays (NodesTable) and the edges onto many targets can be read at once
+as columns (EdgesBlock), with one read of each dataset instead of one read per node/edge and property. Their rows are
+light weight views (NodeView, EdgeView) with the interface of NodeRow and EdgeRow.
 """
 
+READ_CHUNK = 2**20  # maximum number of rows of a dataset read at once by read_rows
+
 
 ##########################################
 # Interface files
@@ -253,13 +260,357 @@ class EdgesFile(object):
     def edges_itr(self, target_gid):
         raise NotImplementedError()
 
+    def edges_block(self, target_gids):
+        """The edges onto the target gids read at once, see EdgesBlock
+
+        Formats that do not store the edges in columns keep the rows of edges_itr in the block.
+        """
+        target_gids = np.unique(np.asarray(target_gids, dtype=np.int64))
+        rows = [[e for e in self.edges_itr(int(gid))] for gid in target_gids]
+        index_ptr = np.concatenate(([0], np.cumsum([len(r) for r in rows], dtype=np.int64)))
+        rows = [e for r in rows for e in r]
+        columns = {'target_gid': np.array([e.target_gid for e in rows], dtype=np.int64),
+                   'source_gid': np.array([e.source_gid for e in rows], dtype=np.int64)}
+        return EdgesBlock(target_gids, index_ptr, columns, rows=rows)
+
+    def source_gids(self, target_gids):
+        """Array of the source gid of every edge onto the target gids"""
+        return self.edges_block(target_gids).columns['source_gid']
+
+    def target_counts(self):
+        """Array with the number of edges onto each target gid, indexed by the gid. Files that store the number of
+        synapses of each edge count the synapses instead."""
+        raise NotImplementedError()
+
     def __len__(self):
         raise NotImplementedError()
 
 
+class NodesTable(object):
+    """The nodes of a file as columns of numpy arrays.
+
+    columns has the arrays of the node_gid, node_type_id, node_group and node_group_index of every node, in the order of
+    the file, the properties of the node groups are in groups[node_group][name] at the node_group_index of the node.
+    Nodes are looked up by gid with a binary search of the sorted gids.
+    """
+    def __init__(self, columns, groups, types_table):
+        """
+        :param columns: dictionary of the arrays of the nodes
+        :param groups: dictionary of the property arrays of each node group
+        :param types_table: properties of each node_type_id
+        """
+        self._columns = columns
+        self._groups = groups
+        self._types_table = types_table
+
+        self._gid_order = np.argsort(columns['node_gid'], kind='mergesort')
+        self._sorted_gids = columns['node_gid'][self._gid_order]
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def groups(self):
+        return self._groups
+
+    @property
+    def gids(self):
+        return self._columns['node_gid']
+
+    def row_of(self, gid):
+        """Row of the node gid, raises a KeyError if the gid is not in the table"""
+        i = np.searchsorted(self._sorted_gids, gid)
+        if i == len(self._sorted_gids) or self._sorted_gids[i] != gid:
+            raise KeyError(gid)
+        return int(self._gid_order[i])
+
+    def node(self, row):
+        return NodeView(self, row)
+
+    def row_gid(self, row):
+        return int(self._columns['node_gid'][row])
+
+    def row_get(self, row, name, default=None):
+        """Property of a node, from its group or its node type"""
+        group = self._groups.get(self._columns['node_group'][row])
+        if group is not None and name in group:
+            return group[name][self._columns['node_group_index'][row]]
+        return self._types_table[self._columns['node_type_id'][row]].get(name, default)
+
+    def row_contains(self, row, name):
+        group = self._groups.get(self._columns['node_group'][row])
+        return (group is not None and name in group) or \
+            name in self._types_table[self._columns['node_type_id'][row]]
+
+    def row_props(self, row):
+        """Properties of the group of a node"""
+        group = self._groups.get(self._columns['node_group'][row], {})
+        group_index = self._columns['node_group_index'][row]
+        return dict((name, values[group_index]) for name, values in group.items())
+
+    def row_type_props(self, row):
+        """Properties of the node type of a node"""
+        return self._types_table[self._columns['node_type_id'][row]]
+
+    def __len__(self):
+        return len(self._columns['node_gid'])
+
+
+class NodeView(object):
+    """A node of a NodesTable, with the same interface as NodeRow"""
+    __slots__ = ['_table', '_row']
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    @property
+    def gid(self):
+        return self._table.row_gid(self._row)
+
+    @property
+    def with_dynamics_params(self):
+        return False
+
+    @property
+    def dynamics_params(self):
+        return None
+
+    @property
+    def columns(self):
+        return self.node_props.keys() + self.node_type_props.keys()
+
+    @property
+    def node_props(self):
+        return self._table.row_props(self._row)
+
+    @property
+    def node_type_props(self):
+        return self._table.row_type_props(self._row)
+
+    def get(self, prop_key, default=None):
+        return self._table.row_get(self._row, prop_key, default)
+
+    def __contains__(self, prop_key):
+        return self._table.row_contains(self._row, prop_key)
+
+    def __getitem__(self, prop_key):
+        val = self._table.row_get(self._row, prop_key)
+        if val is None:
+            raise Exception('Invalid property key {}.'.format(prop_key))
+        return val
+
+    def __repr__(self):
+        return build_row_repr(self)
+
+
+class EdgesBlock(object):
+    """The edges onto a set of target gids as columns of numpy arrays.
+
+    The edges of each target are contiguous, in the order of the target gids. columns has the arrays of the
+    target_gid, source_gid, edge_type_id and edge_group of every edge, the properties of the edge groups are in
+    groups[edge_group][name] at the position group_row of the edge. Single edges are accessed with rows(target_gid),
+    light weight views (EdgeView) that behave like the EdgeRow of the file format.
+    """
+    def __init__(self, target_gids, index_ptr, columns, groups=None, group_row=None, types_table=None, rows=None):
+        """
+        :param target_gids: sorted target gids
+        :param index_ptr: the edges of target_gids[i] are the rows index_ptr[i]:index_ptr[i+1]
+        :param columns: dictionary of the arrays of the edges
+        :param groups: dictionary of the property arrays of each edge group
+        :param group_row: position of each edge in the arrays of its group
+        :param types_table: properties of each edge_type_id
+        :param rows: EdgeRow objects of the edges, for the formats without columns
+        """
+        self._target_gids = target_gids
+        self._index_ptr = index_ptr
+        self._columns = columns
+        self._groups = groups or {}
+        self._group_row = group_row
+        self._types_table = types_table or {}
+        self._rows = rows
+
+    @property
+    def target_gids(self):
+        return self._target_gids
+
+    @property
+    def columns(self):
+        return self._columns
+
+    def target_range(self, target_gid):
+        """(begin, end) rows of the edges onto target_gid"""
+        i = np.searchsorted(self._target_gids, target_gid)
+        if i == len(self._target_gids) or self._target_gids[i] != target_gid:
+            return 0, 0
+        return int(self._index_ptr[i]), int(self._index_ptr[i+1])
+
+    def rows(self, target_gid):
+        """The edges onto target_gid, one EdgeView (or EdgeRow) each"""
+        begin, end = self.target_range(target_gid)
+        if self._rows is not None:
+            return self._rows[begin:end]
+        return [EdgeView(self, row) for row in xrange(begin, end)]
+
+    def edge(self, row):
+        """The edge at row, an EdgeView (or EdgeRow)"""
+        if self._rows is not None:
+            return self._rows[row]
+        return EdgeView(self, row)
+
+    def type_groups(self, target_gid):
+        """Rows of the edges onto target_gid grouped by their edge_type_id and edge_group
+
+        The edges of a group share the properties of their edge type and the columns of their edge group, see
+        column(). The groups are in the order of their first edge and keep the order of the edges. Formats without
+        columns have one group per edge.
+        """
+        begin, end = self.target_range(target_gid)
+        if self._rows is not None:
+            return [np.array([row]) for row in xrange(begin, end)]
+        if begin == end:
+            return []
+
+        type_ids = np.asarray(self._columns['edge_type_id'][begin:end], dtype=np.int64)
+        group_ids = np.asarray(self._columns['edge_group'][begin:end], dtype=np.int64)
+        _, first, inverse = np.unique(type_ids*(group_ids.max() + 1) + group_ids, return_index=True,
+                                      return_inverse=True)
+        inverse = inverse.reshape(-1)
+        rows = np.argsort(inverse, kind='mergesort') + begin
+        groups = np.split(rows, np.cumsum(np.bincount(inverse))[:-1])
+        return [groups[i] for i in np.argsort(first)]
+
+    def type_key(self, row):
+        """(edge_type_id, edge_group) of the edge at row, the same for all the edges of a type group. None for the
+        formats without columns"""
+        if self._rows is not None:
+            return None
+        return int(self._columns['edge_type_id'][row]), int(self._columns['edge_group'][row])
+
+    def column(self, name, rows):
+        """Array of a property of the edges at rows, which must be in the same type group (see type_groups)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if name in self._columns:
+            return self._columns[name][rows]
+        if self._rows is not None:
+            return np.array([self._rows[row][name] for row in rows])
+
+        group = self._groups.get(self._columns['edge_group'][rows[0]])
+        if group is not None and name in group:
+            return group[name][self._group_row[rows]]
+        return np.repeat(self._types_table[self._columns['edge_type_id'][rows[0]]][name], len(rows))
+
+    def row_get(self, row, name, default=None):
+        """Property of an edge, from its group or its edge type"""
+        group = self._groups.get(self._columns['edge_group'][row])
+        if group is not None and name in group:
+            return group[name][self._group_row[row]]
+        return self._types_table[self._columns['edge_type_id'][row]].get(name, default)
+
+    def row_contains(self, row, name):
+        group = self._groups.get(self._columns['edge_group'][row])
+        return (group is not None and name in group) or \
+            name in self._types_table[self._columns['edge_type_id'][row]]
+
+    def row_props(self, row):
+        """Properties of the group of an edge"""
+        group = self._groups.get(self._columns['edge_group'][row], {})
+        return dict((name, values[self._group_row[row]]) for name, values in group.items())
+
+    def row_type_props(self, row):
+        """Properties of the edge type of an edge"""
+        return self._types_table[self._columns['edge_type_id'][row]]
+
+    def __len__(self):
+        return len(self._columns['source_gid'])
+
+
+class EdgeView(object):
+    """An edge of an EdgesBlock, with the same interface as EdgeRow. The properties are read from the arrays of the
+    block, so a view costs no more than a tuple."""
+    __slots__ = ['_block', '_row']
+
+    def __init__(self, block, row):
+        self._block = block
+        self._row = row
+
+    @property
+    def target_gid(self):
+        return self._block.columns['target_gid'][self._row]
+
+    @property
+    def source_gid(self):
+        return self._block.columns['source_gid'][self._row]
+
+    @property
+    def with_dynamics_params(self):
+        return False
+
+    @property
+    def dynamics_params(self):
+        return None
+
+    @property
+    def columns(self):
+        return self.edge_props.keys() + self._block.row_type_props(self._row).keys()
+
+    @property
+    def edge_props(self):
+        return self._block.row_props(self._row)
+
+    def get(self, prop_key, default=None):
+        return self._block.row_get(self._row, prop_key, default)
+
+    def __contains__(self, prop_key):
+        return self._block.row_contains(self._row, prop_key)
+
+    def __getitem__(self, prop_key):
+        if not self._block.row_contains(self._row, prop_key):
+            raise Exception('Invalid property name {}.'.format(prop_key))
+        return self._block.row_get(self._row, prop_key)
+
+    def __repr__(self):
+        return build_row_repr(self)
+
+
 ##########################################
 # Helper functions
 ##########################################
+def read_rows(dataset, rows, chunk_size=READ_CHUNK):
+    """Values of an hdf5 dataset at the sorted row indexes rows
+
+    The dataset is read in contiguous slices spanning the rows, at most chunk_size rows at a time, the gaps longer than
+    a slice are skipped. The rows of a contiguous range are read at once.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return np.zeros((0,) + dataset.shape[1:], dtype=dataset.dtype)
+
+    values = []
+    begin = rows[0]
+    while begin <= rows[-1]:
+        end = min(begin + chunk_size, rows[-1] + 1)
+        i0, i1 = np.searchsorted(rows, [begin, end])
+        values.append(dataset[begin:end][rows[i0:i1] - begin])
+        begin = rows[i1] if i1 < len(rows) else end
+
+    return values[0] if len(values) == 1 else np.concatenate(values)
+
+
+def target_rows(index_ptr, target_gids):
+    """Rows of the edges onto the sorted target gids and the index pointer of the targets in those rows
+
+    :param index_ptr: the edges onto gid are the rows index_ptr[gid]:index_ptr[gid+1] of the file
+    """
+    target_gids = target_gids[target_gids + 1 < len(index_ptr)]
+    begins = index_ptr[target_gids].astype(np.int64)
+    counts = index_ptr[target_gids + 1].astype(np.int64) - begins
+    ptr = np.concatenate(([0], np.cumsum(counts)))
+    rows = np.repeat(begins - ptr[:-1], counts) + np.arange(ptr[-1], dtype=np.int64)
+    return target_gids, ptr, rows
+
+
 class ColumnProperty(object):
     """Representation of a column name and metadata from a hdf5 dataset, csv column, etc.
 
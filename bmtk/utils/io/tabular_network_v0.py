@@ -25,6 +25,7 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
 import pandas as pd
 import h5py
 
@@ -49,46 +50,42 @@ class TabularNetwork(tn.TabularNetwork):
         return ef
 
 
-class NodeRow(tn.NodeRow):
-    def __init__(self, gid, node_props, types_props, columns):
-        super(NodeRow, self).__init__(gid, node_props, types_props)
-        self._columns = columns
-
-    @property
-    def with_dynamics_params(self):
-        return False
-
-    @property
-    def dynamics_params(self):
-        return None
-
-
 class NodesFile(tn.NodesFile):
     def __init__(self):
         super(NodesFile, self).__init__()
         self._network_name = 'NA'
         self._version = 'v0.0'
 
-        self._nodes_df = None
+        self._nodes_table = None
         self._nodes_columns = None
         self._columns = None
 
     @property
     def gids(self):
-        return list(self._nodes_df.index)
+        return self._nodes_table.gids.tolist()
+
+    @property
+    def nodes_table(self):
+        return self._nodes_table
 
     def load(self, nodes_file, node_types_file):
-        self._nodes_df = pd.read_csv(nodes_file, sep=' ', index_col=['node_id'])
+        nodes_df = pd.read_csv(nodes_file, sep=' ', index_col=['node_id'])
         self._node_types_table = tn.TypesTable(node_types_file, 'node_type_id')
 
-        self._nrows = len(self._nodes_df.index)
-        self._nodes_columns = tn.ColumnProperty.from_csv(self._nodes_df)
+        self._nrows = len(nodes_df.index)
+        self._nodes_columns = tn.ColumnProperty.from_csv(nodes_df)
         self._columns = self._nodes_columns + self._node_types_table.columns
 
+        # the csv columns are the properties of a single group of nodes, see tabular_network.NodesTable
+        columns = {'node_gid': nodes_df.index.values,
+                   'node_type_id': nodes_df['node_type_id'].values,
+                   'node_group': np.zeros(self._nrows, dtype=np.int64),
+                   'node_group_index': np.arange(self._nrows)}
+        groups = {0: dict((name, nodes_df[name].values) for name in nodes_df.columns)}
+        self._nodes_table = tn.NodesTable(columns, groups, self._node_types_table)
+
     def get_node(self, gid, cache=False):
-        nodes_data = self._nodes_df.loc[gid]
-        node_type_data = self._node_types_table[nodes_data['node_type_id']]
-        return NodeRow(gid, nodes_data, node_type_data, self._columns)
+        return self._nodes_table.node(self._nodes_table.row_of(gid))
 
     def __len__(self):
         return self._nrows
@@ -97,9 +94,9 @@ class NodesFile(tn.NodesFile):
         if self._iter_index >= len(self):
             raise StopIteration
         else:
-            gid = self._nodes_df.index.get_loc(self._iter_index)
+            node = self._nodes_table.node(self._iter_index)
             self._iter_index += 1
-            return self.get_node(gid)
+            return node
 
 
 class EdgeRow(tn.EdgeRow):
@@ -161,5 +158,29 @@ class EdgesFile(tn.EdgesFile):
             nsyns = self._num_syns_ds[iloc]
             yield EdgeRow(target_gid, source_gid, nsyns, edge_type)
 
+    def edges_block(self, target_gids):
+        """The edges onto the target gids as columns, the number of synapses of each edge is the property nsyns of a
+        single edge group, see tabular_network.EdgesBlock"""
+        target_gids = np.unique(np.asarray(target_gids, dtype=np.int64))
+        target_gids, index_ptr, rows = tn.target_rows(self._edge_ptr_ds[()], target_gids)
+
+        columns = {'target_gid': np.repeat(target_gids, np.diff(index_ptr)),
+                   'source_gid': tn.read_rows(self._src_gids_ds, rows),
+                   'edge_type_id': tn.read_rows(self._edge_types_ds, rows),
+                   'edge_group': np.zeros(len(rows), dtype=np.int64)}
+        groups = {0: {'nsyns': tn.read_rows(self._num_syns_ds, rows)}}
+        return tn.EdgesBlock(target_gids, index_ptr, columns, groups, np.arange(len(rows)), self._edge_types_table)
+
+    def source_gids(self, target_gids):
+        """Array of the source gid of every edge onto the target gids, only the source gids dataset is read"""
+        target_gids = np.unique(np.asarray(target_gids, dtype=np.int64))
+        _, _, rows = tn.target_rows(self._edge_ptr_ds[()], target_gids)
+        return tn.read_rows(self._src_gids_ds, rows)
+
+    def target_counts(self):
+        edge_ptr = self._edge_ptr_ds[()]
+        syns_ptr = np.concatenate(([0], np.cumsum(self._num_syns_ds[()], dtype=np.int64)))
+        return syns_ptr[edge_ptr[1:]] - syns_ptr[edge_ptr[:-1]]
+
     def __len__(self):
         return self._nrows
@@ -25,6 +25,7 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
 import pandas as pd
 import h5py
 
@@ -55,32 +56,23 @@ class TabularNetwork(tn.TabularNetwork):
         return ef
 
 
-class NodeRow(tn.NodeRow):
-    def __init__(self, gid, group, group_props, types_props):
-        super(NodeRow, self).__init__(gid, group_props, types_props)
-        # TODO: use group to determine if dynamics_params are included.
-
-    @property
-    def with_dynamics_params(self):
-        return False
-
-    @property
-    def dynamics_params(self):
-        return None
-
-
 class NodesFile(tn.NodesFile):
+    """Nodes of an hdf5 file kept in memory as a tabular_network.NodesTable, the index datasets and the properties of
+    every group are read at once when the file is loaded. Nodes are returned as views of the table (NodeView)."""
     def __init__(self):
         super(NodesFile, self).__init__()
 
-        self._nodes_hf = None
-        self._nodes_index = pd.DataFrame()
+        self._nodes_table = None
         self._group_table = {}
         self._nrows = 0
 
     @property
     def gids(self):
-        return list(self._nodes_index.index)
+        return self._nodes_table.gids.tolist()
+
+    @property
+    def nodes_table(self):
+        return self._nodes_table
 
     def load(self, nodes_file, node_types_file):
         nodes_hf = h5py.File(nodes_file, 'r')
@@ -92,32 +84,22 @@ class NodesFile(tn.NodesFile):
         self._version = 'v0.1'  # TODO: get the version number from the attributes
 
         # Create Indices
-        self._nodes_index['node_gid'] = pd.Series(nodes_group['node_gid'], dtype=nodes_group['node_gid'].dtype)
-        self._nodes_index['node_type_id'] = pd.Series(nodes_group['node_type_id'],
-                                                      dtype=nodes_group['node_type_id'].dtype)
-        self._nodes_index['node_group'] = pd.Series(nodes_group['node_group'],
-                                                    dtype=nodes_group['node_group'].dtype)
-        self._nodes_index['node_group_index'] = pd.Series(nodes_group['node_group_index'],
-                                                          dtype=nodes_group['node_group_index'].dtype)
-        self._nodes_index.set_index(['node_gid'], inplace=True)
-        self._nrows = len(self._nodes_index)
+        columns = dict((name, nodes_group[name][()])
+                       for name in ['node_gid', 'node_type_id', 'node_group', 'node_group_index'])
+        self._nrows = len(columns['node_gid'])
 
         # Save the node-types
         self._node_types_table = tn.TypesTable(node_types_file, 'node_type_id')
 
-        # save pointers to the groups table
+        # save pointers to the groups table and load the properties of all the nodes of each group
         self._group_table = {grp_id: Group(grp_id, grp_ptr, self._node_types_table)
                              for grp_id, grp_ptr in nodes_group.items() if isinstance(grp_ptr, h5py.Group)}
+        groups = dict((group_id, self._group_table[str(group_id)].get_all())
+                      for group_id in np.unique(columns['node_group']))
+        self._nodes_table = tn.NodesTable(columns, groups, self._node_types_table)
 
     def get_node(self, gid, cache=False):
-        node_metadata = self._nodes_index.loc[gid]
-        ng = node_metadata['node_group']
-        ng_idx = node_metadata['node_group_index']
-
-        group_props = self._group_table[str(ng)][ng_idx]
-        types_props = self._node_types_table[node_metadata['node_type_id']]
-
-        return NodeRow(gid, self._group_table[str(ng)], group_props, types_props)
+        return self._nodes_table.node(self._nodes_table.row_of(gid))
 
     def __len__(self):
         return self._nrows
@@ -126,9 +108,9 @@ class NodesFile(tn.NodesFile):
         if self._iter_index >= len(self):
             raise StopIteration
         else:
-            gid = self._nodes_index.index.get_loc(self._iter_index)
+            node = self._nodes_table.node(self._iter_index)
             self._iter_index += 1
-            return self.get_node(gid)
+            return node
 
 
 class EdgeRow(tn.EdgeRow):
@@ -213,10 +195,39 @@ class EdgesFile(tn.EdgesFile):
         if target_gid+1 >= self._target_index_len:
             raise StopIteration()
 
-        index_begin = self._target_index.iloc[target_gid]
-        index_end = self._target_index.iloc[target_gid+1]
-        for iloc in xrange(index_begin, index_end):
-            yield self[iloc]
+        for edge in self.edges_block([target_gid]).rows(target_gid):
+            yield edge
+
+    def edges_block(self, target_gids):
+        """The edges onto the target gids as columns, each dataset of the edges and of the edge groups is read once
+        for the rows of all the targets, see tabular_network.EdgesBlock"""
+        target_gids = np.unique(np.asarray(target_gids, dtype=np.int64))
+        target_gids, index_ptr, rows = tn.target_rows(self._target_index.values, target_gids)
+
+        columns = {'target_gid': tn.read_rows(self._target_gid_ds, rows),
+                   'source_gid': tn.read_rows(self._source_gid_ds, rows),
+                   'edge_type_id': tn.read_rows(self._edge_type_ds, rows),
+                   'edge_group': tn.read_rows(self._edge_group_ds, rows)}
+        group_row = tn.read_rows(self._edge_group_index_ds, rows)
+
+        # properties of the edges of each group, indexed by the edge_group_index of the edges
+        groups = {}
+        for group_id in np.unique(columns['edge_group']):
+            group = self._group_table[str(group_id)]
+            in_group = columns['edge_group'] == group_id
+            group_indexes, group_row[in_group] = np.unique(group_row[in_group], return_inverse=True)
+            groups[group_id] = group.get_rows(group_indexes)
+
+        return tn.EdgesBlock(target_gids, index_ptr, columns, groups, group_row, self._edge_types_table)
+
+    def source_gids(self, target_gids):
+        """Array of the source gid of every edge onto the target gids, only the source_gid dataset is read"""
+        target_gids = np.unique(np.asarray(target_gids, dtype=np.int64))
+        _, _, rows = tn.target_rows(self._target_index.values, target_gids)
+        return tn.read_rows(self._source_gid_ds, rows)
+
+    def target_counts(self):
+        return np.diff(self._target_index.values)
 
     def __len__(self):
         return self._nedges
@@ -257,5 +268,13 @@ class Group(object):
             group_props[cprop.name] = h5_obj[indx]
         return group_props
 
+    def get_all(self):
+        """Arrays of the properties of every row of the group"""
+        return dict((cprop.name, h5_obj[()]) for cprop, h5_obj in self._group_table)
+
+    def get_rows(self, indexes):
+        """Arrays of the properties of the sorted group indexes, each dataset is read once"""
+        return dict((cprop.name, tn.read_rows(h5_obj, indexes)) for cprop, h5_obj in self._group_table)
+
     def __repr__(self):
         return "Group('group id': {}, 'properties':{})".format(self._group_id, self._all_columns)
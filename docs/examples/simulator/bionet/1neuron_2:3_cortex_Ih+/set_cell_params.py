@@ -1,5 +1,6 @@
 import json
 from bmtk.simulator.bionet.nrn import *
+from bmtk.simulator.bionet.morphology_cache import load_morphology
 from neuron import h
 
 @cell_model
@@ -20,7 +21,7 @@ def Biophys1(cell_prop):
     '''
 
     morphology_file_name = str(cell_prop['morphology_file'])
-    hobj = h.Biophys1(morphology_file_name)
+    hobj = load_morphology(morphology_file_name)
     fix_axon_allactive(hobj)
     #fix_axon(hobj)
     # set_params_peri(hobj, cell_prop.model_params)
@@ -1,5 +1,6 @@
 import json
 from bmtk.simulator.bionet.nrn import *
+from bmtk.simulator.bionet.morphology_cache import load_morphology
 from neuron import h
 import numpy as np
 
@@ -21,42 +22,12 @@ def Biophys1(cell_prop):
     '''
 
     morphology_file_name = str(cell_prop['morphology_file'])
-    hobj = h.Biophys1(morphology_file_name)
+    hobj = load_morphology(morphology_file_name)
     fix_axon_allactive(hobj)
     #fix_axon(hobj)
     # set_params_peri(hobj, cell_prop.model_params)
     set_params(hobj, cell_prop.model_params)
-
-    def calc_density_exp(dist):
-        # FILL IN HERE
-        g_max=2.84922026765e-07
-        density=g_max*(-0.8696 + 2.087*np.exp((dist)*0.0031))
-        #return dist
-        return density
-
-    targeted_sections = ['apic']  # only apply to these types of segements
-    h.distance(sec=hobj.soma[0])   # need this to set all distances relative to soma (not sure if from center?)
-    for sec in hobj.all:
-        sec_type = sec.name().split(".")[1][:4]
-        if sec_type in targeted_sections:
-            # sec.insert('Ih_mod')  # insert channel mechanics
-            for seg in sec:
-                dist = h.distance(seg.x)
-                sec_density = calc_density_exp(dist)  # calculate the channel density
-                setattr(seg, 'gbar_Ih_mod', sec_density)  # 0.0166428509042) 
-
-    for sec in hobj.all:
-        sec_type = sec.name().split(".")[1][:4]
-        if sec_type == 'axon':
-            continue
-
-# print the distance!
-
-        #if sec_type in targeted_sections:
-        print sec.name()
-        for seg in sec:
-            print h.distance(seg.x), seg.gbar_Ih_mod
-
+    # the apical Ih gradient is set from the "distance_densities" of the model json once the cell is segmented
     return hobj
 
 